@@ -5,11 +5,14 @@
 基础智能体类，作为所有特定角色智能体的父类
 """
 
+import os
 import uuid
+import reprlib
 import logging
-import json # <--- 添加导入 json 模块
-from typing import Dict, List, Any, Optional
-from datetime import datetime, timezone # 导入 timezone 用于 UTC
+from collections import deque
+from itertools import islice
+from typing import Deque, Dict, List, Any, Optional, Tuple
+import time
 
 # 假设 MemorySystem 在这里可以被导入（或至少类型提示可用）
 try:
@@ -17,11 +20,62 @@ try:
 except ImportError:
     MemorySystem = type(None) # 使用 NoneType 进行类型提示
 
+from utils.json_utils import dumps as json_dumps # orjson 可用时使用 orjson，否则回退到标准库 json
+
 logger = logging.getLogger("Hospital-MultiAgent-System")
 
+# 记录对话时，若消息顶层和 content 中都没有 patient_id，依次从这些请求结构中查找（保持顺序，故使用 tuple）
+_POTENTIAL_SOURCES = ("reception_request", "diagnose_request", "prescription_request",
+                      "review_request", "patient_response", "followup_query", "general_query",
+                      "patient_query_about_prescription", "review_result", "diagnosis_result")
+
+# 本地对话历史的最大条数，超出后自动丢弃最早的记录（完整历史由 MemorySystem 持久化）
+LOCAL_HISTORY_CAP = int(os.environ.get("AGENT_HISTORY_CAP", "500"))
+
+# 调试日志中的消息内容摘要：限制每层字典/字符串的展开长度，避免为截取 100 个字符而先完整转换整个 content
+_LOG_REPR = reprlib.Repr()
+_LOG_REPR.maxdict = 3
+_LOG_REPR.maxstring = 40
+_LOG_REPR.maxother = 80
+
+# _now_utc_iso 的秒级缓存: (epoch 秒, "YYYY-MM-DDTHH:MM:SS.")
+_ISO_SECOND_CACHE: Tuple[Optional[int], str] = (None, "")
+
+def _extract_conversation_ids(message: Dict[str, Any], message_content: Dict[str, Any]) -> Tuple[Optional[str], Optional[str]]:
+    """
+    从消息中提取 patient_id 和 consultation_id（或 context_id），用于关联对话记录。
+
+    Args:
+        message: 完整的消息对象。
+        message_content: 消息的 content 字典（非字典时传入空字典）。
+
+    Returns:
+        (patient_id, consultation_id)，未找到的项为 None。
+    """
+    mc_get = message_content.get
+    m_get = message.get
+    # --- 优先读取消息顶层的 patient_id 和 consultation_id ---
+    # Orchestrator 的消息信封和 send_message 构造的消息都会在顶层写入这些 ID
+    # 如果顶层没有，再从 content 中获取 (作为后备)
+    patient_id = m_get("patient_id") or mc_get("patient_id")
+    consultation_id = m_get("consultation_id") or m_get("context_id") or mc_get("consultation_id") or mc_get("context_id")
+
+    # 再次尝试从具体请求结构中获取 (最后的努力)
+    if not patient_id:
+         patient_id = next((source_data["patient_id"] for source_key in _POTENTIAL_SOURCES
+                            if type(source_data := message_content.get(source_key)) is dict and source_data.get("patient_id")),
+                           None) # 找到即停止
+    return patient_id, consultation_id
+
+
 class BaseAgent:
     """基础智能体类，提供共通的功能"""
 
+    # 使用 __slots__ 省去每个实例的 __dict__。
+    # 注意：子类也必须声明自己的 __slots__（无新增属性时为空 tuple），否则实例仍会带有 __dict__；
+    # 新增实例属性时需同步加入对应类的 __slots__。
+    __slots__ = ("id", "name", "role", "memory_system", "_mem_ok", "_local_memory", "_conversation_history")
+
     def __init__(self, name: str, role: str, memory_system: Optional[MemorySystem] = None):
         """
         初始化基础智能体
@@ -34,32 +88,53 @@ class BaseAgent:
         Raises:
             ValueError: 如果 role 为空.
         """
-        self.id = str(uuid.uuid4())
+        self.id = uuid.uuid4().hex # 32 位十六进制字符串，省去 str(UUID) 的分隔符格式化
         self.name = name
         if not role: raise ValueError("Agent role cannot be empty")
         self.role = role
         self.memory_system = memory_system
+        # 缓存 MemorySystem 是否可用，避免每条消息都重复 isinstance 检查
+        self._mem_ok: bool = memory_system is not None and isinstance(memory_system, MemorySystem)
 
         # 内部简单记忆（主要用于无 MemorySystem 时的备用）
         self._local_memory: Dict[str, Any] = {}
-        self._conversation_history: List[Dict[str, Any]] = []
+        self._conversation_history: Deque[Dict[str, Any]] = deque(maxlen=LOCAL_HISTORY_CAP)
 
-        logger.info(f"初始化 {self.role} 智能体: {name} (ID: {self.id})")
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(f"初始化 {self.role} 智能体: {name} (ID: {self.id})")
 
     def _now_utc_iso(self) -> str:
-        """获取当前 UTC 时间的 ISO 格式字符串"""
-        return datetime.now(timezone.utc).isoformat()
+        """
+        获取当前 UTC 时间的 ISO 格式字符串（YYYY-MM-DDTHH:MM:SS.ffffff+00:00）。
+
+        同一秒内复用已格式化的日期时间前缀，只拼接微秒部分，省去每次构造和格式化 datetime 对象。
+        与 datetime.isoformat() 不同，微秒部分始终输出。
+        """
+        global _ISO_SECOND_CACHE
+        seconds, micros = divmod(time.time_ns() // 1000, 1_000_000)
+        cached = _ISO_SECOND_CACHE
+        if cached[0] != seconds:
+            cached = (seconds, time.strftime("%Y-%m-%dT%H:%M:%S.", time.gmtime(seconds)))
+            _ISO_SECOND_CACHE = cached # 整体替换 tuple，多线程下读到的前缀与秒数始终一致
+        return f"{cached[1]}{micros:06d}+00:00"
 
     def receive_message(self, message: Dict[str, Any]) -> Dict[str, Any]:
         """
         处理接收到的消息，包含记录和错误处理。
         """
-        # 记录接收到的消息
-        self._record_conversation(direction="received", message=message)
-        sender_info = f"{message.get('sender_role', '未知角色')} ({message.get('sender_id', 'N/A')})"
-        # 尝试记录更简洁的消息内容摘要
-        content_summary = str(message.get('content', {}))[:100] # 取前100个字符
-        logger.debug(f"{self.role} {self.name} 收到来自 {sender_info} 的消息: {content_summary}...")
+        # 本轮收发的对话记录先缓存，处理结束后一次性批量写入 MemorySystem
+        pending_entries: List[Dict[str, Any]] = []
+        # 记录接收到的消息（时间戳只计算一次）
+        received_at = self._now_utc_iso()
+        self._record_conversation(direction="received", message=message, timestamp=received_at, batch=pending_entries)
+        # 仅在 DEBUG 级别启用时才构造日志字符串
+        if logger.isEnabledFor(logging.DEBUG):
+            sender_role = message["sender_role"] if "sender_role" in message else "未知角色"
+            sender_id = message["sender_id"] if "sender_id" in message else "N/A"
+            sender_info = f"{sender_role} ({sender_id})"
+            # 尝试记录更简洁的消息内容摘要
+            content_summary = _LOG_REPR.repr(message.get('content', {}))
+            logger.debug(f"{self.role} {self.name} 收到来自 {sender_info} 的消息: {content_summary}")
 
         # 具体处理逻辑由子类实现
         response = {} # 初始化默认响应
@@ -82,14 +157,17 @@ class BaseAgent:
         # 记录发送的响应
         # 确保 response 是我们期望的字典结构
         if response and "sender_id" in response: # 检查是否是 send_message 构建的结构
-             self._record_conversation(direction="sent", message=response)
-             receiver_info = response.get('receiver_id', '未知接收者')
-             response_content_summary = str(response.get('content', {}))[:100]
-             logger.debug(f"{self.role} {self.name} 发送响应给 {receiver_info}: {response_content_summary}...")
+             # 复用 send_message 已生成的时间戳，避免再次获取当前时间
+             self._record_conversation(direction="sent", message=response, timestamp=response.get("timestamp_utc"), batch=pending_entries)
+             if logger.isEnabledFor(logging.DEBUG):
+                 receiver_info = response.get('receiver_id', '未知接收者')
+                 response_content_summary = _LOG_REPR.repr(response.get('content', {}))
+                 logger.debug(f"{self.role} {self.name} 发送响应给 {receiver_info}: {response_content_summary}")
         else:
              logger.warning(f"{self.role} {self.name} 的 _process_message 未返回标准消息结构，响应内容: {response}")
              # 可以选择返回一个默认错误或尝试包装它，这里选择记录警告
 
+        self._flush_conversation_entries(pending_entries)
         return response
 
     def _process_message(self, message: Dict[str, Any]) -> Dict[str, Any]:
@@ -105,13 +183,21 @@ class BaseAgent:
         """
         raise NotImplementedError(f"子类 {self.__class__.__name__} 必须实现 _process_message 方法")
 
-    def send_message(self, receiver_id: str, content: Dict[str, Any]) -> Dict[str, Any]:
+    def send_message(self, receiver_id: str, content: Dict[str, Any], *, timestamp: Optional[str] = None,
+                     patient_id: Optional[str] = None, consultation_id: Optional[str] = None) -> Dict[str, Any]:
         """
         构造发送给其他智能体或Orchestrator的消息。
 
+        patient_id / consultation_id 会写入消息顶层（与 Orchestrator 构造的消息信封一致），
+        未显式提供时从 content 中的 patient_id、consultation_id/context_id 获取，
+        使记录对话时无需再在 content 的各个请求结构中查找。
+
         Args:
             receiver_id: 接收者ID (例如 Orchestrator 的 ID 或另一个 Agent 的 ID)。
             content: 消息内容字典。应包含必要的处理结果、状态等信息。
+            timestamp: 可选的 UTC ISO 时间戳，未提供时使用当前时间。
+            patient_id: 可选的患者ID。
+            consultation_id: 可选的问诊ID。
 
         Returns:
             格式化的消息对象。
@@ -122,126 +208,145 @@ class BaseAgent:
             "sender_role": self.role,
             "receiver_id": receiver_id,
             "content": content, # content 应该包含 status 等信息
-            "timestamp_utc": self._now_utc_iso() # 使用 UTC 时间戳
+            "timestamp_utc": timestamp or self._now_utc_iso() # 使用 UTC 时间戳
         }
+        if type(content) is dict:
+            patient_id = patient_id or content.get("patient_id")
+            consultation_id = consultation_id or content.get("consultation_id") or content.get("context_id")
+        if patient_id: message["patient_id"] = patient_id
+        if consultation_id: message["consultation_id"] = consultation_id
         return message
 
-    def _record_conversation(self, direction: str, message: Dict[str, Any]) -> None:
+    def _record_conversation(self, direction: str, message: Dict[str, Any], *, timestamp: Optional[str] = None,
+                             batch: Optional[List[Dict[str, Any]]] = None) -> None:
         """
         记录对话历史到本地和 MemorySystem (如果可用)。
-        """
-        now_iso = self._now_utc_iso()
-        # 尝试创建一个消息的浅拷贝用于本地历史，避免后续修改影响记录
-        try:
-             local_message_copy = message.copy()
-        except:
-             local_message_copy = message # 如果无法拷贝，使用原始引用
 
+        Args:
+            direction: "received" 或 "sent"。
+            message: 消息对象。
+            timestamp: 可选的 UTC ISO 时间戳，由调用方传入以避免重复获取当前时间。
+            batch: 可选的待写入列表。提供时记录只追加到该列表，由调用方通过 _flush_conversation_entries 批量写入；
+                   否则立即写入 MemorySystem。
+        """
+        now_iso = timestamp or self._now_utc_iso()
+        # 本地历史直接保存消息引用：receive_message / send_message 在记录后都不会再修改消息，无需浅拷贝
         entry = {
             "timestamp_utc": now_iso,
             "direction": direction,
-            "message": local_message_copy
+            "message": message
         }
         self._conversation_history.append(entry)
 
-        # 如果有 MemorySystem，尝试记录到中央系统
-        if self.memory_system and isinstance(self.memory_system, MemorySystem):
-            patient_id: Optional[str] = None
-            message_content = message.get("content", {}) if isinstance(message.get("content"), dict) else {}
-
-            # --- 统一从 content 中提取 patient_id 和 context_id/consultation_id ---
-            # Agent 在处理时应将这些 ID 放入 content 或 Agent 返回给 Orchestrator 的 content 中
-            patient_id = message_content.get("patient_id")
-            consultation_id = message_content.get("consultation_id") or message_content.get("context_id")
-
-            # 如果 content 中没有，尝试从顶层消息获取 (作为后备)
-            if not patient_id: patient_id = message.get("patient_id")
-            if not consultation_id: consultation_id = message.get("consultation_id") or message.get("context_id")
-
-            # 再次尝试从具体请求结构中获取 (最后的努力)
-            if not patient_id:
-                 potential_sources = ["reception_request", "diagnose_request", "prescription_request",
-                                      "review_request", "patient_response", "followup_query", "general_query",
-                                      "patient_query_about_prescription", "review_result", "diagnosis_result"]
-                 for source_key in potential_sources:
-                     source_data = message_content.get(source_key)
-                     if isinstance(source_data, dict):
-                         patient_id = source_data.get("patient_id")
-                         if patient_id: break # 找到即停止
-
-            # --- 确定角色和内容 ---
-            conversation_role = ""
-            log_content = {} # 存储更结构化的内容，而不是纯字符串
-            metadata_to_save = {
-                "direction": direction,
-                "original_sender_id": message.get("sender_id"),
-                "original_sender_role": message.get("sender_role"),
-                "original_receiver_id": message.get("receiver_id"),
-                "interaction_agent_id": None # 交互 Agent ID
-            }
-            if consultation_id: metadata_to_save['consultation_id'] = consultation_id
-
-            if direction == "received":
-                conversation_role = message.get("sender_role", "unknown_sender")
-                metadata_to_save["interaction_agent_id"] = message.get("sender_id")
-                log_content = message_content # 记录收到的内容
-            elif direction == "sent":
-                conversation_role = self.role
-                metadata_to_save["interaction_agent_id"] = self.id
-                log_content = message_content # 记录发送的内容
-
-            # 如果成功获取 Patient ID，则记录
-            if patient_id:
-                try:
-                    # --- 使用 json.dumps 将 log_content 转为字符串存储 ---
-                    # 这是因为 MemorySystem 的 add_conversation_entry 当前接受字符串 content
-                    # 如果未来 MemorySystem 支持存储字典，可以移除 dumps
-                    log_content_str = json.dumps(log_content, ensure_ascii=False, default=str)
-                    # ----------------------------------------------------
-
-                    self.memory_system.add_conversation_entry(
-                        patient_id=patient_id,
-                        role=conversation_role,
-                        content=log_content_str, # 传递 JSON 字符串
-                        metadata=metadata_to_save
-                    )
-                except AttributeError:
-                     logger.error(f"MemorySystem 实例 ({type(self.memory_system)}) 似乎没有 add_conversation_entry 方法或实例无效。")
-                except Exception as e:
-                    logger.error(f"记录对话到 MemorySystem 时出错 (Patient: {patient_id}): {e}", exc_info=True)
-            else:
-                 # 仅当 direction 是 received 且我们是处理者时，记录无法关联患者的警告可能更有用
-                 if direction == "received":
-                      logger.warning(f"无法从消息中提取 patient_id 以记录对话历史: Keys={list(message_content.keys())}")
+        # 没有 MemorySystem 时无需提取 patient_id 等信息，直接返回
+        if not self._mem_ok:
+            return
+
+        # 消息均由 dict 字面量构造，直接比较类型即可，无需 isinstance 遍历 MRO
+        raw_content = message.get("content")
+        message_content = raw_content if type(raw_content) is dict else {}
+        patient_id, consultation_id = _extract_conversation_ids(message, message_content)
+
+        # --- 确定角色和内容 ---
+        conversation_role = ""
+        interaction_agent_id = None # 交互 Agent ID
+        log_content = message_content # 存储更结构化的内容，而不是纯字符串
+        if direction == "received":
+            conversation_role = message.get("sender_role", "unknown_sender")
+            interaction_agent_id = message.get("sender_id")
+        elif direction == "sent":
+            conversation_role = self.role
+            interaction_agent_id = self.id
+
+        # 每次构造新的 metadata 字典：MemorySystem 会保留并修改它（写入 timestamp_utc），不能跨调用复用
+        metadata_to_save = {
+            "direction": direction,
+            "original_sender_id": message.get("sender_id"),
+            "original_sender_role": message.get("sender_role"),
+            "original_receiver_id": message.get("receiver_id"),
+            "interaction_agent_id": interaction_agent_id
+        }
+        if consultation_id: metadata_to_save['consultation_id'] = consultation_id
 
+        # 如果成功获取 Patient ID，则记录
+        if patient_id:
+            try:
+                # --- 将 log_content 序列化为 JSON 字符串存储 ---
+                # 这是因为 MemorySystem 的 add_conversation_entry 当前接受字符串 content
+                # 如果未来 MemorySystem 支持存储字典，可以移除序列化
+                log_content_str = json_dumps(log_content)
+                if batch is not None:
+                    # 保留记录发生的时间，批量写入后仍能按时间排序
+                    metadata_to_save["timestamp_utc"] = now_iso
+                    batch.append({"patient_id": patient_id, "role": conversation_role,
+                                  "content": log_content_str, "metadata": metadata_to_save})
+                    return
+                # ----------------------------------------------------
+
+                self.memory_system.add_conversation_entry(
+                    patient_id=patient_id,
+                    role=conversation_role,
+                    content=log_content_str, # 传递 JSON 字符串
+                    metadata=metadata_to_save
+                )
+            except AttributeError:
+                 logger.error(f"MemorySystem 实例 ({type(self.memory_system)}) 似乎没有 add_conversation_entry 方法或实例无效。")
+            except Exception as e:
+                logger.error(f"记录对话到 MemorySystem 时出错 (Patient: {patient_id}): {e}", exc_info=True)
+        else:
+             # 仅当 direction 是 received 且我们是处理者时，记录无法关联患者的警告可能更有用
+             if direction == "received":
+                  # 使用 % 延迟格式化：dict_keys 视图仅在日志真正输出时才转为字符串
+                  logger.warning("无法从消息中提取 patient_id 以记录对话历史: Keys=%s", message_content.keys())
+
+
+    def _flush_conversation_entries(self, entries: List[Dict[str, Any]]) -> None:
+        """将缓存的对话记录批量写入 MemorySystem（只触发一次持久化）。"""
+        if not entries or not self._mem_ok:
+            return
+        try:
+            self.memory_system.add_conversation_entries(entries)
+        except AttributeError:
+             logger.error(f"MemorySystem 实例 ({type(self.memory_system)}) 似乎没有 add_conversation_entries 方法或实例无效。")
+        except Exception as e:
+            logger.error(f"批量记录对话到 MemorySystem 时出错 ({len(entries)} 条): {e}", exc_info=True)
+        entries.clear()
 
     # --- Memory Interaction Wrappers (简化) ---
 
     def update_memory(self, key: str, value: Any):
         """(简化) 更新智能体的本地记忆。与中央 MemorySystem 的交互应通过其自身方法完成。"""
-        logger.debug(f"{self.role} {self.name} 更新本地记忆: {key}={str(value)[:50]}...")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"{self.role} {self.name} 更新本地记忆: {key}={str(value)[:50]}...")
         self._local_memory[key] = value
 
     def get_memory(self, key: str, default: Any = None) -> Any:
         """(简化) 获取智能体的本地记忆。"""
         return self._local_memory.get(key, default)
 
+    def _local_history_tail(self, limit: int) -> List[Dict[str, Any]]:
+        """返回本地历史的最近 limit 条，只复制需要的尾部而不是整个 deque。"""
+        if limit <= 0:
+            return list(self._conversation_history) # 与原先 list[-0:] 的行为一致，返回全部
+        start = max(0, len(self._conversation_history) - limit)
+        return list(islice(self._conversation_history, start, None))
+
     def get_conversation_history(self, patient_id: Optional[str] = None, limit: int = 10) -> List[Dict[str, Any]]:
         """
         获取对话历史。优先从 MemorySystem 获取指定患者的历史，否则返回本地历史。
         """
-        if patient_id and self.memory_system and isinstance(self.memory_system, MemorySystem):
+        if patient_id and self._mem_ok:
             try:
                  # 获取全部历史（或按需筛选角色）
                  return self.memory_system.get_conversation_history(patient_id, limit=limit)
             except AttributeError:
                  logger.error(f"MemorySystem 实例 ({type(self.memory_system)}) 似乎没有 get_conversation_history 方法或实例无效。")
-                 return self._conversation_history[-limit:] # Fallback to local
+                 return self._local_history_tail(limit) # Fallback to local
             except Exception as e:
                 logger.error(f"从 MemorySystem 获取对话历史时出错 (Patient: {patient_id}): {e}")
-                return self._conversation_history[-limit:] # Fallback to local
+                return self._local_history_tail(limit) # Fallback to local
 
         # 返回本地历史的最近 N 条
-        return self._conversation_history[-limit:]
+        return self._local_history_tail(limit)
 
 # ... (文件结束)
\ No newline at end of file
@@ -7,26 +7,176 @@
 
 import logging
 import json
+import re
+import unicodedata
 import uuid
-from typing import Dict, List, Any, Optional
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, fields, replace
+from typing import Dict, Iterable, List, Any, Optional, Set, Tuple
 from .base_agent import BaseAgent
+from utils.cache import TTLCache, make_prompt_key
+from utils.json_utils import dumps as json_dumps, loads as json_loads, loads_tolerant as json_loads_tolerant
 try:
-    from utils.llm_service import LLMService
+    from utils.llm_service import LLMService, LLM_ERROR_PREFIX
     from utils.memory_system import MemorySystem
 except ImportError as e:
      logging.error(f"导入依赖失败: {e}")
      LLMService = None
      MemorySystem = None
+     LLM_ERROR_PREFIX = "很抱歉，我无法处理您的请求"
 
 logger = logging.getLogger("Hospital-MultiAgent-System")
 
+# 用于并行发起 LLM 请求的线程池（LLM 调用是阻塞的网络 I/O，多线程即可重叠等待时间）
+_LLM_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="doctor-llm")
+
+# _extract_field / _extract_list 使用的正则缓存（字段名 -> 已编译的正则）
+_FIELD_RE_CACHE: Dict[str, "re.Pattern[str]"] = {}
+_LIST_RE_CACHE: Dict[str, "re.Pattern[str]"] = {}
+_QUOTED_ITEM_RE = re.compile(r'"([^"]*)"')
+
+# 与中日韩文字相邻的空白（"头 痛" 与 "头痛" 视为同一症状，英文词间的空格保留）
+_CJK_SPACE_RE = re.compile(r'(?<=[\u3040-\u30ff\u3400-\u9fff])\s+|\s+(?=[\u3040-\u30ff\u3400-\u9fff])')
+
+def _canon(symptom: str) -> str:
+    """症状的规范形式：NFKC 归一化（全角转半角等）、合并连续空白并去除中文字符间的空白、转小写"""
+    return _CJK_SPACE_RE.sub("", " ".join(unicodedata.normalize("NFKC", symptom).split())).lower()
+
+# 下一个问题的提示词只保留最近 RECENT_QA_WINDOW 轮完整问答，更早的问答折叠为截断拼接的摘要
+RECENT_QA_WINDOW = 2
+HISTORY_SUMMARY_MAX_CHARS = 400
+NEXT_QUESTION_MAX_TOKENS = 120 # 输出仅为一个问题
+
+# --- 提示词模板中固定不变的部分（模块加载时构建一次）---
+_NEXT_Q_HEAD = "作为一位专业医生，根据以下问诊上下文信息生成下一个有针对性的问题:"
+_NEXT_Q_TAIL = """
+请生成一个专业、有针对性的问题，帮助进一步了解患者情况以提高诊断准确性。问题应该避免重复，并根据已知信息深入挖掘。
+
+只返回问题文本本身，不要包含其他内容。
+"""
+_NEXT_Q_SYSTEM = "你是一位专业医生，正在进行交互式问诊。请提出精准、简洁的下一个问题。"
+_DIAG_HEAD = "作为专业医生，请根据以下信息生成诊断结果："
+_DIAG_TAIL = """
+请以JSON格式返回诊断结果，包含以下字段:
+- "condition": 诊断结果
+- "explanation": 诊断解释
+- "severity": 严重程度
+- "recommendations": 建议措施列表
+- "medications": 药物列表，每项包含name, dosage, purpose
+- "follow_up": 随访建议
+- "differential_diagnosis": 鉴别诊断列表（可选）
+- "diagnostic_tests": 建议检查列表（可选）
+
+请确保JSON格式简洁且完整，避免过长的描述导致内容被截断。每个字段的值保持在50字以内，列表项不超过5个。
+"""
+_DIAG_SYSTEM = "你是一位资深医生，正在进行诊断。请给出专业、简洁且结构化的诊断结果（JSON格式）。"
+
+# LLM 响应缓存的过期时间（秒）：(问题, 回答) 的分析结果较稳定，缓存更久
+NEXT_QUESTION_CACHE_TTL = 3600
+ANALYSIS_CACHE_TTL = 24 * 3600
+# 问诊上下文本地缓存的过期时间（秒），覆盖一次多轮问诊的间隔
+CONTEXT_CACHE_TTL = 300
+
+@dataclass(slots=True)
+class ConsultationContext:
+    """
+    医生持有的问诊上下文。MemorySystem 与其他组件（如 Orchestrator 的交互日志）仍以字典形式读写上下文，
+    因此仅在持久化边界通过 to_dict / from_dict 转换，且只包含医生负责维护的字段
+    """
+    patient_id: str = ""
+    consultation_id: str = ""
+    initial_symptoms: Tuple[str, ...] = ()
+    medical_history: Tuple[str, ...] = ()
+    department: str = "general"
+    current_symptoms: Set[str] = field(default_factory=set) # 规范形式的症状集合
+    questions_asked: List[str] = field(default_factory=list)
+    patient_responses: List[str] = field(default_factory=list)
+    history_summary: str = "" # 滑出最近问答窗口的早先问答摘要
+    summarized_turns: int = 0
+    confidence: float = 0.3
+    stage: str = "information_gathering"
+    is_return_visit: bool = False
+    previous_diagnosis: Any = None
+    reception_notes: str = ""
+    symptom_details: Dict[str, Any] = field(default_factory=dict)
+    related_info: Dict[str, Any] = field(default_factory=dict)
+    diagnosis: Optional[Dict[str, Any]] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        """转换为保存到 MemorySystem 的字典（浅拷贝，列表等容器与本对象共享）"""
+        return {name: getattr(self, name) for name in _CONTEXT_FIELDS}
+
+    def to_update_dict(self) -> Dict[str, Any]:
+        """转换为问诊过程中合并回 MemorySystem 的字典：不含 stage，避免用医生持有的旧值覆盖 Orchestrator 推进后的阶段"""
+        return {name: getattr(self, name) for name in _CONTEXT_UPDATE_FIELDS}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ConsultationContext":
+        """从 MemorySystem 中的字典构建，忽略其他组件写入的字段；从持久化文件恢复的列表转回集合/元组"""
+        ctx = cls(**{name: data[name] for name in _CONTEXT_FIELDS if name in data})
+        if not isinstance(ctx.current_symptoms, set): ctx.current_symptoms = set(ctx.current_symptoms or ())
+        if not isinstance(ctx.initial_symptoms, tuple): ctx.initial_symptoms = tuple(ctx.initial_symptoms or ())
+        if not isinstance(ctx.medical_history, tuple): ctx.medical_history = tuple(ctx.medical_history or ())
+        return ctx
+
+_CONTEXT_FIELDS = tuple(f.name for f in fields(ConsultationContext))
+_CONTEXT_UPDATE_FIELDS = tuple(name for name in _CONTEXT_FIELDS if name != "stage")
+
+def _read_json_object_from_stream(chunks: Iterable[str]) -> str:
+    """
+    累积流式增量文本，顶层 JSON 对象闭合后立即停止读取并关闭流（不再等待其后的代码块标记或说明文字）。
+    流在对象闭合前结束（如达到 max_tokens 被截断）时返回已收到的全部文本
+    """
+    buf: List[str] = []
+    depth = 0
+    in_string = escaped = False
+    try:
+        for chunk in chunks:
+            for i, ch in enumerate(chunk):
+                if in_string:
+                    if escaped: escaped = False
+                    elif ch == "\\": escaped = True
+                    elif ch == '"': in_string = False
+                elif ch == '"': in_string = True
+                elif ch == "{": depth += 1
+                elif ch == "}" and depth > 0:
+                    depth -= 1
+                    if depth == 0:
+                        buf.append(chunk[:i + 1])
+                        return "".join(buf)
+            buf.append(chunk)
+        return "".join(buf)
+    finally:
+        close = getattr(chunks, "close", None)
+        if close: close()
+
 class DoctorAgent(BaseAgent):
     """医生智能体"""
 
+    __slots__ = ("specialty", "llm_service", "_llm_cache", "_ctx_cache")
+
+    # 消息类型 -> 处理方法名（按插入顺序匹配，与原 if/elif 的优先级一致）
+    _HANDLERS = {
+        "diagnose_request": "_handle_diagnosis_request",
+        "patient_response": "_handle_patient_response",
+        "prescription_request": "_handle_prescription_request",
+    }
+
+    # 诊断判定阈值
+    MIN_CONFIDENCE = 0.75 # 置信度达到即可诊断
+    MAX_QUESTIONS = 5 # 问题数达到即强制诊断
+    MIN_QUESTIONS_FORCE_DIAG = 4 # 问题数达到且置信度超过 FORCE_DIAG_MIN_CONFIDENCE 时诊断
+    FORCE_DIAG_MIN_CONFIDENCE = 0.4
+
     def __init__(self, name: str = "主治医生", specialty: str = "general", memory_system: Optional[MemorySystem] = None, llm_service: Optional[LLMService] = None):
         super().__init__(name=name, role="doctor", memory_system=memory_system)
         self.specialty = specialty
         self.llm_service = llm_service
+        self._llm_cache = TTLCache(maxsize=1024, ttl=NEXT_QUESTION_CACHE_TTL)
+        # 问诊上下文缓存（写穿）：缓存由字典构建的 ConsultationContext 对象，省去每轮重新构建；
+        # 它是独立的副本，看不到其他组件对 MemorySystem 中字典的修改，因此每轮仍先核对 MemorySystem：
+        # 上下文已被删除时丢弃缓存，stage 以 MemorySystem 中的值为准（由 Orchestrator 推进）
+        self._ctx_cache = TTLCache(maxsize=2048, ttl=CONTEXT_CACHE_TTL)
         if not self.llm_service: logger.error(f"医生 {name}: LLM 服务未提供。")
         if not self.memory_system: logger.error(f"医生 {name}: MemorySystem 未提供。")
         logger.info(f"医生智能体 {name} ({specialty}) 初始化完成")
@@ -40,16 +190,11 @@ class DoctorAgent(BaseAgent):
              logger.error(f"医生 {self.name} 无法处理请求，缺少 LLM 或 MemorySystem。")
              return self.send_message(sender_id, {"status": "error", "message": "内部服务错误，无法处理诊断请求。"})
 
-        if "diagnose_request" in content:
-            return self._handle_diagnosis_request(message)
-        elif "patient_response" in content:
-            return self._handle_patient_response(message)
-        elif "prescription_request" in content:
-             logger.info(f"医生 {self.name} 收到独立的处方请求。")
-             return self._handle_prescription_request(message)
-        else:
-            logger.warning(f"医生 {self.name} 收到未知类型的消息: {list(content.keys())}")
-            return self.send_message(sender_id, {"status": "unhandled", "message": f"医生无法处理此请求类型。"})
+        key = next((k for k in self._HANDLERS if k in content), None)
+        if key:
+            return getattr(self, self._HANDLERS[key])(message)
+        logger.warning(f"医生 {self.name} 收到未知类型的消息: {list(content.keys())}")
+        return self.send_message(sender_id, {"status": "unhandled", "message": f"医生无法处理此请求类型。"})
 
     # --- 内部处理方法 ---
 
@@ -74,31 +219,23 @@ class DoctorAgent(BaseAgent):
         previous_diagnosis = request.get("previous_diagnosis")
         reception_notes = request.get("reception_notes", "") # 获取接待员备注
 
-        logger.info(f"医生 {self.name} 开始处理患者 {patient_id} 的诊断请求 (Consultation: {consultation_id})。复诊: {is_return_visit}")
-
-        initial_context = {
-            "patient_id": patient_id,
-            "consultation_id": consultation_id, # 在上下文中也存一份
-            "initial_symptoms": symptoms.copy(),
-            "medical_history": medical_history.copy(),
-            "department": department,
-            "current_symptoms": symptoms.copy(),
-            "questions_asked": [],
-            "patient_responses": [],
-            "confidence": 0.3,
-            "stage": "information_gathering", # 设置医生的阶段
-            "is_return_visit": is_return_visit,
-            "previous_diagnosis": previous_diagnosis,
-            "reception_notes": reception_notes # 保存接待员备注
-        }
+        logger.info("医生 %s 开始处理患者 %s 的诊断请求 (Consultation: %s)。复诊: %s", self.name, patient_id, consultation_id, is_return_visit)
+
+        initial_context = ConsultationContext(
+            patient_id=patient_id,
+            consultation_id=consultation_id, # 在上下文中也存一份
+            initial_symptoms=tuple(symptoms), # 只读，存为元组即可，无需拷贝列表
+            medical_history=tuple(medical_history),
+            department=department,
+            current_symptoms={_canon(s) for s in symptoms if s.strip()}, # 内部以规范形式的集合维护，持久化时由 MemorySystem 转为列表
+            is_return_visit=is_return_visit,
+            previous_diagnosis=previous_diagnosis,
+            reception_notes=reception_notes # 保存接待员备注
+        )
 
         try:
             first_question = self._generate_next_question(initial_context)
-            initial_context["questions_asked"].append(first_question)
-
-            # --- 关键修改：使用 consultation_id 作为 key 保存上下文 ---
-            self.memory_system.save_consultation_context(consultation_id, initial_context)
-            # -----------------------------------------------
+            initial_context.questions_asked.append(first_question)
 
             response_content = {
                 "status": "in_consultation",
@@ -109,17 +246,22 @@ class DoctorAgent(BaseAgent):
                 # ----------------------------------------------------
                 "patient_id": patient_id
             }
-            # 记录到患者记忆和对话历史
-            self.memory_system.add_patient_memory(patient_id, "consultation_started_by_doctor",
-                                                  {"context_id": consultation_id, "symptoms": symptoms, "department": department},
-                                                  metadata={"agent_id": self.id})
-            self.memory_system.add_conversation_entry(patient_id, self.role, first_question,
-                                                       metadata={"agent_id": self.id, "consultation_id": consultation_id}) # 使用 consultation_id
+            with self.memory_system.pipeline(background=True): # 三次写入合并为一次落盘，且不阻塞回复
+                # --- 关键修改：使用 consultation_id 作为 key 保存上下文 ---
+                self.memory_system.save_consultation_context(consultation_id, initial_context.to_dict())
+                self._ctx_cache.set(consultation_id, initial_context)
+                # -----------------------------------------------
+                # 记录到患者记忆和对话历史
+                self.memory_system.add_patient_memory(patient_id, "consultation_started_by_doctor",
+                                                      {"context_id": consultation_id, "symptoms": symptoms, "department": department},
+                                                      metadata={"agent_id": self.id})
+                self.memory_system.add_conversation_entry(patient_id, self.role, first_question,
+                                                           metadata={"agent_id": self.id, "consultation_id": consultation_id}) # 使用 consultation_id
 
             return self.send_message(sender_id, response_content)
 
         except Exception as e:
-            logger.error(f"为患者 {patient_id} 生成首个问题时出错 (Consultation: {consultation_id}): {e}", exc_info=True)
+            logger.error("为患者 %s 生成首个问题时出错 (Consultation: %s): %s", patient_id, consultation_id, e, exc_info=True)
             return self.send_message(sender_id, {"status": "error", "message": f"开始问诊时出错: {e}"})
 
 
@@ -138,48 +280,69 @@ class DoctorAgent(BaseAgent):
             logger.error("患者回复消息缺少 context_id 或 patient_id")
             return self.send_message(sender_id, {"status": "error", "message": "患者回复缺少必要ID"})
         if not answer:
-             logger.warning(f"收到来自 patient {patient_id} 的空回复 (Context: {context_id})")
+             logger.warning("收到来自 patient %s 的空回复 (Context: %s)", patient_id, context_id)
              # 可以选择追问或忽略，这里简单返回错误提示
              return self.send_message(sender_id, {"status": "error", "message": "收到的回复内容为空，请重新输入。"})
 
-        current_context = self.memory_system.get_consultation_context(context_id)
-        if not current_context:
-            logger.error(f"处理患者回复失败：找不到或问诊已过期 (context_id: {context_id})")
+        stored_context = self.memory_system.get_consultation_context(context_id)
+        if stored_context is None:
+            # 已被其他组件删除（如 Orchestrator 结束问诊），丢弃缓存
+            self._ctx_cache.pop(context_id)
+            current_context = None
+        else:
+            current_context = self._ctx_cache.get(context_id)
+            if current_context is None:
+                current_context = ConsultationContext.from_dict(stored_context)
+                self._ctx_cache.set(context_id, current_context)
+            else:
+                current_context.stage = stored_context.get("stage", current_context.stage)
+        if current_context is None:
+            logger.error("处理患者回复失败：找不到或问诊已过期 (context_id: %s)", context_id)
             return self.send_message(sender_id, {"status": "error", "message": f"会话已过期或无效 (ID: {context_id})"})
 
-        logger.info(f"医生 {self.name} 收到患者 {patient_id} 对问题 (Context: {context_id}) 的回答: '{answer[:50]}...'")
+        logger.info("医生 %s 收到患者 %s 对问题 (Context: %s) 的回答: '%.50s...'", self.name, patient_id, context_id, answer)
         self.memory_system.add_conversation_entry(patient_id, "patient", answer, metadata={"consultation_id": context_id})
 
         try:
-            current_context.setdefault("patient_responses", []).append(answer) # 确保列表存在
-            last_question = current_context.get("questions_asked", [])[-1] if current_context.get("questions_asked") else "无先前问题"
-            analysis_result = self._analyze_patient_response(last_question, answer)
-
-            new_symptoms = analysis_result.get("new_symptoms", [])
-            if new_symptoms:
-                current_symptoms_set = set(current_context.get("current_symptoms", []))
-                current_symptoms_set.update(new_symptoms)
-                current_context["current_symptoms"] = list(current_symptoms_set) # 更新症状列表
-
-            current_context["confidence"] = min(1.0, current_context.get("confidence", 0.3) + analysis_result.get("confidence_delta", 0.0))
-            # 可以存储 symptom_details 和 related_info
-            current_context.setdefault("symptom_details", {}).update(analysis_result.get("symptom_details", {}))
-            current_context.setdefault("related_info", {}).update(analysis_result.get("related_info", {}))
+            current_context.patient_responses.append(answer)
+            last_question = current_context.questions_asked[-1] if current_context.questions_asked else "无先前问题"
+            current_symptoms = current_context.current_symptoms
+
+            next_question_future = None
+            # 已达到最大问题数时无论分析结果如何都会诊断，跳过回答分析，把原始回答直接交给诊断
+            skip_analysis = len(current_context.questions_asked) >= self.MAX_QUESTIONS
+            if skip_analysis:
+                logger.info("患者 %s 已达到最大问题数 %s，跳过回答分析直接诊断", patient_id, self.MAX_QUESTIONS)
+                can_diagnose = True
+            else:
+                self._update_history_summary(current_context)
+                # 分析回答的同时，基于当前上下文快照推测性地生成下一个问题（两次 LLM 调用并行）
+                # 若分析后可以诊断，则丢弃推测的问题
+                speculative_context = replace(current_context, current_symptoms=set(current_symptoms))
+                next_question_future = _LLM_POOL.submit(self._generate_next_question, speculative_context)
+                analysis_result = self._analyze_patient_response(last_question, answer)
 
+                current_symptoms.update(_canon(s) for s in analysis_result.get("new_symptoms", []) if isinstance(s, str) and s.strip())
+                current_context.confidence = min(1.0, current_context.confidence + analysis_result.get("confidence_delta", 0.0))
+                # 可以存储 symptom_details 和 related_info
+                current_context.symptom_details.update(analysis_result.get("symptom_details", {}))
+                current_context.related_info.update(analysis_result.get("related_info", {}))
 
-            logger.info(f"患者 {patient_id} 回答分析完成。当前症状: {current_context['current_symptoms']}. 置信度: {current_context['confidence']:.2f}")
+                logger.info("患者 %s 回答分析完成。当前症状: %s. 置信度: %.2f", patient_id, current_symptoms, current_context.confidence)
 
-            can_diagnose = self._can_make_diagnosis(current_context)
+                can_diagnose = self._can_make_diagnosis(current_context)
 
             if can_diagnose:
-                 logger.info(f"医生 {self.name} 可以为患者 {patient_id} (Context: {context_id}) 做出诊断。")
+                 logger.info("医生 %s 可以为患者 %s (Context: %s) 做出诊断。", self.name, patient_id, context_id)
+                 if next_question_future: next_question_future.cancel() # 尚未开始时直接取消；已在执行则忽略其结果
                  final_diagnosis = self._generate_diagnosis_with_llm(
-                     current_context["current_symptoms"],
-                     current_context["medical_history"],
-                     current_context["department"]
+                     sorted(current_context.current_symptoms), # 排序后提示词在不同进程间一致
+                     current_context.medical_history,
+                     current_context.department,
+                     latest_answer=answer if skip_analysis else None
                  )
-                 current_context["diagnosis"] = final_diagnosis
-                 current_context["stage"] = "diagnosis_complete" # 更新阶段
+                 current_context.diagnosis = final_diagnosis
+                 current_context.stage = "diagnosis_complete" # 更新阶段
 
                  response_content = {
                      "status": "diagnosis_complete",
@@ -195,19 +358,24 @@ class DoctorAgent(BaseAgent):
                          "follow_up": final_diagnosis.get("follow_up", "建议后续定期复查")
                      }
                  }
-                 self.memory_system.add_patient_memory(patient_id, "diagnosis", final_diagnosis,
-                                                       metadata={"agent_id": self.id, "consultation_id": context_id})
-                 self.memory_system.delete_consultation_context(context_id) # 诊断完成，删除上下文
+                 with self.memory_system.pipeline(background=True):
+                     self.memory_system.add_patient_memory(patient_id, "diagnosis", final_diagnosis,
+                                                           metadata={"agent_id": self.id, "consultation_id": context_id})
+                     self.memory_system.delete_consultation_context(context_id) # 诊断完成，删除上下文
+                     self._ctx_cache.pop(context_id)
                  return self.send_message(sender_id, response_content)
 
             else:
-                 logger.info(f"医生 {self.name} 需要向患者 {patient_id} (Context: {context_id}) 提出下一个问题。")
-                 next_question = self._generate_next_question(current_context)
-                 current_context.setdefault("questions_asked", []).append(next_question) # 确保列表存在
+                 logger.info("医生 %s 需要向患者 %s (Context: %s) 提出下一个问题。", self.name, patient_id, context_id)
+                 next_question = next_question_future.result()
+                 current_context.questions_asked.append(next_question)
 
-                 self.memory_system.update_consultation_context(context_id, current_context) # 更新上下文
-                 self.memory_system.add_conversation_entry(patient_id, self.role, next_question,
-                                                          metadata={"agent_id": self.id, "consultation_id": context_id})
+                 with self.memory_system.pipeline(background=True):
+                     # 只合并医生维护的字段，保留其他组件写入的字段（如交互日志）
+                     self.memory_system.update_consultation_context(context_id, current_context.to_update_dict()) # 更新上下文
+                     self._ctx_cache.set(context_id, current_context)
+                     self.memory_system.add_conversation_entry(patient_id, self.role, next_question,
+                                                              metadata={"agent_id": self.id, "consultation_id": context_id})
 
                  response_content = {
                      "status": "in_consultation",
@@ -219,8 +387,9 @@ class DoctorAgent(BaseAgent):
                  return self.send_message(sender_id, response_content)
 
         except Exception as e:
-             logger.error(f"处理患者 {patient_id} 回答 (Context: {context_id}) 时出错: {e}", exc_info=True)
+             logger.error("处理患者 %s 回答 (Context: %s) 时出错: %s", patient_id, context_id, e, exc_info=True)
              self.memory_system.delete_consultation_context(context_id) # 出错时也删除上下文
+             self._ctx_cache.pop(context_id)
              return self.send_message(sender_id, {"status": "error", "message": f"处理您的回答时发生内部错误。"})
 
 
@@ -238,7 +407,7 @@ class DoctorAgent(BaseAgent):
          if not patient_id or not diagnosis:
               return self.send_message(sender_id, {"status": "error", "message": "处方请求缺少 patient_id 或 diagnosis 信息"})
 
-         logger.info(f"医生 {self.name} 收到为患者 {patient_id} 基于提供诊断开具处方的请求 (Consultation: {consultation_id or 'N/A'})")
+         logger.info("医生 %s 收到为患者 %s 基于提供诊断开具处方的请求 (Consultation: %s)", self.name, patient_id, consultation_id or 'N/A')
 
          suggested_medications = diagnosis.get("medications", [])
          instructions = diagnosis.get("recommendations", ["遵医嘱"])
@@ -267,30 +436,64 @@ class DoctorAgent(BaseAgent):
 
 
     # --- LLM 调用和判断逻辑 (保持不变，因为它们接收 context) ---
-    def _generate_next_question(self, context: Dict[str, Any]) -> str:
+    def _cached_llm(self, prompt: str, system_message: str, temperature: float, max_tokens: int, ttl: float, response_format: Optional[str] = None) -> str:
+        """按提示词哈希缓存 LLM 响应（缓存旁路模式），调用失败的响应不写入缓存"""
+        key = make_prompt_key(prompt, system_message, temperature, max_tokens) + (f":{response_format}" if response_format else "")
+        cached = self._llm_cache.get(key)
+        if cached is not None:
+            logger.debug("医生 %s 命中 LLM 响应缓存: %s", self.name, key)
+            return cached
+        response = self.llm_service.generate_response(prompt=prompt, system_message=system_message, temperature=temperature, max_tokens=max_tokens, response_format=response_format)
+        if response and not response.startswith(LLM_ERROR_PREFIX):
+            self._llm_cache.set(key, response, ttl=ttl)
+        return response
+
+    def _recent_qa_pairs(self, context: ConsultationContext) -> List[Dict[str, str]]:
+        """返回最近 RECENT_QA_WINDOW 轮问答（最后一个问题可能尚未回答）"""
+        questions = context.questions_asked
+        responses = context.patient_responses
+        start = max(0, len(questions) - RECENT_QA_WINDOW)
+        return [{"问": q, "答": responses[i] if i < len(responses) else ""} for i, q in enumerate(questions[start:], start)]
+
+    def _update_history_summary(self, context: ConsultationContext) -> None:
+        """将滑出最近问答窗口的已回答问答对折叠进 history_summary（截断拼接，不额外调用 LLM）"""
+        questions = context.questions_asked
+        responses = context.patient_responses
+        summarized = context.summarized_turns
+        fold_until = min(len(questions), len(responses)) - RECENT_QA_WINDOW
+        if fold_until <= summarized:
+            return
+        parts = [context.history_summary] if context.history_summary else []
+        parts.extend(f"问: {q[:40]} 答: {a[:60]}" for q, a in zip(questions[summarized:fold_until], responses[summarized:fold_until]))
+        summary = "；".join(parts)
+        if len(summary) > HISTORY_SUMMARY_MAX_CHARS:
+            summary = "…" + summary[-HISTORY_SUMMARY_MAX_CHARS:]
+        context.history_summary = summary
+        context.summarized_turns = fold_until
+
+    def _generate_next_question(self, context: ConsultationContext) -> str:
         # ... (代码不变)
-        prompt = f"""作为一位专业医生，根据以下问诊上下文信息生成下一个有针对性的问题:
-患者ID: {context.get('patient_id', 'N/A')}
-初始症状: {', '.join(context.get('initial_symptoms', []))}
-当前已知症状: {', '.join(context.get('current_symptoms', []))}
-病史: {', '.join(context.get('medical_history', []))}
-科室: {context.get('department', '未知')}
-已问过的问题: {json.dumps(context.get('questions_asked', []), ensure_ascii=False)}
-患者的回答: {json.dumps(context.get('patient_responses', []), ensure_ascii=False)}
-当前诊断置信度: {context.get('confidence', 0.3):.2f}
-是否复诊: {context.get('is_return_visit', False)}
-{f"上次诊断: {json.dumps(context.get('previous_diagnosis'), ensure_ascii=False)}" if context.get('is_return_visit') and context.get('previous_diagnosis') else ""}
-{f"接待员备注: {context.get('reception_notes', '')}" if context.get('reception_notes') else ""}
-
-请生成一个专业、有针对性的问题，帮助进一步了解患者情况以提高诊断准确性。问题应该避免重复，并根据已知信息深入挖掘。
-
-只返回问题文本本身，不要包含其他内容。
-"""
+        lines = [
+            _NEXT_Q_HEAD,
+            f"患者ID: {context.patient_id or 'N/A'}",
+            f"初始症状: {', '.join(context.initial_symptoms)}",
+            f"当前已知症状: {', '.join(sorted(context.current_symptoms))}", # 集合迭代顺序随哈希种子变化，排序后提示词（及其缓存键）才稳定
+            f"病史: {', '.join(context.medical_history)}",
+            f"科室: {context.department or '未知'}",
+        ]
+        if context.history_summary: lines.append(f"早先问诊摘要: {context.history_summary}")
+        lines.append(f"最近问答: {json_dumps(self._recent_qa_pairs(context))}")
+        lines.append(f"当前诊断置信度: {context.confidence:.2f}")
+        lines.append(f"是否复诊: {context.is_return_visit}")
+        if context.is_return_visit and context.previous_diagnosis: lines.append(f"上次诊断: {json_dumps(context.previous_diagnosis)}")
+        if context.reception_notes: lines.append(f"接待员备注: {context.reception_notes}")
+        lines.append(_NEXT_Q_TAIL)
+        prompt = "\n".join(lines)
         try:
-            response = self.llm_service.generate_response(prompt=prompt, system_message="你是一位专业医生，正在进行交互式问诊。请提出精准、简洁的下一个问题。", temperature=0.6)
+            response = self._cached_llm(prompt, _NEXT_Q_SYSTEM, temperature=0.6, max_tokens=NEXT_QUESTION_MAX_TOKENS, ttl=NEXT_QUESTION_CACHE_TTL)
             return response
         except Exception as e:
-            logger.error(f"生成下一个问诊问题时出错 (Patient: {context.get('patient_id')}): {str(e)}")
+            logger.error(f"生成下一个问诊问题时出错 (Patient: {context.patient_id}): {str(e)}")
             return "能再详细描述一下您最不舒服的感觉吗？或者还有其他症状吗？" # Fallback
 
     def _analyze_patient_response(self, question: str, answer: str) -> Dict[str, Any]:
@@ -310,12 +513,8 @@ class DoctorAgent(BaseAgent):
 如果无法提取某项信息，请使用空列表[]或空字典{{}}。确保JSON格式正确。
 """
         try:
-            response = self.llm_service.generate_response(prompt=prompt, system_message="你是一个医疗信息提取和分析助手。请仔细分析医患对话并按要求输出JSON。", temperature=0.1, max_tokens=300)
-            json_part = response.strip()
-            if json_part.startswith("```json"): json_part = json_part[7:]
-            if json_part.endswith("```"): json_part = json_part[:-3]
-            json_part = json_part.strip()
-            analysis = json.loads(json_part)
+            response = self._cached_llm(prompt, "你是一个医疗信息提取和分析助手。请仔细分析医患对话并按要求输出JSON。", temperature=0.1, max_tokens=300, ttl=ANALYSIS_CACHE_TTL, response_format="json")
+            analysis = json_loads(response) # JSON 模式下响应即为 JSON 对象，无需去除代码块标记
             analysis["new_symptoms"] = analysis.get("new_symptoms", [])
             analysis["symptom_details"] = analysis.get("symptom_details", {})
             analysis["negated_symptoms"] = analysis.get("negated_symptoms", [])
@@ -327,63 +526,52 @@ class DoctorAgent(BaseAgent):
             return {"new_symptoms": [], "symptom_details": {}, "negated_symptoms": [], "related_info": {}, "confidence_delta": 0.0}
 
 
-    def _can_make_diagnosis(self, context: Dict[str, Any]) -> bool:
+    def _can_make_diagnosis(self, context: ConsultationContext) -> bool:
         # ... (代码不变)
-        confidence = context.get("confidence", 0.3); questions_asked_count = len(context.get("questions_asked", []))
-        min_confidence = 0.75; max_questions = 5; min_questions_force_diag = 4
-        if confidence >= min_confidence: logger.info(f"可以诊断：置信度 {confidence:.2f} >= {min_confidence}"); return True
-        if questions_asked_count >= max_questions: logger.info(f"可以诊断：已达到最大问题数 {max_questions}"); return True
-        if questions_asked_count >= min_questions_force_diag and confidence > 0.4: logger.info(f"可以诊断：问题数 {questions_asked_count} >= {min_questions_force_diag} 且置信度 {confidence:.2f} > 0.4"); return True
-        logger.debug(f"不能诊断：置信度 {confidence:.2f}, 问题数 {questions_asked_count}"); return False
-
-
-    def _generate_diagnosis_with_llm(self, symptoms: List[str], medical_history: List[str], department: str) -> Dict[str, Any]:
-        """使用LLM生成诊断结果"""
-        prompt = f"""作为专业医生，请根据以下信息生成诊断结果：
-症状：{', '.join(symptoms) if symptoms else '未提供'}
-病史：{', '.join(medical_history) if medical_history else '无'}
-科室：{department}
-
-请以JSON格式返回诊断结果，包含以下字段:
-- "condition": 诊断结果
-- "explanation": 诊断解释
-- "severity": 严重程度
-- "recommendations": 建议措施列表
-- "medications": 药物列表，每项包含name, dosage, purpose
-- "follow_up": 随访建议
-- "differential_diagnosis": 鉴别诊断列表（可选）
-- "diagnostic_tests": 建议检查列表（可选）
-
-请确保JSON格式简洁且完整，避免过长的描述导致内容被截断。每个字段的值保持在50字以内，列表项不超过5个。
-"""
+        confidence = context.confidence; questions_asked_count = len(context.questions_asked)
+        if confidence >= self.MIN_CONFIDENCE: logger.info("可以诊断：置信度 %.2f >= %s", confidence, self.MIN_CONFIDENCE); return True
+        if questions_asked_count >= self.MAX_QUESTIONS: logger.info("可以诊断：已达到最大问题数 %s", self.MAX_QUESTIONS); return True
+        if questions_asked_count >= self.MIN_QUESTIONS_FORCE_DIAG and confidence > self.FORCE_DIAG_MIN_CONFIDENCE: logger.info("可以诊断：问题数 %s >= %s 且置信度 %.2f > %s", questions_asked_count, self.MIN_QUESTIONS_FORCE_DIAG, confidence, self.FORCE_DIAG_MIN_CONFIDENCE); return True
+        logger.debug("不能诊断：置信度 %.2f, 问题数 %s", confidence, questions_asked_count); return False
+
+
+    def _generate_diagnosis_with_llm(self, symptoms: List[str], medical_history: List[str], department: str, latest_answer: Optional[str] = None) -> Dict[str, Any]:
+        """使用LLM生成诊断结果（latest_answer 为未经分析的患者最后一次回答）"""
+        symptoms_text = ', '.join(symptoms)
+        lines = [
+            _DIAG_HEAD,
+            f"症状：{symptoms_text or '未提供'}",
+            f"病史：{', '.join(medical_history) if medical_history else '无'}",
+            f"科室：{department}",
+        ]
+        if latest_answer: lines.append(f"患者最后的补充：{latest_answer}")
+        lines.append(_DIAG_TAIL)
+        prompt = "\n".join(lines)
         try:
-            # 增加max_tokens以确保完整接收回复
-            response = self.llm_service.generate_response(
+            # 增加max_tokens以确保完整接收回复；流式读取，JSON 对象闭合后即停止
+            response = _read_json_object_from_stream(self.llm_service.generate_response_stream(
                 prompt=prompt, 
-                system_message="你是一位资深医生，正在进行诊断。请给出专业、简洁且结构化的诊断结果（JSON格式）。", 
+                system_message=_DIAG_SYSTEM, 
                 temperature=0.3, 
-                max_tokens=1000
-            )
-            
-            # 提取JSON部分
-            json_part = response.strip()
-            if json_part.startswith("```json"): 
-                json_part = json_part[7:]
-            if json_part.endswith("```"): 
-                json_part = json_part[:-3]
-            json_part = json_part.strip()
+                max_tokens=1000,
+                response_format="json"
+            ))
+            # JSON 模式保证不含代码块标记，但达到 max_tokens 时内容仍可能被截断
+            json_part = response
             
-            # 尝试解析JSON
+            # 尝试解析JSON（可自动修复被截断的内容）
             try:
-                diagnosis = json.loads(json_part)
-            except json.JSONDecodeError as json_err:
+                diagnosis = json_loads_tolerant(json_part)
+                if not isinstance(diagnosis, dict):
+                    raise ValueError(f"诊断结果不是JSON对象: {type(diagnosis).__name__}")
+            except ValueError as json_err:
                 # 处理JSON解析错误
-                logger.error(f"JSON解析失败: {json_err}. 尝试修复...")
+                logger.error(f"JSON解析及自动修复均失败: {json_err}")
                 
-                # 尝试修复可能的不完整JSON
-                if "diagnostic_tests" in json_part and json_err.msg.startswith("Unterminated string"):
-                    # 如果是字符串截断的错误，尝试创建一个简化版本
-                    logger.warning(f"检测到JSON截断，创建简化版本")
+                # 修复失败时，从部分文本中提取关键字段
+                if '"condition"' in json_part:
+                    # 尝试创建一个简化版本
+                    logger.warning(f"JSON无法修复，提取字段创建简化版本")
                     simple_diagnosis = {
                         "condition": self._extract_field(json_part, "condition") or "可能的消化系统疾病",
                         "explanation": self._extract_field(json_part, "explanation") or "根据症状判断",
@@ -415,7 +603,7 @@ class DoctorAgent(BaseAgent):
                 if not isinstance(diagnosis.get(list_field), list):
                     diagnosis[list_field] = [str(diagnosis.get(list_field))] if diagnosis.get(list_field) else []
             
-            logger.info(f"为症状 '{', '.join(symptoms)}' 生成诊断结果：{diagnosis.get('condition')}")
+            logger.info(f"为症状 '{symptoms_text}' 生成诊断结果：{diagnosis.get('condition')}")
             return diagnosis
             
         except (json.JSONDecodeError, Exception) as e:
@@ -434,9 +622,10 @@ class DoctorAgent(BaseAgent):
     def _extract_field(self, json_text: str, field_name: str) -> str:
         """从部分JSON文本中提取单个字段的值"""
         try:
-            import re
-            pattern = f'"{field_name}"\\s*:\\s*"([^"]*)"'
-            match = re.search(pattern, json_text)
+            pattern = _FIELD_RE_CACHE.get(field_name)
+            if pattern is None:
+                pattern = _FIELD_RE_CACHE[field_name] = re.compile(rf'"{re.escape(field_name)}"\s*:\s*"([^"]*)"')
+            match = pattern.search(json_text)
             if match:
                 return match.group(1)
             return None
@@ -447,10 +636,11 @@ class DoctorAgent(BaseAgent):
     def _extract_list(self, json_text: str, field_name: str) -> List[str]:
         """从部分JSON文本中提取列表字段的值"""
         try:
-            import re
             # 尝试匹配字段名后面的数组部分
-            pattern = f'"{field_name}"\\s*:\\s*\\[(.*?)\\]'
-            match = re.search(pattern, json_text, re.DOTALL)
+            pattern = _LIST_RE_CACHE.get(field_name)
+            if pattern is None:
+                pattern = _LIST_RE_CACHE[field_name] = re.compile(rf'"{re.escape(field_name)}"\s*:\s*\[(.*?)\]', re.DOTALL)
+            match = pattern.search(json_text)
             if not match:
                 return None
                 
@@ -460,7 +650,7 @@ class DoctorAgent(BaseAgent):
                 
             # 提取数组中的所有字符串项
             items = []
-            for item_match in re.finditer('"([^"]*)"', items_text):
+            for item_match in _QUOTED_ITEM_RE.finditer(items_text):
                 items.append(item_match.group(1))
             return items
         except Exception as e:
@@ -7,11 +7,20 @@
 
 import logging
 import json
+import hashlib
+import itertools
+import os
 import re  # 用于从错误消息中提取信息
-from typing import Dict, List, Any, Optional
+import threading
+import time
+import unicodedata
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterator, List, Any, Optional, Tuple
 
 # 导入 BaseAgent
 from .base_agent import BaseAgent
+from utils.cache import TTLCache
+from utils.json_utils import dumps_bytes as json_dumps_bytes, loads as json_loads
 
 # 导入依赖项，添加类型提示和错误处理
 try:
@@ -22,9 +31,116 @@ except ImportError as e:
     LLMService = None
     MemorySystem = None
 
+try:
+    from pydantic import BaseModel, ConfigDict, ValidationError
+except ImportError:
+    BaseModel = None # 未安装 pydantic 时按 _VALIDATION_SCHEMA 逐字段校验
+
 logger = logging.getLogger("Hospital-MultiAgent-System")
 
+# 用于并行发起 LLM 请求的线程池（如逐个药物查询信息，均为阻塞的网络 I/O）
+_LLM_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="pharmacist-llm")
+
 # --- Constants ---
+# 从 LLM 响应中提取最外层 JSON 对象 / 列表（去除代码块标记和前后说明文字）
+_JSON_OBJECT_RE = re.compile(r'\{.*\}', re.DOTALL)
+_JSON_ARRAY_RE = re.compile(r'\[.*\]', re.DOTALL)
+
+
+def _extract_json_part(response: str, pattern: "re.Pattern[str]", brackets: str) -> Optional[str]:
+    """
+    从 LLM 响应中取出 JSON 部分：响应本身就是裸 JSON（以 brackets 指定的括号首尾包裹）时直接返回，
+    否则用 pattern 提取最外层结构；都不满足时返回 None
+    """
+    text = response.strip()
+    if text[:1] == brackets[0] and text[-1:] == brackets[1]:
+        return text
+    match = pattern.search(text)
+    return match.group(0) if match else None
+
+# 患者处方问答缓存：仅当同一患者、同一处方下规范化后的问题完全相同时复用答案。
+# 不做近似匹配，规范化时也不去除标点和数字：“过敏/不过敏”“七十五岁/七岁”“0.5片/05片”“1/2片/12片”
+# 这类一两个字符的差异足以改变用药结论
+_QUERY_SPACE_RE = re.compile(r'\s+')
+QA_CACHE_SIZE = 4096
+
+
+def _normalize_query(query: str) -> str:
+    """规范化问题用于精确匹配：NFKC 归一化、合并连续空白并去除首尾空白、转小写（保留标点与数字）"""
+    return _QUERY_SPACE_RE.sub(" ", unicodedata.normalize("NFKC", query)).strip().lower()
+
+
+# 流式回答时合并 token 的时间窗口（秒），避免逐 token 推送
+STREAM_BATCH_INTERVAL = 0.05
+
+# 常见药物相互作用本地知识库：命中的药物对无需调用 LLM，未收录的药物对仍交给 LLM 判断
+INTERACTION_KB_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "common_interactions.json")
+
+
+def _kb_drug_key(name: str) -> str:
+    return unicodedata.normalize("NFKC", name).strip().lower()
+
+
+def _load_interaction_kb(path: str) -> Dict[Tuple[str, str], Dict[str, str]]:
+    """加载相互作用知识库: (规范化药名A, 规范化药名B)（按字母序）-> 相互作用条目"""
+    try:
+        with open(path, "rb") as f:
+            entries = json_loads(f.read())
+    except FileNotFoundError:
+        logger.warning(f"未找到药物相互作用知识库 {path}，相互作用检查将全部交给 LLM。")
+        return {}
+    except Exception as e:
+        logger.error(f"加载药物相互作用知识库 {path} 失败: {e}")
+        return {}
+    return {tuple(sorted((_kb_drug_key(e["drug_a"]), _kb_drug_key(e["drug_b"])))): e for e in entries}
+
+
+_INTERACTION_KB = _load_interaction_kb(INTERACTION_KB_PATH)
+
+
+def _interaction_pair_key(item: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+    """相互作用条目中药物对的规范化键（与知识库键一致），drug_pair 不是两个药名时返回 None"""
+    pair = item.get("drug_pair")
+    if isinstance(pair, (list, tuple)) and len(pair) == 2 and all(isinstance(d, str) for d in pair):
+        return tuple(sorted((_kb_drug_key(pair[0]), _kb_drug_key(pair[1]))))
+    return None
+
+
+# 处方审核结果中需要校验类型的字段: 字段名 -> (期望类型, 默认值工厂)；"valid" 单独按 bool 转换
+_VALIDATION_SCHEMA = {
+    "issues": (list, list),
+    "warnings": (list, list),
+    "recommendations": (list, list),
+    "notes": (str, str),
+}
+
+# 相互作用检查的输出 token 预算：按待查药物对数线性分配，并限制在上下界之间
+INTERACTION_TOKENS_PER_PAIR = 80
+INTERACTION_MIN_TOKENS = 256
+INTERACTION_MAX_TOKENS_CAP = 4096
+
+# 合并审核（审核 + 药物信息 + 相互作用）的输出 token 预算：基础部分加按药物数线性增加的部分，并设上限
+FUSED_REVIEW_BASE_TOKENS = 800
+FUSED_REVIEW_TOKENS_PER_DRUG = 400
+FUSED_REVIEW_MAX_TOKENS_CAP = 4096
+
+if BaseModel is not None:
+    class ValidationResult(BaseModel):
+        """处方审核结果（pydantic 一次完成类型校验和宽松转换，保留 LLM 返回的额外字段）"""
+        model_config = ConfigDict(extra="allow")
+
+        valid: bool = False
+        issues: List[str] = []
+        warnings: List[str] = []
+        recommendations: List[str] = []
+        notes: str = ""
+
+# 单张处方的药物条目上限，超出视为格式异常，无需交给 LLM 审核
+MAX_MEDICATIONS_PER_PRESCRIPTION = 20
+
+# 处方审核提示词中诊断说明的最大字符数
+DIAGNOSIS_EXPLANATION_MAX_CHARS = 150
+
 VALID_DEPARTMENTS = [  # 这个列表可能药剂师也需要参考，或者从配置导入
     "内科", "外科", "儿科", "妇产科", "皮肤科", "眼科",
     "耳鼻喉科", "神经科", "心血管科", "消化内科", "呼吸内科",
@@ -32,19 +148,116 @@ VALID_DEPARTMENTS = [  # 这个列表可能药剂师也需要参考，或者从
 ]
 
 
+# --- 提示词模板（模块加载时构建一次，调用时只填充动态字段；字面量花括号写作 {{ }}） ---
+
+# 处方审核
+_VALIDATION_PROMPT_TEMPLATE = """作为一位资深临床药剂师，请基于患者的部分诊断信息和以下处方，严格审核其合理性、安全性及潜在风险。
+
+{diagnosis_context}
+
+处方信息:
+{medication_text}
+
+医嘱/用法说明: {instructions}
+其他说明/随访建议: {notes}
+{patient_line}
+
+请重点评估以下方面，并结合诊断信息判断（例如，药物是否符合适应症）:
+1. 剂量与用法: 每个药物的剂量、频率、疗程是否清晰、常规且安全？
+2. 适应症符合性: 药物组合是否与提供的诊断信息或常见用途相符？
+3. 药物相互作用: 处方内的药物之间是否存在显著相互作用？
+4. 禁忌症/注意事项: 是否存在明显的禁忌或重要提醒？
+5. 说明清晰度: 医嘱是否清晰完整？
+
+请【务必只返回】一个JSON对象，严格遵循以下格式，【不要包含任何】 markdown 标记 (如 ```json) 或其他解释文字:
+{{
+  "valid": true,
+  "issues": [],
+  "warnings": [],
+  "recommendations": [],
+  "notes": "处方合理，未发现明显问题。"
+}}
+如果发现问题，请修改相应字段，例如：
+{{
+  "valid": false,
+  "issues": ["药物X剂量可能偏高，建议复核", "疗程未指定"],
+  "warnings": ["药物X与药物Z联用可能增加出血风险"],
+  "recommendations": ["请确认药物X的准确剂量", "请补充疗程"],
+  "notes": "处方存在剂量和相互作用风险，需修改。"
+}}
+"""
+
+# 处方审核 + 药物信息 + 相互作用合并查询
+_FUSED_REVIEW_PROMPT_TEMPLATE = """作为一位资深临床药剂师，请基于患者的部分诊断信息和以下处方，一次性完成三项工作：审核处方、提供每种药物的信息、检查药物之间的相互作用。
+
+{diagnosis_context}
+
+处方信息:
+{medication_text}
+
+医嘱/用法说明: {instructions}
+其他说明/随访建议: {notes}
+
+要求:
+1. validation: 评估剂量与用法、适应症符合性、药物相互作用、禁忌症/注意事项、说明清晰度；发现问题时 valid 为 false。
+2. drug_info: 为以下每种药物各提供一条信息，键必须与药物名称完全一致: [{drug_list_str}]。
+3. interactions: 列出处方内药物两两之间已知的、临床显著的相互作用，无相互作用时为 []。
+
+请【务必只返回】一个JSON对象，严格遵循以下格式，【不要包含任何】 markdown 标记或其他解释文字:
+{{
+  "validation": {{"valid": true, "issues": [], "warnings": [], "recommendations": [], "notes": "处方合理，未发现明显问题。"}},
+  "drug_info": {{"药物名称": {{"drug_name": "药物名称", "description": "", "common_uses": "", "common_dosage": "", "common_side_effects": "", "serious_side_effects": "", "contraindications": "", "warnings_precautions": "", "storage": ""}}}},
+  "interactions": [{{"drug_pair": ["药物A", "药物B"], "severity": "", "description": "", "recommendation": ""}}]
+}}
+"""
+
+# 药物信息查询
+_DRUG_INFO_PROMPT_TEMPLATE = """请提供关于药物 "{drug_name}" 的详细信息。严格按JSON格式返回(字段: "drug_name", "description", "common_uses", "common_dosage", "common_side_effects", "serious_side_effects", "contraindications", "warnings_precautions", "storage")。找不到返回{{"drug_name":"{drug_name}", "error":"信息未找到"}}。"""
+
+# 药物相互作用检查（全部两两组合）
+_INTERACTION_PROMPT_TEMPLATE = """请检查以下药物之间所有可能的两两组合是否存在已知的、临床显著的相互作用: 药物列表: [{drug_list_str}]。严格按JSON列表格式返回(字段: "drug_pair", "severity", "description", "recommendation")。无相互作用返回[]。"""
+
+# 药物相互作用检查（指定药物组合）
+_INTERACTION_PAIRS_PROMPT_TEMPLATE = """请检查以下每组药物之间是否存在已知的、临床显著的相互作用: 药物组合: [{pair_list_str}]。严格按JSON列表格式返回(字段: "drug_pair", "severity", "description", "recommendation")。无相互作用返回[]。"""
+
+# 患者处方提问
+_PATIENT_QUERY_PROMPT_TEMPLATE = """作为一名专业的药剂师，请根据以下处方信息，回答患者的提问。请确保回答专业、准确、易懂，并且【不要提供新的医疗建议或诊断】。
+当前处方:\n{med_list}\n用法说明: {instructions}\n注意事项/随访: {notes}
+患者的问题: "{query}"
+请针对患者的问题进行回答。如果问题超出药剂师职责范围（例如询问诊断细节），请建议患者咨询医生。回复请简洁明了。"""
+
+
 class PharmacistAgent(BaseAgent):
     """药剂师智能体"""
-    
+
+    __slots__ = ("llm_service", "_drug_info_cache", "_qa_cache", "_qa_cache_lock", "_interaction_cache", "_med_list_cache", "_validation_cache", "_qa_inflight")
+
     def __init__(self, name: str = "药剂师", role: str = "pharmacist", memory_system=None, llm_service=None):
         super().__init__(name=name, role=role, memory_system=memory_system)
         self.llm_service = llm_service
+        # 药物信息基本不变，按规范化药名缓存 LLM 查询结果（查询失败的结果不缓存）
+        self._drug_info_cache = TTLCache(maxsize=2048, ttl=600)
+        # (患者ID, 处方签名, 规范化问题) -> 答案，按 LRU 淘汰
+        self._qa_cache = TTLCache(maxsize=QA_CACHE_SIZE, ttl=3600)
+        self._qa_cache_lock = threading.Lock()
+        # 正在生成回答的 (患者ID, 处方签名, 规范化问题) -> Future，由 _qa_cache_lock 保护
+        self._qa_inflight: Dict[Tuple[str, str, str], Future] = {}
+        # 处方签名 -> 格式化后的药物清单，同一处方的多次提问复用
+        self._med_list_cache = TTLCache(maxsize=256, ttl=3600)
+        # 排序去重后的药物元组 -> 相互作用列表（temperature=0.0，结果可视为确定）
+        self._interaction_cache = TTLCache(maxsize=512, ttl=3600)
+        # 规范化（处方 + 诊断）摘要 -> 审核结果，仅缓存成功解析的结果
+        self._validation_cache = TTLCache(maxsize=512, ttl=1800)
         if not self.llm_service:
             logger.warning(f"药剂师 {name}: LLM 服务未提供。")
-        logger.info(f"药剂师智能体 {name} 初始化完成")
+        logger.info("药剂师智能体 %s 初始化完成", name)
 
     def process_message(self, message: str, session: dict) -> dict:
         """
         处理来自网页界面的对话消息
+
+        注意：当前代码中没有调用方（编排器经 receive_message 走 _handle_review_request /
+        _handle_patient_prescription_query），此处的合并审核与并发查询仅在接入网页对话入口后生效。
         
         Args:
             message: 患者发送的消息文本
@@ -62,20 +275,18 @@ class PharmacistAgent(BaseAgent):
                 
             prescription = session["prescription"]
             
-            # 处方审核
-            validation_result = self._validate_prescription_with_llm(prescription)
-            
             # 分析用户的问题并提供相应的答复
             if "药" in message or "处方" in message or "用药" in message:
+                # 一次 LLM 调用同时获得审核结果、药物信息和相互作用
+                annotated = self._validate_and_annotate_prescription(prescription)
+                validation_result = annotated["validation"]
                 if validation_result["valid"]:
-                    # 获取每种药物的详细信息
-                    drug_info_list = []
-                    for med in prescription.get("medications", []):
-                        drug_info = self._get_drug_info_with_llm(med["name"])
-                        if drug_info:
-                            drug_info_list.append(f"【{med['name']}】\n用法：{med['dosage']}，{med['frequency']}\n说明：{drug_info.get('description', '无')}\n注意事项：{drug_info.get('side_effects', '无')}")
-                    
-                    drug_instructions = "\n\n".join(drug_info_list)
+                    medications = prescription.get("medications", [])
+                    drug_infos = annotated["drug_info"]
+                    drug_instructions = "\n\n".join(
+                        self._format_medication_block(med, drug_infos[med["name"]])
+                        for med in medications if drug_infos[med["name"]]
+                    )
                     
                     return {
                         "message": f"处方已通过审核，以下是详细的用药说明：\n\n{drug_instructions}\n\n" + \
@@ -164,7 +375,7 @@ class PharmacistAgent(BaseAgent):
                 }
             })
             
-        logger.info(f"药剂师 {self.name} 正在审核患者 {patient_id} 的处方...")
+        logger.info("药剂师 %s 正在审核患者 %s 的处方...", self.name, patient_id)
         # --- 修改：传递诊断信息给审核函数 ---
         validation_result = self._validate_prescription_with_llm(prescription, patient_id, diagnosis_info)
         # ----------------------------------
@@ -177,15 +388,16 @@ class PharmacistAgent(BaseAgent):
                 "validation_result": validation_result,
                 "is_approved": is_approved
             }
-            self.memory_system.add_patient_memory(
-                patient_id,
-                "prescription_review",
-                memory_data,
-                metadata={"agent_id": self.id}
-            )
+            with self.memory_system.pipeline(background=True): # 落盘在后台完成，与构建回复并行
+                self.memory_system.add_patient_memory(
+                    patient_id,
+                    "prescription_review",
+                    memory_data,
+                    metadata={"agent_id": self.id}
+                )
             
         if is_approved:
-            logger.info(f"患者 {patient_id} 的处方已通过审核")
+            logger.info("患者 %s 的处方已通过审核", patient_id)
             if validation_result.get("recommendations"):
                 recs = "; ".join(validation_result["recommendations"])
                 note_key = "pharmacist_notes"
@@ -223,7 +435,7 @@ class PharmacistAgent(BaseAgent):
         if not drug_name:
             return self.send_message(sender_id, {"status": "error", "message": "药物信息请求缺少 drug_name"})
             
-        logger.info(f"药剂师 {self.name} 收到查询药物 '{drug_name}' 信息的请求")
+        logger.info("药剂师 %s 收到查询药物 '%s' 信息的请求", self.name, drug_name)
         drug_info = self._get_drug_info_with_llm(drug_name)
         
         if drug_info and not drug_info.get("error"):
@@ -260,7 +472,7 @@ class PharmacistAgent(BaseAgent):
         if len(drugs_to_check) < 2:
             return self.send_message(sender_id, {"status": "not_applicable", "message": "需要至少两种药物才能检查相互作用。"})
             
-        logger.info(f"药剂师 {self.name} 正在检查药物相互作用: {', '.join(drugs_to_check)}")
+        logger.info("药剂师 %s 正在检查药物相互作用: %s", self.name, ', '.join(drugs_to_check))
         interactions = self._check_drug_interactions_with_llm(drugs_to_check)
         
         if interactions:
@@ -287,7 +499,7 @@ class PharmacistAgent(BaseAgent):
                 "message": interaction_msg
             }
         else:
-            logger.info(f"未发现药物 {', '.join(drugs_to_check)} 之间的显著相互作用。")
+            logger.info("未发现药物 %s 之间的显著相互作用。", ', '.join(drugs_to_check))
             response_content = {
                 "status": "no_interactions_found",
                 "drugs_checked": drugs_to_check,
@@ -307,35 +519,10 @@ class PharmacistAgent(BaseAgent):
         if not patient_id or not query or not prescription:
             return self.send_message(sender_id, {"status": "error", "message": "处理患者处方提问失败：缺少必要信息。"})
             
-        logger.info(f"药剂师 {self.name} 收到患者 {patient_id} 关于处方的提问: '{query[:50]}...'")
-        
-        med_list = "\n".join([f"- {m.get('name')} ({m.get('dosage')}, {m.get('frequency')})" for m in prescription.get("medications", [])])
-        instructions = prescription.get("instructions", "遵医嘱")
-        notes = prescription.get("notes", "无特殊说明")
-        
-        prompt = f"""作为一名专业的药剂师，请根据以下处方信息，回答患者的提问。请确保回答专业、准确、易懂，并且【不要提供新的医疗建议或诊断】。
-当前处方:\n{med_list}\n用法说明: {instructions}\n注意事项/随访: {notes}
-患者的问题: "{query}"
-请针对患者的问题进行回答。如果问题超出药剂师职责范围（例如询问诊断细节），请建议患者咨询医生。回复请简洁明了。"""
-        
+        logger.info("药剂师 %s 收到患者 %s 关于处方的提问: '%s...'", self.name, patient_id, query[:50])
+
         try:
-            answer = self.llm_service.generate_response(
-                prompt=prompt,
-                system_message="你是一位耐心、专业的药剂师，正在解答患者关于处方用药的疑问。",
-                temperature=0.3,
-                max_tokens=250
-            )
-            
-            logger.info(f"药剂师为患者 {patient_id} 生成的回答: {answer[:100]}...")
-            
-            if self.memory_system:
-                self.memory_system.add_conversation_entry(
-                    patient_id,
-                    self.role,
-                    answer,
-                    metadata={"consultation_id": context_id, "agent_id": self.id}
-                )
-                
+            answer = "".join(self.stream_prescription_answer(patient_id, query, prescription, context_id))
             response_content = {
                 "status": "info_provided",
                 "message": answer,
@@ -358,19 +545,129 @@ class PharmacistAgent(BaseAgent):
                 
             return self.send_message(sender_id, {"status": "error", "message": error_message})
 
+    def stream_prescription_answer(self, patient_id: str, query: str, prescription: Dict[str, Any], context_id: Optional[str] = None) -> Iterator[str]:
+        """
+        流式回答患者关于处方的提问，按 STREAM_BATCH_INTERVAL 合并 token 后逐批产出文本
+
+        支持流式推送的接口可直接迭代本方法以尽早展示回答；完整回答在迭代结束后写入问答缓存和对话记录。
+
+        Args:
+            patient_id: 患者ID
+            query: 患者的问题
+            prescription: 当前处方
+            context_id: 会诊上下文ID
+
+        Yields:
+            回答文本片段
+        """
+        prescription_sig = hashlib.sha256(json_dumps_bytes(prescription, sort_keys=True)).hexdigest()
+        qa_key = (patient_id, prescription_sig, _normalize_query(query))
+        answer = self._qa_cache.get(qa_key)
+        if answer is not None:
+            logger.debug("处方问答缓存命中 (Patient: %s): '%s'", patient_id, query[:50])
+            yield answer
+        else:
+            # 同一患者就同一处方的相同问题并发到达时只调用一次 LLM，其余请求等待首个请求的结果
+            with self._qa_cache_lock:
+                inflight = self._qa_inflight.get(qa_key)
+                is_leader = inflight is None
+                if is_leader:
+                    inflight = self._qa_inflight[qa_key] = Future()
+            if not is_leader:
+                logger.debug("相同的处方提问正在生成回答，等待其结果 (Patient: %s): '%s'", patient_id, query[:50])
+                answer = inflight.result()
+                yield answer
+            else:
+                try:
+                    parts: List[str] = []
+                    for chunk in self._stream_prescription_answer_from_llm(prescription_sig, prescription, query):
+                        parts.append(chunk)
+                        yield chunk
+                    answer = "".join(parts)
+                    logger.info("药剂师为患者 %s 生成的回答: %s...", patient_id, answer[:100])
+                    if answer:
+                        self._qa_cache.set(qa_key, answer)
+                    inflight.set_result(answer)
+                except BaseException as e:
+                    # 包括调用方中途停止迭代（GeneratorExit），避免等待中的请求永久阻塞
+                    inflight.set_exception(e if isinstance(e, Exception) else RuntimeError("处方提问回答生成被中断"))
+                    raise
+                finally:
+                    with self._qa_cache_lock:
+                        self._qa_inflight.pop(qa_key, None)
+
+        if self.memory_system:
+            self.memory_system.add_conversation_entry(
+                patient_id,
+                self.role,
+                answer,
+                metadata={"consultation_id": context_id, "agent_id": self.id}
+            )
+
+    def _stream_prescription_answer_from_llm(self, prescription_sig: str, prescription: Dict[str, Any], query: str) -> Iterator[str]:
+        """调用 LLM 流式生成回答，按 STREAM_BATCH_INTERVAL 合并 token 后逐批产出"""
+        med_list = self._med_list_cache.get(prescription_sig)
+        if med_list is None:
+            med_list = "\n".join(f"- {m.get('name')} ({m.get('dosage')}, {m.get('frequency')})" for m in prescription.get("medications", []))
+            self._med_list_cache.set(prescription_sig, med_list)
+        instructions = prescription.get("instructions", "遵医嘱")
+        notes = prescription.get("notes", "无特殊说明")
+
+        prompt = _PATIENT_QUERY_PROMPT_TEMPLATE.format_map({"med_list": med_list, "instructions": instructions, "notes": notes, "query": query})
+
+        pending: List[str] = []
+        last_flush = time.monotonic()
+        for delta in self.llm_service.generate_response_stream(
+            prompt=prompt,
+            system_message="你是一位耐心、专业的药剂师，正在解答患者关于处方用药的疑问。",
+            temperature=0.3,
+            max_tokens=250
+        ):
+            pending.append(delta)
+            now = time.monotonic()
+            if now - last_flush >= STREAM_BATCH_INTERVAL:
+                yield "".join(pending)
+                pending.clear()
+                last_flush = now
+        if pending:
+            yield "".join(pending)
+
+    @staticmethod
+    def _format_medication_block(med: Dict[str, Any], drug_info: Dict[str, Any]) -> str:
+        """格式化单个药物的用药说明段落"""
+        return f"【{med['name']}】\n用法：{med['dosage']}，{med['frequency']}\n说明：{drug_info.get('description', '无')}\n注意事项：{drug_info.get('side_effects') or drug_info.get('common_side_effects', '无')}"
+
     # --- LLM 调用方法 ---
 
-    def _validate_prescription_with_llm(
-        self,
-        prescription: Dict[str, Any],
-        patient_id: Optional[str] = None,
-        diagnosis_info: Optional[Dict[str, Any]] = None  # 添加诊断信息参数
-    ) -> Dict[str, Any]:
-        """使用LLM审核处方 (改进 Prompt 和错误处理, 加入诊断信息)"""
-        medications = prescription.get("medications", [])
-        if not medications:
+    @staticmethod
+    def _fast_validate(prescription: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """本地规则预检：处方存在明显问题时直接返回拒绝结果（无需调用 LLM），否则返回 None"""
+        medications = prescription.get("medications")
+        if not medications or not isinstance(medications, list):
             return {"valid": False, "issues": ["处方中没有药物"], "warnings": [], "recommendations": [], "notes": "空处方"}
-
+        if len(medications) > MAX_MEDICATIONS_PER_PRESCRIPTION:
+            return {"valid": False, "issues": [f"处方药物条目过多（{len(medications)} 条，上限 {MAX_MEDICATIONS_PER_PRESCRIPTION} 条）"], "warnings": [],
+                    "recommendations": ["请核对处方是否重复录入或拆分处方"], "notes": "处方格式异常，未提交审核。"}
+        issues = []
+        for i, med in enumerate(medications):
+            if not isinstance(med, dict) or not str(med.get("name") or "").strip():
+                issues.append(f"第{i+1}条药物缺少名称")
+            elif not str(med.get("dosage") or "").strip():
+                issues.append(f"药物 {med['name']} 未指定剂量")
+        if issues:
+            return {"valid": False, "issues": issues, "warnings": [], "recommendations": ["请补充完整的药物名称和剂量后重新提交"], "notes": "处方信息不完整，未提交审核。"}
+        return None
+
+    @staticmethod
+    def _validation_cache_key(prescription: Dict[str, Any], patient_id: Optional[str], diagnosis_info: Optional[Dict[str, Any]]) -> str:
+        """规范化（处方 + 诊断 + 患者ID）后的摘要，作为审核结果缓存键"""
+        canonical = json_dumps_bytes({"rx": prescription, "dx": diagnosis_info, "pid": patient_id}, sort_keys=True)
+        return hashlib.blake2b(canonical, digest_size=16).hexdigest()
+
+    @staticmethod
+    def _format_medication_details(medications: List[Dict[str, Any]]) -> str:
+        """格式化审核提示词中的药物清单（完全重复的药物条目只列出一次）"""
+        medications = list({(m.get('name'), m.get('dosage'), m.get('frequency'), m.get('duration')): m for m in medications}.values())
         medication_details = []
         for i, med in enumerate(medications):
             name = med.get('name', f'药物{i+1}')
@@ -378,54 +675,158 @@ class PharmacistAgent(BaseAgent):
             freq = med.get('frequency', '未指定')
             dur = med.get('duration', '未指定')  # 尝试获取疗程
             medication_details.append(f"- {name}: {dose}, {freq}, 疗程: {dur}")
-        medication_text = "\n".join(medication_details)
-        instructions = prescription.get("instructions", "无")
-        notes = prescription.get("notes", "无")
+        return "\n".join(medication_details)
 
-        # 构建诊断信息字符串 (如果提供)
+    @staticmethod
+    def _format_diagnosis_context(diagnosis_info: Optional[Dict[str, Any]]) -> str:
+        """构建审核提示词中的诊断信息段落"""
         diagnosis_context = "无可用诊断信息。"
         if diagnosis_info and isinstance(diagnosis_info, dict):
             cond = diagnosis_info.get('condition', '未指定')
             severity = diagnosis_info.get('severity', '未知')
-            explanation = diagnosis_info.get('explanation', '')  # 获取解释
-            diagnosis_context = f"相关诊断信息:\n诊断: {cond}\n严重程度: {severity}\n诊断说明: {explanation[:150]}..."  # 限制长度
-
-        # --- 改进 Prompt: 加入诊断上下文, 再次强调 JSON ---
-        prompt = f"""作为一位资深临床药剂师，请基于患者的部分诊断信息和以下处方，严格审核其合理性、安全性及潜在风险。
-
-{diagnosis_context}
+            explanation = diagnosis_info.get('explanation') or ''  # 获取解释
+            # 诊断和严重程度都未知、也没有说明时不附加诊断段落，减少提示词长度
+            if cond != '未指定' or severity != '未知' or explanation:
+                diagnosis_context = f"相关诊断信息:\n诊断: {cond}\n严重程度: {severity}"
+                if explanation:
+                    # 限制长度，仅在实际截断时添加省略号
+                    ellipsis = "..." if len(explanation) > DIAGNOSIS_EXPLANATION_MAX_CHARS else ""
+                    diagnosis_context += f"\n诊断说明: {explanation[:DIAGNOSIS_EXPLANATION_MAX_CHARS]}{ellipsis}"
+        return diagnosis_context
+
+    @staticmethod
+    def _sanitize_validation_result(result: Dict[str, Any]) -> Dict[str, Any]:
+        """就地校验并修正审核结果的字段类型"""
+        validated = None
+        if BaseModel is not None:
+            try:
+                validated = ValidationResult.model_validate(result).model_dump()
+            except ValidationError as e:
+                logger.debug("审核结果未通过 pydantic 校验，逐字段修正: %s", e)
+        if validated is not None:
+            result.update(validated)
+        else:
+            result["valid"] = bool(result.get("valid", False))
+            for field, (typ, default_factory) in _VALIDATION_SCHEMA.items():
+                value = result.get(field)
+                result[field] = value if isinstance(value, typ) else default_factory()
+        if result["issues"]:
+            result["valid"] = False  # 有 issue 则必定无效
+        return result
+
+    def _validate_and_annotate_prescription(self, prescription: Dict[str, Any], diagnosis_info: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        单次 LLM 调用同时完成处方审核、药物信息查询和药物相互作用检查，各部分结果写入对应缓存
 
-处方信息:
-{medication_text}
+        Args:
+            prescription: 处方
+            diagnosis_info: 诊断信息（可选）
 
-医嘱/用法说明: {instructions}
-其他说明/随访建议: {notes}
-{f'患者ID (供参考): {patient_id}' if patient_id else ''}
+        Returns:
+            {"validation": 审核结果, "drug_info": {药物名称: 药物信息}, "interactions": 相互作用列表}
+            合并调用失败时回退为分别调用（审核与药物信息查询并发进行），此时不额外检查相互作用；相互作用未缓存时 interactions 为 None。
+        """
+        rejection = self._fast_validate(prescription)
+        if rejection is not None:
+            return {"validation": rejection, "drug_info": {}, "interactions": []}
+        medications = prescription["medications"]
+        drug_names = list(dict.fromkeys(med["name"] for med in medications))
+        validation_key = self._validation_cache_key(prescription, None, diagnosis_info)
+        drug_by_key = self._dedupe_drugs(drug_names)
+        interaction_key = tuple(sorted(drug_by_key)) if len(drug_by_key) >= 2 else None  # 与 _check_drug_interactions_with_llm 的缓存键一致
+
+        # 审核结果和药物信息均已缓存时无需调用 LLM
+        validation = self._validation_cache.get(validation_key)
+        drug_infos = {name: self._drug_info_cache.get(name.strip().lower()) for name in drug_names}
+        cached_interactions = self._interaction_cache.get(interaction_key) if interaction_key else []
+        if validation is not None and all(drug_infos.values()):
+            return {"validation": dict(validation), "drug_info": drug_infos, "interactions": cached_interactions}
+
+        drug_list_str = ", ".join(f'"{name}"' for name in drug_names)
+        prompt = _FUSED_REVIEW_PROMPT_TEMPLATE.format_map({
+            "diagnosis_context": self._format_diagnosis_context(diagnosis_info),
+            "medication_text": self._format_medication_details(medications),
+            "instructions": prescription.get("instructions", "无"),
+            "notes": prescription.get("notes", "无"),
+            "drug_list_str": drug_list_str
+        })
+        try:
+            response = self.llm_service.generate_response(
+                prompt=prompt,
+                system_message="你是一位经验丰富、极其严谨的临床药剂师，同时也是专业的药学信息数据库。请【严格按照要求的JSON格式】输出，【不要输出任何其他文字】。",
+                temperature=0.1,
+                max_tokens=min(FUSED_REVIEW_MAX_TOKENS_CAP, FUSED_REVIEW_BASE_TOKENS + FUSED_REVIEW_TOKENS_PER_DRUG * len(drug_names)),
+                response_format="json"
+            )
+            logger.debug("处方合并审核 LLM 响应原文: '%s'", response)
+            result = json_loads(_extract_json_part(response, _JSON_OBJECT_RE, "{}") or response.strip())
+            validation = result.get("validation") if isinstance(result, dict) else None
+            fused_infos = result.get("drug_info") if isinstance(result, dict) else None
+            interactions = result.get("interactions", []) if isinstance(result, dict) else None
+            if not isinstance(validation, dict) or "valid" not in validation or not isinstance(fused_infos, dict) \
+                    or not isinstance(interactions, list) or not all(isinstance(item, dict) for item in interactions):
+                raise ValueError("LLM返回的合并审核JSON结构无效")
+        except Exception as e:
+            logger.warning(f"处方合并审核失败，回退为分别调用: {e}")
+        else:
+            self._sanitize_validation_result(validation)
+            self._validation_cache.set(validation_key, validation)
+            if interaction_key:
+                # 与 _check_drug_interactions_with_llm 一样以本地知识库结果为准并写入缓存：
+                # 之后命中缓存时不会再查知识库，只缓存 LLM 结果会漏掉已知的相互作用
+                local_hits, _ = self._lookup_local_interactions([drug_by_key[k] for k in interaction_key])
+                known_pairs = {_interaction_pair_key(hit) for hit in local_hits}
+                interactions = local_hits + [item for item in interactions if _interaction_pair_key(item) not in known_pairs]
+                self._interaction_cache.set(interaction_key, interactions)
+            for name in drug_names:
+                info = fused_infos.get(name)
+                if isinstance(info, dict) and info and "error" not in info:
+                    self._drug_info_cache.set(name.strip().lower(), info)
+                    drug_infos[name] = info
+            # 个别药物缺失时单独补查
+            missing = [name for name in drug_names if not drug_infos[name]]
+            drug_infos.update(zip(missing, _LLM_POOL.map(self._get_drug_info_with_llm, missing)))
+            logger.info("处方合并审核完成: Valid=%s, Drugs=%s, Interactions=%s", validation['valid'], len(drug_names), len(interactions))
+            return {"validation": dict(validation), "drug_info": drug_infos, "interactions": list(interactions)}
+
+        # 回退：处方审核与各药物信息查询并发进行
+        drug_info_futures = [_LLM_POOL.submit(self._get_drug_info_with_llm, name) for name in drug_names]
+        validation = self._validate_prescription_with_llm(prescription, diagnosis_info=diagnosis_info)
+        drug_infos = dict(zip(drug_names, (f.result() for f in drug_info_futures)))
+        return {"validation": validation, "drug_info": drug_infos, "interactions": cached_interactions}
 
-请重点评估以下方面，并结合诊断信息判断（例如，药物是否符合适应症）:
-1. 剂量与用法: 每个药物的剂量、频率、疗程是否清晰、常规且安全？
-2. 适应症符合性: 药物组合是否与提供的诊断信息或常见用途相符？
-3. 药物相互作用: 处方内的药物之间是否存在显著相互作用？
-4. 禁忌症/注意事项: 是否存在明显的禁忌或重要提醒？
-5. 说明清晰度: 医嘱是否清晰完整？
+    def _validate_prescription_with_llm(
+        self,
+        prescription: Dict[str, Any],
+        patient_id: Optional[str] = None,
+        diagnosis_info: Optional[Dict[str, Any]] = None  # 添加诊断信息参数
+    ) -> Dict[str, Any]:
+        """使用LLM审核处方 (改进 Prompt 和错误处理, 加入诊断信息)"""
+        rejection = self._fast_validate(prescription)
+        if rejection is not None:
+            return rejection
+        medications = prescription["medications"]
+
+        # 相同处方 + 诊断（重试、重复消息）直接复用审核结果
+        cache_key = self._validation_cache_key(prescription, patient_id, diagnosis_info)
+        cached = self._validation_cache.get(cache_key)
+        if cached is not None:
+            logger.debug("处方审核缓存命中 (Patient: %s)", patient_id)
+            return dict(cached)
+
+        medication_text = self._format_medication_details(medications)
+        instructions = prescription.get("instructions", "无")
+        notes = prescription.get("notes", "无")
+        diagnosis_context = self._format_diagnosis_context(diagnosis_info)
 
-请【务必只返回】一个JSON对象，严格遵循以下格式，【不要包含任何】 markdown 标记 (如 ```json) 或其他解释文字:
-{{{{
-  "valid": true,
-  "issues": [],
-  "warnings": [],
-  "recommendations": [],
-  "notes": "处方合理，未发现明显问题。"
-}}}}
-如果发现问题，请修改相应字段，例如：
-{{{{
-  "valid": false,
-  "issues": ["药物X剂量可能偏高，建议复核", "疗程未指定"],
-  "warnings": ["药物X与药物Z联用可能增加出血风险"],
-  "recommendations": ["请确认药物X的准确剂量", "请补充疗程"],
-  "notes": "处方存在剂量和相互作用风险，需修改。"
-}}}}
-"""
+        # --- 改进 Prompt: 加入诊断上下文, 再次强调 JSON ---
+        prompt = _VALIDATION_PROMPT_TEMPLATE.format_map({
+            "diagnosis_context": diagnosis_context,
+            "medication_text": medication_text,
+            "instructions": instructions,
+            "notes": notes,
+            "patient_line": f"患者ID (供参考): {patient_id}" if patient_id else ""
+        })
         try:
             # --- 增加 max_tokens ---
             response = self.llm_service.generate_response(
@@ -435,21 +836,18 @@ class PharmacistAgent(BaseAgent):
                 max_tokens=800  # 再次增加 Token 限制
             )
             # --------------------------
-            logger.debug(f"处方审核LLM响应原文: '{response}'")  # 记录原始响应
+            logger.debug("处方审核LLM响应原文: '%s'", response)  # 记录原始响应
 
             # --- 改进 JSON 解析和验证 ---
-            json_part = response.strip()
-            # 尝试更鲁棒地去除可能的代码块标记和前后缀文本
-            match = re.search(r'\{.*\}', json_part, re.DOTALL)  # 查找被{}包裹的最外层JSON
-            if match:
-                json_part = match.group(0)
-            else:
+            # 裸 JSON 直接使用，否则去除可能的代码块标记和前后缀文本，查找被{}包裹的最外层JSON
+            json_part = _extract_json_part(response, _JSON_OBJECT_RE, "{}")
+            if json_part is None:
                 logger.warning(f"LLM响应中未找到有效的 JSON 对象结构。原始响应: {response[:200]}...")
-                # 仍然尝试直接解析，可能LLM正好返回了裸JSON
-                pass  # 继续尝试 json.loads
+                # 仍然尝试直接解析
+                json_part = response.strip()
 
             try:
-                result = json.loads(json_part)
+                result = json_loads(json_part)
                 if not isinstance(result, dict) or "valid" not in result:
                     logger.error(f"LLM处方审核返回了无效的JSON结构 (缺少 'valid' 字段)。解析部分: '{json_part[:200]}...'")
                     raise ValueError("LLM返回的JSON结构无效")
@@ -461,22 +859,22 @@ class PharmacistAgent(BaseAgent):
             # ----------------------------
 
             # 验证和清理返回结果
-            result["valid"] = bool(result.get("valid", False))
-            result["issues"] = result.get("issues", []) if isinstance(result.get("issues"), list) else []
-            result["warnings"] = result.get("warnings", []) if isinstance(result.get("warnings"), list) else []
-            result["recommendations"] = result.get("recommendations", []) if isinstance(result.get("recommendations"), list) else []
-            result["notes"] = result.get("notes", "") if isinstance(result.get("notes"), str) else ""
-            if result["issues"]:
-                result["valid"] = False  # 有 issue 则必定无效
-            logger.info(f"处方审核LLM解析成功: Valid={result['valid']}, Issues={len(result['issues'])}, Warnings={len(result['warnings'])}")
-            return result
+            self._sanitize_validation_result(result)
+            logger.info("处方审核LLM解析成功: Valid=%s, Issues=%s, Warnings=%s", result['valid'], len(result['issues']), len(result['warnings']))
+            self._validation_cache.set(cache_key, result)
+            return dict(result)
 
         except Exception as e:
             logger.error(f"LLM处方审核过程发生错误: {str(e)}.", exc_info=True)
             return {"valid": False, "issues": ["系统审核时发生内部错误"], "warnings": [f"错误详情: {str(e)}"], "recommendations": ["请人工复核"], "notes": "系统错误导致审核未完成。"}
 
     def _get_drug_info_with_llm(self, drug_name: str) -> Dict[str, Any]:
-        prompt = f"""请提供关于药物 "{drug_name}" 的详细信息。严格按JSON格式返回(字段: "drug_name", "description", "common_uses", "common_dosage", "common_side_effects", "serious_side_effects", "contraindications", "warnings_precautions", "storage")。找不到返回{{"drug_name":"{drug_name}", "error":"信息未找到"}}。"""
+        key = drug_name.strip().lower()
+        cached = self._drug_info_cache.get(key)
+        if cached is not None:
+            logger.debug("药物信息缓存命中: '%s'", drug_name)
+            return cached
+        prompt = _DRUG_INFO_PROMPT_TEMPLATE.format_map({"drug_name": drug_name})
         try:
             response = self.llm_service.generate_response(
                 prompt=prompt,
@@ -484,54 +882,101 @@ class PharmacistAgent(BaseAgent):
                 temperature=0.1,
                 max_tokens=500
             )
-            logger.debug(f"药物信息查询 LLM 响应 for '{drug_name}': {response}")
+            logger.debug("药物信息查询 LLM 响应 for '%s': %s", drug_name, response)
             
-            json_part = response.strip()
-            match = re.search(r'\{.*\}', json_part, re.DOTALL)
-            json_part = match.group(0) if match else json_part  # Try extracting json object
+            json_part = _extract_json_part(response, _JSON_OBJECT_RE, "{}") or response.strip()
             
-            drug_info = json.loads(json_part)
+            drug_info = json_loads(json_part)
             if drug_info.get("drug_name", "").lower() != drug_name.lower() and "error" not in drug_info:
                 logger.warning(f"LLM 返回的药物信息名称 ('{drug_info.get('drug_name')}') 与查询名称 ('{drug_name}') 不完全匹配。")
+            if "error" not in drug_info:
+                self._drug_info_cache.set(key, drug_info)
             return drug_info
         except Exception as e:
             logger.error(f"LLM获取药物 '{drug_name}' 信息过程发生错误: {str(e)}. Raw: {response if 'response' in locals() else 'N/A'}")
             return {"drug_name": drug_name, "error": f"查询时发生系统错误: {str(e)}"}
 
+    @staticmethod
+    def _dedupe_drugs(drug_list: List[str]) -> Dict[str, str]:
+        """忽略大小写和首尾空白去重，返回 规范化名称 -> 首次出现的写法"""
+        drug_by_key: Dict[str, str] = {}
+        for d in drug_list:
+            d = d.strip() if d else ""
+            if d:
+                drug_by_key.setdefault(d.lower(), d)
+        return drug_by_key
+
+    @staticmethod
+    def _lookup_local_interactions(drugs: List[str]) -> Tuple[List[Dict[str, Any]], List[Tuple[str, str]]]:
+        """在本地知识库中查找各药物两两组合的相互作用，返回 (命中的相互作用列表, 未收录的药物对)"""
+        local_hits: List[Dict[str, Any]] = []
+        unknown_pairs: List[Tuple[str, str]] = []
+        for drug_a, drug_b in itertools.combinations(drugs, 2):
+            entry = _INTERACTION_KB.get(tuple(sorted((_kb_drug_key(drug_a), _kb_drug_key(drug_b)))))
+            if entry is None:
+                unknown_pairs.append((drug_a, drug_b))
+            else:
+                local_hits.append({
+                    "drug_pair": [drug_a, drug_b],
+                    "severity": entry.get("severity", ""),
+                    "description": entry.get("description", ""),
+                    "recommendation": entry.get("recommendation", "")
+                })
+        return local_hits, unknown_pairs
+
     def _check_drug_interactions_with_llm(self, drug_list: List[str]) -> List[Dict[str, Any]]:
         if len(drug_list) < 2:
             return []
             
-        unique_drugs = sorted(list(set(filter(None, [d.strip() for d in drug_list]))))
-        if len(unique_drugs) < 2:
+        # 忽略大小写去重，保留首次出现的写法，按规范化名称排序
+        drug_by_key = self._dedupe_drugs(drug_list)
+        if len(drug_by_key) < 2:
             return []
-            
-        drug_list_str = ", ".join(f'"{drug}"' for drug in unique_drugs)
-        prompt = f"""请检查以下药物之间所有可能的两两组合是否存在已知的、临床显著的相互作用: 药物列表: [{drug_list_str}]。严格按JSON列表格式返回(字段: "drug_pair", "severity", "description", "recommendation")。无相互作用返回[]。"""
+        cache_key = tuple(sorted(drug_by_key))
+        unique_drugs = [drug_by_key[k] for k in cache_key]
+
+        cached = self._interaction_cache.get(cache_key)
+        if cached is not None:
+            logger.debug("药物相互作用缓存命中: %s", unique_drugs)
+            return list(cached)
+
+        # 先查本地知识库，只把未收录的药物对交给 LLM
+        local_hits, unknown_pairs = self._lookup_local_interactions(unique_drugs)
+        if not unknown_pairs:
+            logger.debug("药物相互作用全部由本地知识库得出: %s", unique_drugs)
+            self._interaction_cache.set(cache_key, local_hits)
+            return list(local_hits)
+
+        if local_hits:
+            pair_list_str = ", ".join(f'["{a}", "{b}"]' for a, b in unknown_pairs)
+            prompt = _INTERACTION_PAIRS_PROMPT_TEMPLATE.format_map({"pair_list_str": pair_list_str})
+        else:
+            drug_list_str = ", ".join(f'"{drug}"' for drug in unique_drugs)
+            prompt = _INTERACTION_PROMPT_TEMPLATE.format_map({"drug_list_str": drug_list_str})
         
         try:
             response = self.llm_service.generate_response(
                 prompt=prompt,
                 system_message="你是一个专业的药物相互作用数据库查询引擎。请仅以JSON列表格式返回已知的、临床显著的相互作用信息。",
                 temperature=0.0,
-                max_tokens=max(500, len(unique_drugs) * 150)
+                max_tokens=min(INTERACTION_MAX_TOKENS_CAP, max(INTERACTION_MIN_TOKENS, len(unknown_pairs) * INTERACTION_TOKENS_PER_PAIR))  # 按待查药物对数（O(N²)）分配
             )
-            logger.debug(f"药物相互作用检查 LLM 响应 for {unique_drugs}: {response}")
+            logger.debug("药物相互作用检查 LLM 响应 for %s: %s", unique_drugs, response)
             
-            json_part = response.strip()
-            # 查找最外层列表
-            match = re.search(r'$.*$', json_part, re.DOTALL)
-            json_part = match.group(0) if match else json_part
+            json_part = _extract_json_part(response, _JSON_ARRAY_RE, "[]") or response.strip()  # 查找最外层列表
             
             if json_part == '[]':
-                return []
+                self._interaction_cache.set(cache_key, local_hits)
+                return list(local_hits)
                 
-            interactions = json.loads(json_part)
+            interactions = json_loads(json_part)
             if isinstance(interactions, list) and all(isinstance(item, dict) for item in interactions):
-                return interactions
+                interactions = local_hits + interactions
+                self._interaction_cache.set(cache_key, interactions)
+                return list(interactions)
             else:
                 logger.error(f"LLM药物相互作用检查返回了无效的格式。Raw: {response}")
-                return []
+                return list(local_hits)
         except Exception as e:
             logger.error(f"LLM药物相互作用检查过程发生错误: {str(e)}. Raw: {response if 'response' in locals() else 'N/A'}")
-            return []
+            return list(local_hits)
@@ -1,17 +1,25 @@
 # agents/receptionist.py
 
+import itertools
 import logging
 import json
 import re # Used for phone extraction
-from typing import Dict, List, Any, Optional
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, fields, replace
+from datetime import datetime, timezone
+from typing import Dict, List, Any, Optional, Tuple
 from .base_agent import BaseAgent
+from utils.cache import SimilarityCache, TTLCache, make_prompt_key, normalize_text
+from utils.json_utils import loads as json_loads, loads_tolerant
 try:
-    from utils.llm_service import LLMService
+    from utils.llm_service import LLMService, LLM_ERROR_PREFIX
     from utils.memory_system import MemorySystem
 except ImportError as e:
     logging.error(f"ReceptionistAgent failed to import dependencies: {e}", exc_info=True)
     LLMService = None # type: ignore
     MemorySystem = None # type: ignore
+    LLM_ERROR_PREFIX = "很抱歉，我无法处理您的请求"
 
 logger = logging.getLogger("Hospital-MultiAgent-System")
 
@@ -19,7 +27,52 @@ VALID_DEPARTMENTS = ["内科", "外科", "儿科", "妇产科", "皮肤科", "
 DEFAULT_DEPARTMENT = "内科"
 DEFAULT_PRIORITY = "normal"
 PRIORITY_LEVELS = ["normal", "priority", "urgent"]
+# 校验 LLM 分诊结果时使用的集合，以及提示词中使用的科室列表文本
+VALID_DEPARTMENTS_SET = frozenset(VALID_DEPARTMENTS)
+PRIORITY_LEVELS_SET = frozenset(PRIORITY_LEVELS)
+VALID_DEPARTMENTS_JOINED = ", ".join(VALID_DEPARTMENTS)
+PRIORITY_TEXT = {"normal": "普通", "priority": "优先", "urgent": "紧急"}
+VISIT_STATUS_TEXT = ("（已记录为初诊）", "（已记录为复诊）") # 按是否复诊取值
 MAX_CHAT_TURNS = 3
+REQUEST_KEYS = ("reception_request", "followup_query", "general_query") # 接待员处理的消息类型，按优先级排列
+DEFAULT_REPLY = "抱歉，我暂时无法处理您的请求，请稍后再试。"
+MAX_CONVERSATION_SNIPPETS = 6 # 上下文中保留的最近对话片段数
+INTENT_HISTORY_SNIPPETS = 4 # 意图识别提示词中带上的最近对话片段数
+
+# 模块加载时预编译的正则
+PHONE_RE = re.compile(r'1[3-9]\d{9}')  # 手机号
+SYMPTOM_SPLIT_RE = re.compile(r'[，。；、？！,.!?\s]+')  # 按中英文标点和空白切分症状
+SYMPTOM_STOPWORDS = frozenset(["我", "你好", "谢谢"])  # 切分后不视为症状的片段
+
+# 身份信息关键词 -> (类别, 是否从症状文本中剔除)
+IDENTITY_KEYWORDS = {
+    "复诊": ("return_yes", True), "以前来过": ("return_yes", True), "之前看过": ("return_yes", False),
+    "初诊": ("return_no", True), "第一次": ("return_no", True), "没来过": ("return_no", False),
+    "是的": ("affirm", True), "是啊": ("affirm", False), "对": ("affirm", True),
+    "不是": ("deny", True), "没有": ("deny", True),
+    "手机号是": ("mask_only", True), "号码是": ("mask_only", True),
+}
+# 零宽前瞻使一次扫描即可得到所有（含重叠的）关键词命中及其位置
+IDENTITY_KEYWORD_RE = re.compile("(?=(" + "|".join(re.escape(k) for k in sorted(IDENTITY_KEYWORDS, key=len, reverse=True)) + "))")
+
+# 纯寒暄/应答消息（去除标点后只由这些词组成且足够短）直接视为闲聊，无需调用 LLM 识别意图
+GREETING_WORDS = ["你好", "您好", "嗨", "谢谢", "多谢", "再见", "哦", "嗯", "好的"]
+GREETING_MAX_CHARS = 10
+GREETING_RE = re.compile("(?:" + "|".join(map(re.escape, GREETING_WORDS)) + ")+")
+GREETING_INTENT = {"intent": "general_chat", "has_sufficient_medical_info": False, "extracted_symptoms": []}
+
+# 分诊前并行执行互不依赖的记忆查询（患者信息、长期记忆摘要）
+_LOOKUP_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="reception-lookup")
+# 与意图识别并行的预先分诊（分诊任务内部还会使用 _LOOKUP_POOL，因此使用独立线程池避免相互等待）
+_TRIAGE_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="reception-triage")
+
+# 意图识别/分诊 LLM 响应缓存：只缓存低温度（结果基本确定）的调用
+LLM_CACHE_MAX_TEMPERATURE = 0.2
+LLM_CACHE_TTL = 3600
+
+# 闲聊/找医生回复缓存：用户消息规范化后相同或字符二元组 Jaccard 相似度达到阈值时复用已生成的回复
+CHAT_REPLY_CACHE_SIZE = 512
+CHAT_REPLY_SIMILARITY = 0.9
 
 STAGE_INTENT = "reception_intent_recognition"
 STAGE_ASKING_IDENTITY = "reception_asking_identity"
@@ -30,86 +83,214 @@ STAGE_CHATTING = "reception_chatting"
 STAGE_CHAT_ENDED = "reception_chat_ended"
 STAGE_CLARIFICATION = "reception_clarification"
 STAGE_ERROR = "reception_error_handling"
+# 只有处于问诊流程中的阶段才预先发起分诊；闲聊、出错等阶段本轮几乎不会分诊
+SPECULATIVE_TRIAGE_STAGES = frozenset({STAGE_GUIDING, STAGE_CLARIFICATION, STAGE_TRIAGE})
+# 处理方法可能返回"执行分诊"的意图，其余意图识别完成后立即取消预先分诊
+TRIAGE_INTENTS = frozenset({"medical_inquiry", "providing_identity"})
+
+# 意图识别/分诊提示词中不随请求变化的部分放在最前面，便于服务端复用提示词前缀缓存；变化的内容追加在末尾
+INTENT_PROMPT_PREFIX = """你是一个医院接待AI，需要判断用户的意图。
+
+请分析用户最新消息的主要意图，并判断是否提供了足够的医疗信息（至少一个明确症状）。
+可能的意图分类:
+- "medical_inquiry": 用户在描述症状或健康问题。
+- "general_chat": 闲聊、问候、询问非医疗信息、表达感谢等。
+- "seeking_specific_doctor": 明确表示想找某位医生。
+- "providing_identity": 用户在提供手机号或说明是否复诊 (可能是对你问题的回复)。
+- "asking_guidance": 用户不确定如何描述，寻求引导。
+- "unclear": 意图不明。
+
+请严格按照以下JSON格式返回结果:
+{
+  "intent": "...",
+  "has_sufficient_medical_info": true/false,
+  "extracted_symptoms": ["..."]
+}
+如果意图是 "providing_identity"， "has_sufficient_medical_info" 和 "extracted_symptoms" 可能为 false/[]。"""
+
+TRIAGE_PROMPT_PREFIX = f"""你是一位经验丰富的医院分诊接待员。请根据下方的患者信息，推荐最合适的就诊科室，并评估紧急程度（普通、优先、紧急）。
+
+请严格按照以下 JSON 格式返回结果:
+{{
+  "department": "推荐的科室名称 (从 {VALID_DEPARTMENTS_JOINED} 中选择)",
+  "priority": "紧急程度 ('normal', 'priority', 'urgent')",
+  "reason": "推荐科室和判断紧急程度的简要理由"
+}}
+如果信息不足，推荐 "{DEFAULT_DEPARTMENT}" 和 "{DEFAULT_PRIORITY}"。非常紧急的情况（如严重外伤、呼吸困难、胸痛）推荐 "急诊科" 和 "urgent"。"""
+
+# 两者都只返回一个小 JSON 对象
+INTENT_MAX_TOKENS = 80
+TRIAGE_MAX_TOKENS = 120
+
+
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _parse_json_object(text: str) -> Any:
+    """
+    解析 LLM 响应中的 JSON 对象：响应本身就是裸 JSON 时直接用 orjson 解析；否则从第一个 "{" 起增量解码，
+    忽略其后的多余文本；解码失败时退回截取第一个 "{" 到最后一个 "}" 之间的内容解析（不使用回溯正则），
+    没有闭合的 "}"（如输出因 max_tokens 被截断）时尝试补全后解析
+    """
+    json_part = text.strip()
+    if json_part[:1] == '{' and json_part[-1:] == '}':
+        try:
+            return json_loads(json_part)
+        except json.JSONDecodeError:
+            pass
+    start = json_part.find('{')
+    if start < 0:
+        return json.loads(json_part)
+    try:
+        result, _ = _JSON_DECODER.raw_decode(json_part, start)
+        return result
+    except json.JSONDecodeError:
+        end = json_part.rfind('}')
+        if end < start:
+            return loads_tolerant(json_part[start:])
+        return json_loads(json_part[start:end + 1])
+
+def _merge_symptoms(existing: List[str], new: List[str]) -> List[str]:
+    """合并已有症状和新提取的症状：去重、去空，保留首次出现的顺序"""
+    return list(dict.fromkeys(s for s in itertools.chain(existing, new) if s))
 
+@dataclass(slots=True)
+class ReceptionContext:
+    """
+    接待员持有的问诊上下文。MemorySystem 与其他组件（如 Orchestrator 的交互日志、阶段切换）仍以字典形式读写上下文，
+    因此每轮通过 from_dict 读取、to_dict 合并回写，且只包含接待员负责维护的字段
+    """
+    patient_id: Optional[str] = None
+    consultation_id: Optional[str] = None
+    stage: str = STAGE_INTENT
+    chat_turns: int = 0
+    off_topic_turns: int = 0
+    conversation_snippets: deque = field(default_factory=lambda: deque(maxlen=MAX_CONVERSATION_SNIPPETS))
+    patient_info_from_web: Dict[str, Any] = field(default_factory=dict)
+    extracted_symptoms: List[str] = field(default_factory=list)
+    guidance_given: bool = False
+    identity_asked: bool = False
+    identity_confirmed: bool = False
+    is_return_visit: Optional[bool] = None
+    phone_provided: Optional[str] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        """转换为合并到 MemorySystem 中的字典（浅拷贝，容器与本对象共享）"""
+        return {name: getattr(self, name) for name in _RECEPTION_CONTEXT_FIELDS}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ReceptionContext":
+        """从 MemorySystem 中的字典构建，忽略其他组件写入的字段；缺失或为空的字段使用默认值"""
+        ctx = cls(**{name: data[name] for name in _RECEPTION_CONTEXT_FIELDS if data.get(name) is not None})
+        if not isinstance(ctx.conversation_snippets, deque): # 从持久化文件恢复的上下文中是列表
+            ctx.conversation_snippets = deque(ctx.conversation_snippets, maxlen=MAX_CONVERSATION_SNIPPETS)
+        return ctx
+
+_RECEPTION_CONTEXT_FIELDS = tuple(f.name for f in fields(ReceptionContext))
 
 class ReceptionistAgent(BaseAgent):
     """前台接待智能体 (支持多轮交互、身份识别和意图识别)"""
 
+    __slots__ = ("llm_service", "off_topic_response", "_llm_cache", "_chat_reply_cache", "_llm_generate")
+
+    # 当前阶段 -> 处理方法名（优先于意图识别）
+    _STAGE_HANDLERS = {
+        STAGE_ASKING_IDENTITY: "_handle_identity_reply",
+    }
+    # 识别出的意图 -> 处理方法名；未列出的意图保持当前阶段并返回默认回复
+    _INTENT_HANDLERS = {
+        "general_chat": "_handle_general_chat",
+        "seeking_specific_doctor": "_handle_general_chat",
+        "medical_inquiry": "_handle_medical_inquiry",
+        "providing_identity": "_handle_providing_identity",
+        "asking_guidance": "_handle_asking_guidance",
+        "unclear": "_handle_asking_guidance",
+        "error": "_handle_intent_error",
+    }
+
     def __init__(self, name: str = "前台接待员", role: str = "receptionist", memory_system: Optional[MemorySystem] = None, llm_service: Optional[LLMService] = None):
         super().__init__(name=name, role=role, memory_system=memory_system)
         self.llm_service = llm_service
+        self._llm_generate = llm_service.generate_response if llm_service else None # 预先绑定，热路径上免去属性查找
+        # 提示词摘要 -> LLM 原始响应（问候、致谢等重复消息直接命中）
+        self._llm_cache = TTLCache(maxsize=2048, ttl=LLM_CACHE_TTL)
+        self._chat_reply_cache = SimilarityCache(maxsize=CHAT_REPLY_CACHE_SIZE, threshold=CHAT_REPLY_SIMILARITY)
         if not self.llm_service:
             logger.warning(f"接待员 {name}: LLM 服务未提供，意图识别和分诊功能将受限。")
         if not self.memory_system:
              logger.error(f"接待员 {name}: MemorySystem 未提供，无法管理多轮对话状态。")
         # 新增的默认闲聊过多回复
         self.off_topic_response = "您交流过多和看诊无关的话题，请描述您的具体症状，或明天再来沟通。我们需要给其他病人留出更多时间，谢谢理解。"
-        logger.info(f"前台接待智能体 {name} 初始化完成")
+        logger.info("前台接待智能体 %s 初始化完成", name)
+
+    def _cached_llm(self, prompt: str, system_message: str, temperature: float, max_tokens: int) -> str:
+        """按提示词哈希缓存低温度 LLM 调用的响应，调用失败的响应不写入缓存"""
+        if temperature > LLM_CACHE_MAX_TEMPERATURE:
+            return self._llm_generate(prompt=prompt, system_message=system_message, temperature=temperature, max_tokens=max_tokens)
+        key = make_prompt_key(prompt, system_message, temperature, max_tokens)
+        cached = self._llm_cache.get(key)
+        if cached is not None:
+            logger.debug("接待员 %s 命中 LLM 响应缓存: %s", self.name, key)
+            return cached
+        response = self._llm_generate(prompt=prompt, system_message=system_message, temperature=temperature, max_tokens=max_tokens)
+        if response and not response.startswith(LLM_ERROR_PREFIX):
+            self._llm_cache.set(key, response)
+        return response
 
-    def _determine_intent_and_extract(self, user_message: str, patient_id: str, context: Optional[Dict]=None) -> Dict:
+    def _determine_intent_and_extract(self, user_message: str, patient_id: str, context: Optional["ReceptionContext"]=None) -> Dict:
         if not self.llm_service:
              logger.error(f"无法进行意图识别 (Patient {patient_id})：LLM 服务不可用")
              return {"intent": "error", "message": "LLM 服务不可用"}
         history_summary = ""
-        if context and context.get("conversation_snippets"):
-             snippets_to_use = context["conversation_snippets"][-min(len(context["conversation_snippets"]), 4):]
+        if context and context.conversation_snippets:
+             snippets = context.conversation_snippets
+             snippets_to_use = itertools.islice(snippets, max(0, len(snippets) - INTENT_HISTORY_SNIPPETS), None)
              history_summary = "\n\n最近对话片段:\n" + "\n".join(snippets_to_use)
-        prompt = f"""你是一个医院接待AI，需要判断用户的意图。
-
-{history_summary}
+        prompt = f"""{INTENT_PROMPT_PREFIX}{history_summary}
 
 用户最新消息: "{user_message}"
-
-请分析用户最新消息的主要意图，并判断是否提供了足够的医疗信息（至少一个明确症状）。
-可能的意图分类:
-- "medical_inquiry": 用户在描述症状或健康问题。
-- "general_chat": 闲聊、问候、询问非医疗信息、表达感谢等。
-- "seeking_specific_doctor": 明确表示想找某位医生。
-- "providing_identity": 用户在提供手机号或说明是否复诊 (可能是对你问题的回复)。
-- "asking_guidance": 用户不确定如何描述，寻求引导。
-- "unclear": 意图不明。
-
-请严格按照以下JSON格式返回结果:
-{{
-  "intent": "...",
-  "has_sufficient_medical_info": true/false,
-  "extracted_symptoms": ["..."]
-}}
-如果意图是 "providing_identity"， "has_sufficient_medical_info" 和 "extracted_symptoms" 可能为 false/[]。
 """
         try:
-            response_str = self.llm_service.generate_response(prompt=prompt, system_message="你是一个意图识别助手，请分析用户输入并以JSON格式返回结果。", temperature=0.1, max_tokens=200)
-            logger.debug(f"意图识别LLM响应 (Patient {patient_id}): {response_str}")
-            json_part = response_str.strip()
-            match = re.search(r'\{.*\}', json_part, re.DOTALL)
-            if match: json_part = match.group(0)
-            result = json.loads(json_part)
+            response_str = self._cached_llm(prompt=prompt, system_message="你是一个意图识别助手，请分析用户输入并以JSON格式返回结果。", temperature=0.1, max_tokens=INTENT_MAX_TOKENS)
+            logger.debug("意图识别LLM响应 (Patient %s): %s", patient_id, response_str)
+            result = _parse_json_object(response_str)
             result["intent"] = result.get("intent", "unclear")
             result["has_sufficient_medical_info"] = bool(result.get("has_sufficient_medical_info", False))
-            result["extracted_symptoms"] = result.get("extracted_symptoms", []) if isinstance(result.get("extracted_symptoms"), list) else []
-            logger.info(f"意图识别结果 (Patient {patient_id}): Intent={result['intent']}, SufficientInfo={result['has_sufficient_medical_info']}, Symptoms={result['extracted_symptoms']}")
+            symptoms = result.get("extracted_symptoms")
+            result["extracted_symptoms"] = symptoms if isinstance(symptoms, list) else []
+            logger.info("意图识别结果 (Patient %s): Intent=%s, SufficientInfo=%s, Symptoms=%s", patient_id, result['intent'], result['has_sufficient_medical_info'], result['extracted_symptoms'])
             return result
         except (json.JSONDecodeError, Exception) as e:
              logger.error(f"意图识别LLM调用或解析失败 (Patient {patient_id}): {e}", exc_info=True)
              return {"intent": "error", "message": f"意图识别失败: {e}"}
 
     def _extract_identity_info(self, message: str) -> Dict[str, Any]:
-        phone_match = re.search(r'1[3-9]\d{9}', message)
-        phone = phone_match.group(0) if phone_match else None
+        # 手机号（取第一个）及所有手机号所在区间都需从症状文本中剔除
+        mask_spans = [match.span() for match in PHONE_RE.finditer(message)]
+        phone = message[slice(*mask_spans[0])] if mask_spans else None
+        # 一次扫描收集关键词类别及需剔除的区间
+        categories = set()
+        for match in IDENTITY_KEYWORD_RE.finditer(message):
+            keyword = match.group(1)
+            category, masked = IDENTITY_KEYWORDS[keyword]
+            categories.add(category)
+            if masked: mask_spans.append((match.start(), match.start() + len(keyword)))
         is_return = None
-        if any(keyword in message for keyword in ["复诊", "以前来过", "之前看过"]): is_return = True
-        elif any(keyword in message for keyword in ["初诊", "第一次", "没来过"]): is_return = False
-        elif is_return is None and any(keyword in message for keyword in ["是的", "是啊", "对"]): is_return = True
-        elif is_return is None and any(keyword in message for keyword in ["不是", "没有"]): is_return = False
-        extracted_symptoms = []
-        symptom_text = message
-        if phone: symptom_text = symptom_text.replace(phone, "")
-        identity_phrases = ["手机号是", "号码是", "复诊", "初诊", "是的", "不是", "以前来过", "第一次", "没有", "对"]
-        for phrase in identity_phrases: symptom_text = symptom_text.replace(phrase, "")
-        possible_symptoms = re.split(r'[，。；、？！,.!?\s]+', symptom_text.strip())
-        extracted_symptoms = [s.strip() for s in possible_symptoms if s.strip() and len(s.strip()) > 1 and s.strip() not in ["我", "你好", "谢谢"]]
+        if "return_yes" in categories: is_return = True
+        elif "return_no" in categories: is_return = False
+        elif "affirm" in categories: is_return = True
+        elif "deny" in categories: is_return = False
+        # 按区间拼接未被剔除的片段
+        pieces, cursor = [], 0
+        for start, end in sorted(mask_spans):
+            if start > cursor: pieces.append(message[cursor:start])
+            cursor = max(cursor, end)
+        pieces.append(message[cursor:])
+        symptom_text = "".join(pieces)
+        possible_symptoms = SYMPTOM_SPLIT_RE.split(symptom_text.strip())
+        extracted_symptoms = [s for s in map(str.strip, possible_symptoms) if len(s) > 1 and s not in SYMPTOM_STOPWORDS]
         result = {"phone": phone,"is_return_visit_indicated": is_return,"additional_symptoms": extracted_symptoms}
-        logger.debug(f"Extracted identity info: {result}")
+        logger.debug("Extracted identity info: %s", result)
         return result
 
     def _triage_with_llm(self, symptoms: List[str], patient_age: Optional[int], medical_history: List[str], is_return_visit: bool, previous_diagnosis: Optional[Dict]) -> Dict:
@@ -125,39 +306,159 @@ class ReceptionistAgent(BaseAgent):
                  prev_cond = previous_diagnosis.get('condition', '未记录')
                  return_visit_info += f" 上次诊断可能与 {prev_cond} 相关。"
              else: return_visit_info += " (无上次具体诊断信息)"
-        prompt = f"""你是一位经验丰富的医院分诊接待员。请根据以下患者信息，推荐最合适的就诊科室，并评估紧急程度（普通、优先、紧急）。
+        prompt = f"""{TRIAGE_PROMPT_PREFIX}
 
 患者信息：
 年龄：{patient_age if patient_age else '未知'}
 主诉症状：{symptoms_string}
 过往病史：{history_string}{return_visit_info}
-
-请严格按照以下 JSON 格式返回结果:
-{{
-  "department": "推荐的科室名称 (从 {', '.join(VALID_DEPARTMENTS)} 中选择)",
-  "priority": "紧急程度 ('normal', 'priority', 'urgent')",
-  "reason": "推荐科室和判断紧急程度的简要理由"
-}}
-如果信息不足，推荐 "{DEFAULT_DEPARTMENT}" 和 "{DEFAULT_PRIORITY}"。非常紧急的情况（如严重外伤、呼吸困难、胸痛）推荐 "急诊科" 和 "urgent"。
 """
         try:
-            llm_response_str = self.llm_service.generate_response(prompt=prompt, system_message="你是一位专业的医院分诊助手，请仔细分析信息并给出结构化JSON输出。", temperature=0.2, max_tokens=200)
-            logger.debug(f"分诊LLM响应: {llm_response_str}")
-            json_part = llm_response_str.strip()
-            match = re.search(r'\{.*\}', json_part, re.DOTALL)
-            if match: json_part = match.group(0)
-            triage_result = json.loads(json_part)
+            llm_response_str = self._cached_llm(prompt=prompt, system_message="你是一位专业的医院分诊助手，请仔细分析信息并给出结构化JSON输出。", temperature=0.2, max_tokens=TRIAGE_MAX_TOKENS)
+            logger.debug("分诊LLM响应: %s", llm_response_str)
+            triage_result = _parse_json_object(llm_response_str)
             validated_result = {"status": "success","department": DEFAULT_DEPARTMENT,"priority": DEFAULT_PRIORITY,"reason": triage_result.get("reason", "LLM未提供理由。")}
             rec_dept = triage_result.get("department")
-            if rec_dept and isinstance(rec_dept, str) and rec_dept in VALID_DEPARTMENTS: validated_result["department"] = rec_dept
+            if rec_dept and isinstance(rec_dept, str) and rec_dept in VALID_DEPARTMENTS_SET: validated_result["department"] = rec_dept
             rec_prio = triage_result.get("priority")
-            if rec_prio and isinstance(rec_prio, str) and rec_prio in PRIORITY_LEVELS: validated_result["priority"] = rec_prio
-            logger.info(f"分诊结果: 科室={validated_result['department']}, 优先级={validated_result['priority']}")
+            if rec_prio and isinstance(rec_prio, str) and rec_prio in PRIORITY_LEVELS_SET: validated_result["priority"] = rec_prio
+            logger.info("分诊结果: 科室=%s, 优先级=%s", validated_result['department'], validated_result['priority'])
             return validated_result
         except (json.JSONDecodeError, Exception) as e:
              logger.error(f"分诊LLM调用或解析失败: {e}", exc_info=True)
              return {"status": "error", "message": f"智能分诊失败: {e}", "department": DEFAULT_DEPARTMENT, "priority": DEFAULT_PRIORITY, "reason": "系统错误"}
 
+    def _run_triage(self, context: "ReceptionContext", patient_id: str, symptoms: List[str]) -> Tuple[Dict, Dict[str, Any], Optional[Dict[str, Any]]]:
+        """
+        查询分诊所需的患者信息和病史并调用 LLM 分诊
+
+        Returns:
+            (分诊结果, 提供给 LLM 的患者信息, 数据库中的患者信息)
+        """
+        patient_info_for_llm = {}
+        patient_db_info = None
+        if context.identity_confirmed:
+            info_future = _LOOKUP_POOL.submit(self.memory_system.get_patient_info, patient_id)
+            summaries_future = _LOOKUP_POOL.submit(self.memory_system.get_consolidated_long_term_memories, patient_id, limit=2)
+            patient_db_info = info_future.result()
+            patient_info_for_llm = patient_db_info.copy() if patient_db_info else {}
+        else: 
+            patient_info_for_llm = context.patient_info_from_web.copy()
+            patient_info_for_llm["name"] = patient_info_for_llm.get("patient_name", "网页用户")
+        medical_history_list = []
+        if context.identity_confirmed:
+            summaries = summaries_future.result()
+            medical_history_list = [f"过往诊断摘要: {s.get('summary',{}).get('key_diagnoses','N/A')}" for s in summaries]
+            medical_history_list = medical_history_list or ["有就诊记录但无摘要"]
+        else: 
+            medical_history_list = context.patient_info_from_web.get("medical_history", [])
+        triage_llm_result = self._triage_with_llm(symptoms=symptoms, patient_age=patient_info_for_llm.get("age"), medical_history=medical_history_list, is_return_visit=context.is_return_visit, previous_diagnosis=None)
+        return triage_llm_result, patient_info_for_llm, patient_db_info
+
+    # --- 阶段/意图处理方法：返回 (回复内容, 下一阶段, 是否执行分诊) ---
+
+    def _handle_identity_reply(self, context: "ReceptionContext", user_message: str, consultation_id: str, patient_updates: Dict[str, Dict[str, Any]]) -> Tuple[str, str, bool]:
+        """处理用户对身份问题（手机号、是否复诊）的回复，需要更新的患者信息写入 patient_updates"""
+        patient_id = context.patient_id
+        logger.info("处理用户对身份问题的回复 (Consultation: %s)", consultation_id)
+        identity_info = self._extract_identity_info(user_message)
+        phone = identity_info.get("phone")
+        is_return_indicated = identity_info.get("is_return_visit_indicated")
+        additional_symptoms = identity_info.get("additional_symptoms", [])
+        context.phone_provided = phone
+        found_patient_id = None
+        if phone: found_patient_id = self.memory_system.find_patient_by_phone(phone)
+        if found_patient_id:
+            logger.info("找到匹配手机号的患者: %s。更新上下文。", found_patient_id)
+            context.patient_id = found_patient_id
+            patient_id = found_patient_id
+            context.identity_confirmed = True
+            context.is_return_visit = False if is_return_indicated is False else True
+            patient_updates[patient_id] = {"phone": phone, "last_web_consultation_id": consultation_id}
+        else:
+            logger.info("未找到匹配手机号的患者，或未提供手机号。将使用当前ID: %s", patient_id)
+            context.identity_confirmed = False
+            context.is_return_visit = True if is_return_indicated is True else False
+            if phone: patient_updates[patient_id] = {"phone": phone, "source": "web", "first_consultation_id": consultation_id}
+        context.extracted_symptoms = _merge_symptoms(context.extracted_symptoms, additional_symptoms)
+        if context.extracted_symptoms and context.extracted_symptoms != ["用户描述不清晰"]: 
+            logger.info("身份信息处理完毕，症状充分，准备分诊 (Patient: %s)", patient_id)
+            return DEFAULT_REPLY, STAGE_TRIAGE, True
+        logger.info("身份信息处理完毕，但症状仍不足，需要引导 (Patient: %s)", patient_id)
+        context.guidance_given = True
+        return "谢谢您的信息。为了能准确地为您分诊，请您再尽量详细地描述一下您的症状，例如主要不适是什么？持续多久了？", STAGE_GUIDING, False
+
+    def _handle_general_chat(self, context: "ReceptionContext", user_message: str, intent_result: Dict[str, Any]) -> Tuple[str, str, bool]:
+        """处理闲聊/找医生意图"""
+        patient_id = context.patient_id
+        # 计数闲聊或者非诊疗相关对话的轮次
+        context.off_topic_turns += 1
+        context.chat_turns += 1
+        logger.info("处理闲聊/找医生意图，当前轮次: %s，与诊断无关对话轮次: %s", context.chat_turns, context.off_topic_turns)
+        
+        # 检查是否超过了闲聊的最大轮数 - 注意这里是 >= 而不是 >
+        if context.off_topic_turns >= MAX_CHAT_TURNS:
+            # 超过等于3轮闲聊，返回标准回复
+            logger.info("用户闲聊已达%s轮，返回标准回复 (Patient: %s)", MAX_CHAT_TURNS, patient_id)
+            return self.off_topic_response, STAGE_CHAT_ENDED, False
+        if context.chat_turns > MAX_CHAT_TURNS:
+            return "非常抱歉，我们已经聊了几句了。如果您有身体不适需要咨询，请详细描述您的症状，否则我需要优先处理其他患者的请求。", STAGE_CHAT_ENDED, False
+        cached_reply = self._chat_reply_cache.get(user_message)
+        if cached_reply is not None:
+            logger.debug("闲聊回复缓存命中 (Patient: %s)", patient_id)
+            return cached_reply, STAGE_CHATTING, False
+        chat_prompt = f"""你是一个专业、有礼貌的医院接待员。用户刚才说："{user_message}"。请给出一个简洁、专业、乐于助人但【绝对不涉及】具体医疗建议或诊断的回复。如果是找特定医生，请礼貌地告知用户需要先描述症状以便系统分诊安排，我们无法直接指定医生。回复请少于50字。"""
+        try: 
+            response_message = self._llm_generate(chat_prompt, temperature=0.6, max_tokens=100)
+            if response_message and not response_message.startswith(LLM_ERROR_PREFIX):
+                self._chat_reply_cache.set(user_message, response_message)
+        except Exception as llm_err: 
+            logger.error(f"生成闲聊回复失败: {llm_err}")
+            response_message = "好的，我知道了。如果您有身体不适，请告诉我您的症状。"
+        return response_message, STAGE_CHATTING, False
+
+    def _handle_medical_inquiry(self, context: "ReceptionContext", user_message: str, intent_result: Dict[str, Any]) -> Tuple[str, str, bool]:
+        """处理医疗咨询意图（或尚未询问身份时用户主动提供身份）：先询问身份，已询问过则分诊或引导补充症状"""
+        patient_id = context.patient_id
+        if not context.identity_asked: 
+            logger.info("识别到医疗意图或提前提供身份，准备询问/确认身份信息 (Patient: %s)", patient_id)
+            context.identity_asked = True
+            return "了解您身体不适。为了更好地帮助您（特别是如果您之前来过），请问您的手机号码是多少？这次是复诊吗？", STAGE_ASKING_IDENTITY, False
+        if context.extracted_symptoms and context.extracted_symptoms != ["用户描述不清晰"]: 
+            logger.info("已有身份信息，且当前消息补充了足够症状，准备分诊。")
+            return DEFAULT_REPLY, STAGE_TRIAGE, True
+        if not context.guidance_given: 
+            logger.info("已有身份信息，但信息仍不足，提供引导 (Patient: %s)", patient_id)
+            context.guidance_given = True
+            return """谢谢。为了能准确地为您分诊，请您尽量详细地描述一下您的症状，例如：
+- 主要不适是什么？（如：头痛、咳嗽、腹泻）
+- 这种不适持续多久了？
+- 有没有其他伴随症状？（如：发烧、乏力、恶心）""", STAGE_GUIDING, False
+        return "抱歉，我仍然需要您描述一下具体哪里不舒服才能继续。请告诉我您的主要症状。", STAGE_GUIDING, False
+
+    def _handle_providing_identity(self, context: "ReceptionContext", user_message: str, intent_result: Dict[str, Any]) -> Tuple[str, str, bool]:
+        """处理用户提供身份信息的意图：尚未询问身份时按医疗咨询处理"""
+        if not context.identity_asked:
+            return self._handle_medical_inquiry(context, user_message, intent_result)
+        logger.warning(f"User provided identity info again? Re-processing identity. (Consultation: {context.consultation_id})")
+        identity_info = self._extract_identity_info(user_message)  # Process again
+        # ... potentially repeat logic from STAGE_ASKING_IDENTITY block ...
+        if context.extracted_symptoms and context.extracted_symptoms != ["用户描述不清晰"]: 
+            return DEFAULT_REPLY, STAGE_TRIAGE, True
+        return "谢谢您再次提供信息。请问您具体哪里不舒服？", STAGE_GUIDING, False
+
+    def _handle_asking_guidance(self, context: "ReceptionContext", user_message: str, intent_result: Dict[str, Any]) -> Tuple[str, str, bool]:
+        """处理意图不清或寻求引导"""
+        logger.info("用户意图不清或寻求引导 (Patient: %s)", context.patient_id)
+        if not context.identity_asked and not context.extracted_symptoms: 
+            context.identity_asked = True
+            return "您好，请问您哪里不舒服？为了更好地帮助您，也请告知您的手机号以及是否复诊。", STAGE_ASKING_IDENTITY, False
+        return "嗯，请问您具体哪里不舒服呢？或者您想咨询什么问题？请尽量详细描述，以便我能更好地帮助您。", STAGE_CLARIFICATION, False
+
+    def _handle_intent_error(self, context: "ReceptionContext", user_message: str, intent_result: Dict[str, Any]) -> Tuple[str, str, bool]:
+        """意图识别失败"""
+        return f"抱歉，系统在理解您意图的时候好像出了点问题 ({intent_result.get('message')})。您能换种方式再说一遍吗？或者直接告诉我您的症状？", STAGE_ERROR, False
+
     def _process_message(self, message: Dict[str, Any]) -> Dict[str, Any]:
         content = message.get("content", {})
         sender_id = message.get("sender_id", "unknown")
@@ -166,7 +467,11 @@ class ReceptionistAgent(BaseAgent):
             return self.send_message(sender_id, {"status": "error", "message": "接待员内部服务错误，无法处理请求。"})
 
         user_message = ""; patient_id = None; consultation_id = None; context = None
-        request_type = next((key for key in ["reception_request", "followup_query", "general_query"] if key in content), None)
+        request_type = None
+        for key in REQUEST_KEYS:
+            if key in content:
+                request_type = key
+                break
 
         if request_type:
             request_data = content[request_type]
@@ -176,18 +481,18 @@ class ReceptionistAgent(BaseAgent):
             if not consultation_id: 
                 logger.error(f"请求类型 '{request_type}' 缺少 consultation_id/context_id")
                 return self.send_message(sender_id, {"status": "error", "message": "内部错误：缺少会话标识。"})
-            context = self.memory_system.get_consultation_context(consultation_id)
-            if not context:
+            stored_context = self.memory_system.get_consultation_context(consultation_id)
+            if not stored_context:
                 if request_type == "reception_request":
-                    logger.info(f"为咨询 {consultation_id} (Patient: {patient_id}) 创建新上下文")
-                    context = {"patient_id": patient_id,"consultation_id": consultation_id,"stage": STAGE_INTENT,"chat_turns": 0,"conversation_snippets": [],"patient_info_from_web": request_data,"extracted_symptoms": request_data.get("symptoms", []),"guidance_given": False,"identity_asked": False,"identity_confirmed": False,"is_return_visit": None,"phone_provided": None}
-                    self.memory_system.save_consultation_context(consultation_id, context)
+                    logger.info("为咨询 %s (Patient: %s) 创建新上下文", consultation_id, patient_id)
+                    context = ReceptionContext(patient_id=patient_id, consultation_id=consultation_id, patient_info_from_web=request_data, extracted_symptoms=list(request_data.get("symptoms", [])))
                 else: 
                     logger.error(f"找不到咨询上下文 {consultation_id} 用于后续消息")
                     return self.send_message(sender_id, {"status": "error", "message": f"会话已过期或无效 (ID: {consultation_id})"})
             else: 
-                logger.info(f"找到现有上下文 {consultation_id}, 当前阶段: {context.get('stage')}")
-                patient_id = context.get("patient_id", patient_id)
+                context = ReceptionContext.from_dict(stored_context)
+                logger.info("找到现有上下文 %s, 当前阶段: %s", consultation_id, context.stage)
+                patient_id = context.patient_id or patient_id
         else: 
             logger.warning(f"接待员收到未知类型的消息: {list(content.keys())}")
             return self.send_message(sender_id, {"status": "unhandled", "message": "接待员无法处理此请求类型。"})
@@ -196,155 +501,67 @@ class ReceptionistAgent(BaseAgent):
             logger.error(f"处理失败：缺少用户信息或消息内容 (Patient: {patient_id}, Msg: '{user_message[:20]}...')")
             return self.send_message(sender_id, {"status": "error", "message": "请求缺少用户信息或消息内容。"})
 
-        context.setdefault("conversation_snippets", []).append(f"User: {user_message}")
-        context["conversation_snippets"] = context["conversation_snippets"][-6:]
-        self.memory_system.add_conversation_entry(context["patient_id"], "patient", user_message, metadata={"consultation_id": consultation_id, "agent_role": self.role})
+        context.conversation_snippets.append(f"User: {user_message}")
+        # 本轮的写入先在本地累积，回合结束时通过 commit_turn 一次提交
+        turn_entries = [{"patient_id": context.patient_id, "role": "patient", "content": user_message,
+                         "metadata": {"consultation_id": consultation_id, "agent_role": self.role, "timestamp_utc": datetime.now(timezone.utc).isoformat()}}]
+        patient_updates: Dict[str, Dict[str, Any]] = {}
 
-        current_stage = context.get("stage", STAGE_INTENT)
-        response_message = "抱歉，我暂时无法处理您的请求，请稍后再试。"
-        next_stage = current_stage
+        current_stage = context.stage
         reception_result_data = None
         should_end_reception = False
-        execute_triage = False
-
-        if current_stage == STAGE_ASKING_IDENTITY:
-            logger.info(f"处理用户对身份问题的回复 (Consultation: {consultation_id})")
-            identity_info = self._extract_identity_info(user_message)
-            phone = identity_info.get("phone")
-            is_return_indicated = identity_info.get("is_return_visit_indicated")
-            additional_symptoms = identity_info.get("additional_symptoms", [])
-            context["phone_provided"] = phone
-            found_patient_id = None
-            if phone: found_patient_id = self.memory_system.find_patient_by_phone(phone)
-            if found_patient_id:
-                logger.info(f"找到匹配手机号的患者: {found_patient_id}。更新上下文。")
-                context["patient_id"] = found_patient_id
-                patient_id = found_patient_id
-                context["identity_confirmed"] = True
-                context["is_return_visit"] = False if is_return_indicated is False else True
-                self.memory_system.add_or_update_patient_info(patient_id, {"phone": phone, "last_web_consultation_id": consultation_id})
-            else:
-                logger.info(f"未找到匹配手机号的患者，或未提供手机号。将使用当前ID: {patient_id}")
-                context["identity_confirmed"] = False
-                context["is_return_visit"] = True if is_return_indicated is True else False
-                if phone: self.memory_system.add_or_update_patient_info(patient_id, {"phone": phone, "source": "web", "first_consultation_id": consultation_id})
-            current_symptoms = set(context.get("extracted_symptoms", []))
-            current_symptoms.update(additional_symptoms)
-            context["extracted_symptoms"] = list(s for s in current_symptoms if s)
-            if context["extracted_symptoms"] and context["extracted_symptoms"] != ["用户描述不清晰"]: 
-                logger.info(f"身份信息处理完毕，症状充分，准备分诊 (Patient: {patient_id})")
-                execute_triage = True
-                next_stage = STAGE_TRIAGE
-            else: 
-                logger.info(f"身份信息处理完毕，但症状仍不足，需要引导 (Patient: {patient_id})")
-                response_message = "谢谢您的信息。为了能准确地为您分诊，请您再尽量详细地描述一下您的症状，例如主要不适是什么？持续多久了？"
-                next_stage = STAGE_GUIDING
-                context["guidance_given"] = True
+        speculative_triage = None # (Future, 发起时使用的症状列表)
+
+        stage_handler = self._STAGE_HANDLERS.get(current_stage)
+        if stage_handler:
+            response_message, next_stage, execute_triage = getattr(self, stage_handler)(context, user_message, consultation_id, patient_updates)
+            patient_id = context.patient_id or patient_id # 身份确认后可能切换为已有患者的 ID
         else:
-            intent_result = self._determine_intent_and_extract(user_message, patient_id, context)
+            normalized_message = normalize_text(user_message)
+            if len(normalized_message) <= GREETING_MAX_CHARS and GREETING_RE.fullmatch(normalized_message):
+                logger.debug("寒暄消息，跳过意图识别 LLM 调用 (Patient: %s)", patient_id)
+                intent_result = dict(GREETING_INTENT)
+            else:
+                # 已询问过身份且已有症状时，本轮很可能直接分诊：与意图识别并行预先发起分诊
+                known_symptoms = context.extracted_symptoms or []
+                if context.identity_asked and current_stage in SPECULATIVE_TRIAGE_STAGES \
+                        and known_symptoms and known_symptoms != ["用户描述不清晰"]:
+                    known_symptoms = list(known_symptoms)
+                    # 后台线程使用上下文快照：主线程本轮仍会修改 context，_run_triage 读取的字典也单独复制
+                    snapshot = replace(context, patient_info_from_web=dict(context.patient_info_from_web))
+                    speculative_triage = (_TRIAGE_POOL.submit(self._run_triage, snapshot, patient_id, known_symptoms), known_symptoms)
+                intent_result = self._determine_intent_and_extract(user_message, patient_id, context)
             intent = intent_result.get("intent", "error")
-            current_symptoms = set(context.get("extracted_symptoms", []))
-            current_symptoms.update(intent_result.get("extracted_symptoms", []))
-            context["extracted_symptoms"] = list(s for s in current_symptoms if s)
-            if intent in ["general_chat", "seeking_specific_doctor"]:
-                # 计数闲聊或者非诊疗相关对话的轮次
-                context["off_topic_turns"] = context.get("off_topic_turns", 0) + 1
-                context["chat_turns"] = context.get("chat_turns", 0) + 1
-                logger.info(f"处理闲聊/找医生意图，当前轮次: {context['chat_turns']}，与诊断无关对话轮次: {context['off_topic_turns']}")
-                
-                # 检查是否超过了闲聊的最大轮数 - 注意这里是 >= 而不是 >
-                if context["off_topic_turns"] >= MAX_CHAT_TURNS:
-                    # 超过等于3轮闲聊，返回标准回复
-                    logger.info(f"用户闲聊已达{MAX_CHAT_TURNS}轮，返回标准回复 (Patient: {patient_id})")
-                    response_message = self.off_topic_response
-                    next_stage = STAGE_CHAT_ENDED
-                elif context["chat_turns"] <= MAX_CHAT_TURNS:
-                    chat_prompt = f"""你是一个专业、有礼貌的医院接待员。用户刚才说："{user_message}"。请给出一个简洁、专业、乐于助人但【绝对不涉及】具体医疗建议或诊断的回复。如果是找特定医生，请礼貌地告知用户需要先描述症状以便系统分诊安排，我们无法直接指定医生。回复请少于50字。"""
-                    try: 
-                        response_message = self.llm_service.generate_response(chat_prompt, temperature=0.6, max_tokens=100)
-                    except Exception as llm_err: 
-                        logger.error(f"生成闲聊回复失败: {llm_err}")
-                        response_message = "好的，我知道了。如果您有身体不适，请告诉我您的症状。"
-                    next_stage = STAGE_CHATTING
-                else: 
-                    response_message = f"非常抱歉，我们已经聊了几句了。如果您有身体不适需要咨询，请详细描述您的症状，否则我需要优先处理其他患者的请求。"
-                    next_stage = STAGE_CHAT_ENDED
-            elif intent == "medical_inquiry" or (intent == "providing_identity" and not context.get("identity_asked")):
-                if not context.get("identity_asked"): 
-                    logger.info(f"识别到医疗意图或提前提供身份，准备询问/确认身份信息 (Patient: {patient_id})")
-                    response_message = "了解您身体不适。为了更好地帮助您（特别是如果您之前来过），请问您的手机号码是多少？这次是复诊吗？"
-                    context["identity_asked"] = True
-                    next_stage = STAGE_ASKING_IDENTITY
-                else:
-                    if context["extracted_symptoms"] and context["extracted_symptoms"] != ["用户描述不清晰"]: 
-                        logger.info("已有身份信息，且当前消息补充了足够症状，准备分诊。")
-                        execute_triage = True
-                        next_stage = STAGE_TRIAGE
-                    elif not context.get("guidance_given"): 
-                        logger.info(f"已有身份信息，但信息仍不足，提供引导 (Patient: {patient_id})")
-                        response_message = """谢谢。为了能准确地为您分诊，请您尽量详细地描述一下您的症状，例如：
-- 主要不适是什么？（如：头痛、咳嗽、腹泻）
-- 这种不适持续多久了？
-- 有没有其他伴随症状？（如：发烧、乏力、恶心）"""
-                        next_stage = STAGE_GUIDING
-                        context["guidance_given"] = True
-                    else: 
-                        response_message = "抱歉，我仍然需要您描述一下具体哪里不舒服才能继续。请告诉我您的主要症状。"
-                        next_stage = STAGE_GUIDING
-            elif intent == "providing_identity" and context.get("identity_asked"):
-                logger.warning(f"User provided identity info again? Re-processing identity. (Consultation: {consultation_id})")
-                identity_info = self._extract_identity_info(user_message)  # Process again
-                # ... potentially repeat logic from STAGE_ASKING_IDENTITY block ...
-                if context["extracted_symptoms"] and context["extracted_symptoms"] != ["用户描述不清晰"]: 
-                    execute_triage = True
-                    next_stage = STAGE_TRIAGE
-                else: 
-                    response_message = "谢谢您再次提供信息。请问您具体哪里不舒服？"
-                    next_stage = STAGE_GUIDING
-            elif intent in ["asking_guidance", "unclear"]:
-                logger.info(f"用户意图不清或寻求引导 (Patient: {patient_id})")
-                if not context.get("identity_asked") and not context.get("extracted_symptoms"): 
-                    response_message = "您好，请问您哪里不舒服？为了更好地帮助您，也请告知您的手机号以及是否复诊。"
-                    context["identity_asked"] = True
-                    next_stage = STAGE_ASKING_IDENTITY
-                else: 
-                    response_message = "嗯，请问您具体哪里不舒服呢？或者您想咨询什么问题？请尽量详细描述，以便我能更好地帮助您。"
-                    next_stage = STAGE_CLARIFICATION
-            elif intent == "error": 
-                response_message = f"抱歉，系统在理解您意图的时候好像出了点问题 ({intent_result.get('message')})。您能换种方式再说一遍吗？或者直接告诉我您的症状？"
-                next_stage = STAGE_ERROR
+            if speculative_triage and intent not in TRIAGE_INTENTS:
+                speculative_triage[0].cancel() # 本轮不会分诊，尚未开始则取消
+                speculative_triage = None
+            context.extracted_symptoms = _merge_symptoms(context.extracted_symptoms, intent_result.get("extracted_symptoms", []))
+            intent_handler = self._INTENT_HANDLERS.get(intent)
+            if intent_handler:
+                response_message, next_stage, execute_triage = getattr(self, intent_handler)(context, user_message, intent_result)
+            else:
+                response_message, next_stage, execute_triage = DEFAULT_REPLY, current_stage, False
 
         if execute_triage:
-            logger.info(f"执行分诊逻辑 (Patient: {patient_id})")
-            triage_input_symptoms = context.get("extracted_symptoms", [])
+            logger.info("执行分诊逻辑 (Patient: %s)", patient_id)
+            triage_input_symptoms = context.extracted_symptoms
             if not triage_input_symptoms or triage_input_symptoms == ["用户描述不清晰"]: 
                 response_message = "抱歉，我还是没能获取到您的具体症状描述。请告诉我哪里不舒服。"
                 next_stage = STAGE_GUIDING
-                context["guidance_given"] = False
+                context.guidance_given = False
             else:
-                patient_info_for_llm = {}
-                patient_db_info = None
-                if context.get("identity_confirmed"): 
-                    patient_db_info = self.memory_system.get_patient_info(patient_id)
-                    patient_info_for_llm = patient_db_info.copy() if patient_db_info else {}
-                else: 
-                    patient_info_for_llm = context.get("patient_info_from_web", {}).copy()
-                    patient_info_for_llm["name"] = patient_info_for_llm.get("patient_name", "网页用户")
-                medical_history_list = []
-                if context.get("identity_confirmed"):
-                    summaries = self.memory_system.get_consolidated_long_term_memories(patient_id, limit=2)
-                    medical_history_list = [f"过往诊断摘要: {s.get('summary',{}).get('key_diagnoses','N/A')}" for s in summaries]
-                    medical_history_list = medical_history_list or ["有就诊记录但无摘要"]
-                else: 
-                    medical_history_list = context.get("patient_info_from_web", {}).get("medical_history", [])
-                triage_llm_result = self._triage_with_llm(symptoms=triage_input_symptoms, patient_age=patient_info_for_llm.get("age"), medical_history=medical_history_list, is_return_visit=context.get("is_return_visit", False), previous_diagnosis=None)
+                if speculative_triage and speculative_triage[1] == triage_input_symptoms:
+                    logger.debug("使用预先发起的分诊结果 (Patient: %s)", patient_id)
+                    triage_llm_result, patient_info_for_llm, patient_db_info = speculative_triage[0].result()
+                else:
+                    if speculative_triage: speculative_triage[0].cancel() # 症状已变化，预先分诊作废
+                    triage_llm_result, patient_info_for_llm, patient_db_info = self._run_triage(context, patient_id, triage_input_symptoms)
                 if triage_llm_result.get("status") == "success":
                     determined_department = triage_llm_result["department"]
                     priority = triage_llm_result["priority"]
                     reason = triage_llm_result["reason"]
-                    priority_text_map = {"normal": "普通", "priority": "优先", "urgent": "紧急"}
-                    priority_text = priority_text_map.get(priority, "普通")
-                    visit_status_msg = "（已记录为复诊）" if context.get("is_return_visit") else "（已记录为初诊）"
+                    priority_text = PRIORITY_TEXT.get(priority, "普通")
+                    visit_status_msg = VISIT_STATUS_TEXT[bool(context.is_return_visit)]
                     response_message = f"好的，感谢您的信息{visit_status_msg}。根据您的描述 ({', '.join(triage_input_symptoms)}) 和初步分析，建议您挂 [{determined_department}] 科。系统评估的就诊优先级为：[{priority_text}]。正在为您安排后续流程... (理由: {reason})"
                     next_stage = STAGE_COMPLETED
                     should_end_reception = True
@@ -353,7 +570,7 @@ class ReceptionistAgent(BaseAgent):
                         "patient_id": patient_id,
                         "department": determined_department,
                         "priority": priority,
-                        "notes": f"分诊完成。身份确认: {context.get('identity_confirmed')}, 是否复诊: {context.get('is_return_visit')}, 电话提供: {'是' if context.get('phone_provided') else '否'}. LLM理由: {reason}",
+                        "notes": f"分诊完成。身份确认: {context.identity_confirmed}, 是否复诊: {context.is_return_visit}, 电话提供: {'是' if context.phone_provided else '否'}. LLM理由: {reason}",
                         "message": response_message,
                         "patient_info_final": patient_db_info or patient_info_for_llm
                     }
@@ -371,13 +588,17 @@ class ReceptionistAgent(BaseAgent):
                         "patient_info_final": patient_db_info or patient_info_for_llm
                     }
 
+        elif speculative_triage:
+            speculative_triage[0].cancel() # 本轮无需分诊（如闲聊），尚未开始则取消，已开始则忽略结果
+
         if execute_triage and reception_result_data: 
             response_message = reception_result_data.get("message", response_message)
 
-        context["stage"] = next_stage
-        context.setdefault("conversation_snippets", []).append(f"Receptionist: {response_message}")
-        context["conversation_snippets"] = context["conversation_snippets"][-6:]
-        self.memory_system.update_consultation_context(consultation_id, context)
+        context.stage = next_stage
+        context.conversation_snippets.append(f"Receptionist: {response_message}")
+        turn_entries.append({"patient_id": context.patient_id, "role": self.role, "content": response_message,
+                             "metadata": {"consultation_id": consultation_id, "next_stage": next_stage}})
+        self.memory_system.commit_turn(consultation_id, context.to_dict(), turn_entries, patient_updates=patient_updates)
 
         final_response_content = {
             "status": STAGE_COMPLETED if should_end_reception else "in_progress",
@@ -385,5 +606,4 @@ class ReceptionistAgent(BaseAgent):
             "next_stage": next_stage,
             "reception_result": reception_result_data
         }
-        self.memory_system.add_conversation_entry(context["patient_id"], self.role, response_message, metadata={"consultation_id": consultation_id, "next_stage": next_stage})
         return self.send_message(sender_id, final_response_content)
@@ -6,6 +6,8 @@
 """
 
 import logging
+import random
+import threading
 from datetime import datetime, timedelta
 import json
 from typing import Dict, List, Any, Optional, Tuple
@@ -13,9 +15,19 @@ from .base_agent import BaseAgent
 
 logger = logging.getLogger("Hospital-MultiAgent-System")
 
+# --- 每日时间槽模板（每天相同，模块加载时生成一次，各日期共享同一对象） ---
+MORNING_SLOTS: Tuple[str, ...] = tuple(f"{h:02d}:{m:02d}" for h in range(9, 12) for m in (0, 30))
+AFTERNOON_SLOTS: Tuple[str, ...] = tuple(f"{h:02d}:{m:02d}" for h in range(14, 17) for m in (0, 30))
+SLOT_TEMPLATE: Tuple[str, ...] = MORNING_SLOTS + AFTERNOON_SLOTS # 按时间先后排列
+SLOT_INDEX: Dict[str, int] = {slot: i for i, slot in enumerate(SLOT_TEMPLATE)} # 时间 -> 位序号
+FULL_SLOT_MASK = (1 << len(SLOT_TEMPLATE)) - 1
+BOOKING_DAYS = 7 # 开放未来 7 天的预约
+
 class SchedulerAgent(BaseAgent):
     """调度器智能体，负责医疗资源分配和流程调度"""
-    
+
+    __slots__ = ("_sched_lock",)
+
     def __init__(self, name: str = "调度器", memory_system = None):
         """
         初始化调度器智能体
@@ -25,6 +37,8 @@ class SchedulerAgent(BaseAgent):
             memory_system: 记忆系统对象
         """
         super().__init__(name=name, role="scheduler", memory_system=memory_system)
+        # 查找空闲时间槽、分配诊室与写入预约必须在同一临界区内完成，否则并发请求可能预约到同一时间槽
+        self._sched_lock = threading.Lock()
         self._initialize_resources()
     
     def _initialize_resources(self):
@@ -52,22 +66,35 @@ class SchedulerAgent(BaseAgent):
             {"id": "R007", "type": "treatment", "busy": False}
         ]
         
-        # 模拟时间槽
+        # 模拟时间槽：各日期直接引用模块级模板，不再逐日重新格式化
         current_date = datetime.now().date()
         time_slots = {}
-        for day_offset in range(7):  # 未来7天的预约时间槽
+        for day_offset in range(BOOKING_DAYS):
             date = current_date + timedelta(days=day_offset)
             date_str = date.strftime("%Y-%m-%d")
-            time_slots[date_str] = {
-                "morning": [f"{h:02d}:{m:02d}" for h in range(9, 12) for m in [0, 30]],
-                "afternoon": [f"{h:02d}:{m:02d}" for h in range(14, 17) for m in [0, 30]]
-            }
+            time_slots[date_str] = {"morning": MORNING_SLOTS, "afternoon": AFTERNOON_SLOTS}
+        
+        # 按专科/类型建立索引（列表中的元素与 doctors/rooms 为同一对象，状态变化同步可见）
+        doctors_by_specialty: Dict[str, List[Dict[str, Any]]] = {}
+        for doctor in doctors:
+            doctors_by_specialty.setdefault(doctor["specialty"], []).append(doctor)
+        # 同专科医生按初始化时随机确定的优先级排列（RANKING 在线匹配）：同一时间有多位医生可用时选优先级最高者，
+        # 而不是固定偏向录入顺序靠前的医生
+        for candidates in doctors_by_specialty.values():
+            random.shuffle(candidates)
+        rooms_by_type: Dict[str, List[Dict[str, Any]]] = {}
+        for room in rooms:
+            rooms_by_type.setdefault(room["type"], []).append(room)
         
         # 存储资源到内存
         self.update_memory("doctors", doctors)
         self.update_memory("rooms", rooms)
+        self.update_memory("doctors_by_specialty", doctors_by_specialty)
+        self.update_memory("rooms_by_type", rooms_by_type)
         self.update_memory("time_slots", time_slots)
         self.update_memory("appointments", {})
+        # (医生ID, 日期) -> 占用位图，第 k 位为 1 表示 SLOT_TEMPLATE[k] 已有预约；与 appointments 同步维护
+        self.update_memory("slot_masks", {})
     
     def _process_message(self, message: Dict[str, Any]) -> Dict[str, Any]:
         """处理接收到的消息"""
@@ -105,55 +132,57 @@ class SchedulerAgent(BaseAgent):
         preferred_date = request.get("preferred_date", "")
         preferred_time = request.get("preferred_time", "")
         
-        # 查找适合的医生
-        doctor, available_slot = self._find_available_doctor_and_slot(
-            department, preferred_date, preferred_time
-        )
-        
-        if not doctor or not available_slot:
-            return self.send_message(
-                message.get("sender_id", "unknown"),
-                {
-                    "status": "scheduling_failed",
+        failure_message = None
+        with self._sched_lock:
+            # 查找适合的医生
+            doctor, available_slot = self._find_available_doctor_and_slot(
+                department, preferred_date, preferred_time
+            )
+            
+            if not doctor or not available_slot:
+                failure_message = "抱歉，指定时间没有可用的医生。请尝试其他时间。"
+            else:
+                # 安排诊室
+                room = self._allocate_room("consultation")
+                if not room:
+                    failure_message = "抱歉，目前没有可用的诊室。"
+            
+            if failure_message is None:
+                # 创建预约记录
+                appointment = {
+                    "appointment_id": f"A{patient_id[1:]}",
                     "patient_id": patient_id,
-                    "message": "抱歉，指定时间没有可用的医生。请尝试其他时间。"
+                    "doctor_id": doctor["id"],
+                    "doctor_name": doctor["name"],
+                    "department": department,
+                    "date": available_slot[0],
+                    "time": available_slot[1],
+                    "room_id": room["id"],
+                    "status": "scheduled"
                 }
-            )
-        
-        # 安排诊室
-        room = self._allocate_room("consultation")
-        
-        if not room:
+                
+                # 保存预约记录：本地记忆保存的是对象引用，原地修改即可生效，无需整体写回
+                appointments = self.get_memory("appointments")
+                slot_masks = self.get_memory("slot_masks")
+                previous = appointments.get(appointment["appointment_id"])
+                if previous: # 同一预约号被覆盖时释放原时间槽
+                    previous_key = (previous["doctor_id"], previous["date"])
+                    slot_masks[previous_key] = slot_masks.get(previous_key, 0) & ~(1 << SLOT_INDEX[previous["time"]])
+                appointments[appointment["appointment_id"]] = appointment
+                key = (doctor["id"], available_slot[0])
+                # 医生与诊室仍然可用，只是在该时间点有预约，占用情况仅由 slot_masks 记录
+                slot_masks[key] = slot_masks.get(key, 0) | (1 << SLOT_INDEX[available_slot[1]])
+        
+        if failure_message is not None:
             return self.send_message(
                 message.get("sender_id", "unknown"),
                 {
                     "status": "scheduling_failed",
                     "patient_id": patient_id,
-                    "message": "抱歉，目前没有可用的诊室。"
+                    "message": failure_message
                 }
             )
         
-        # 创建预约记录
-        appointment = {
-            "appointment_id": f"A{patient_id[1:]}",
-            "patient_id": patient_id,
-            "doctor_id": doctor["id"],
-            "doctor_name": doctor["name"],
-            "department": department,
-            "date": available_slot[0],
-            "time": available_slot[1],
-            "room_id": room["id"],
-            "status": "scheduled"
-        }
-        
-        # 保存预约记录
-        appointments = self.get_memory("appointments", {})
-        appointments[appointment["appointment_id"]] = appointment
-        self.update_memory("appointments", appointments)
-        
-        # 更新资源状态
-        self._update_resource_status(doctor["id"], room["id"], available_slot)
-        
         # 构造响应
         return self.send_message(
             message.get("sender_id", "unknown"),
@@ -266,12 +295,12 @@ class SchedulerAgent(BaseAgent):
         Returns:
             医生信息和可用时间槽 (日期, 时间)
         """
-        doctors = self.get_memory("doctors", [])
         time_slots = self.get_memory("time_slots", {})
-        appointments = self.get_memory("appointments", {})
+        slot_masks = self.get_memory("slot_masks", {})
         
         # 按科室筛选医生
-        available_doctors = [d for d in doctors if d["specialty"] == department and d["available"]]
+        candidates = self.get_memory("doctors_by_specialty", {}).get(department, [])
+        available_doctors = [d for d in candidates if d["available"]]
         
         if not available_doctors:
             return None, None
@@ -287,49 +316,28 @@ class SchedulerAgent(BaseAgent):
                 return None, None
             preferred_date = dates[0]
         
-        available_slots = []
-        
-        # 获取指定日期的时间槽
-        day_slots = time_slots.get(preferred_date, {})
-        
-        # 合并上午和下午的时间槽
-        all_slots = day_slots.get("morning", []) + day_slots.get("afternoon", [])
-        
         # 如果指定了首选时间，优先考虑
-        if preferred_time:
-            # 检查首选时间是否可用
+        preferred_index = SLOT_INDEX.get(preferred_time)
+        if preferred_index is not None:
+            # 检查首选时间是否可用：医生当天位图中对应位为 0 即无预约
             for doctor in available_doctors:
-                # 检查医生在该时间是否已有预约
-                has_appointment = any(
-                    app["doctor_id"] == doctor["id"] and 
-                    app["date"] == preferred_date and 
-                    app["time"] == preferred_time
-                    for app in appointments.values()
-                )
-                
-                if not has_appointment and preferred_time in all_slots:
+                if not (slot_masks.get((doctor["id"], preferred_date), 0) >> preferred_index) & 1:
                     return doctor, (preferred_date, preferred_time)
         
-        # 如果首选时间不可用，查找其他可用时间
+        # 如果首选时间不可用，查找其他可用时间：空闲位图的最低位即该医生最早的空闲时间，
+        # 取各医生中最早者（时间相同时按医生顺序）
+        best_doctor, best_index = None, len(SLOT_TEMPLATE)
         for doctor in available_doctors:
-            for slot in all_slots:
-                # 检查医生在该时间是否已有预约
-                has_appointment = any(
-                    app["doctor_id"] == doctor["id"] and 
-                    app["date"] == preferred_date and 
-                    app["time"] == slot
-                    for app in appointments.values()
-                )
-                
-                if not has_appointment:
-                    available_slots.append((doctor, preferred_date, slot))
-        
-        # 按时间排序
-        available_slots.sort(key=lambda x: x[2])
-        
-        if available_slots:
-            return available_slots[0][0], (available_slots[0][1], available_slots[0][2])
-        
+            free = ~slot_masks.get((doctor["id"], preferred_date), 0) & FULL_SLOT_MASK
+            if free:
+                index = (free & -free).bit_length() - 1
+                if index < best_index:
+                    best_doctor, best_index = doctor, index
+                    if index == 0:
+                        break
+        
+        if best_doctor is not None:
+            return best_doctor, (preferred_date, SLOT_TEMPLATE[best_index])
         return None, None
     
     def _allocate_doctor(self, specialty: str) -> Optional[Dict[str, Any]]:
@@ -342,16 +350,10 @@ class SchedulerAgent(BaseAgent):
         Returns:
             医生信息或None
         """
-        doctors = self.get_memory("doctors", [])
-        
-        # 按专科筛选可用医生
-        available_doctors = [d for d in doctors if d["specialty"] == specialty and d["available"]]
-        
-        if not available_doctors:
-            return None
+        candidates = self.get_memory("doctors_by_specialty", {}).get(specialty, [])
         
         # 简单地返回第一个可用医生
-        return available_doctors[0]
+        return next((d for d in candidates if d["available"]), None)
     
     def _allocate_room(self, room_type: str) -> Optional[Dict[str, Any]]:
         """
@@ -363,40 +365,7 @@ class SchedulerAgent(BaseAgent):
         Returns:
             诊室信息或None
         """
-        rooms = self.get_memory("rooms", [])
-        
-        # 按类型筛选可用诊室
-        available_rooms = [r for r in rooms if r["type"] == room_type and not r["busy"]]
-        
-        if not available_rooms:
-            return None
+        candidates = self.get_memory("rooms_by_type", {}).get(room_type, [])
         
         # 简单地返回第一个可用诊室
-        return available_rooms[0]
-    
-    def _update_resource_status(self, doctor_id: str, room_id: str, time_slot: Tuple[str, str]):
-        """
-        更新资源状态
-        
-        Args:
-            doctor_id: 医生ID
-            room_id: 诊室ID
-            time_slot: 时间槽 (日期, 时间)
-        """
-        # 更新医生状态
-        doctors = self.get_memory("doctors", [])
-        for doctor in doctors:
-            if doctor["id"] == doctor_id:
-                # 医生仍然可用，但在特定时间点有预约
-                break
-        
-        self.update_memory("doctors", doctors)
-        
-        # 更新诊室状态
-        rooms = self.get_memory("rooms", [])
-        for room in rooms:
-            if room["id"] == room_id:
-                # 诊室仍然可用，但在特定时间点有预约
-                break
-        
-        self.update_memory("rooms", rooms)
\ No newline at end of file
+        return next((r for r in candidates if not r["busy"]), None)
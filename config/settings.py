@@ -6,10 +6,32 @@
 """
 
 import os
+import threading
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, Any
+from types import MappingProxyType
+from typing import Any, Mapping
 import warnings
 
+
+@lru_cache(maxsize=None)
+def _normalize_url(url: str) -> str:
+    """确保URL包含http/https协议前缀（结果按输入缓存，相同地址只规范化并告警一次）"""
+    if not url:
+        return ""
+    url = url.strip()
+    if not url.startswith(("http://", "https://")):
+        warnings.warn(f"URL '{url}' 缺少协议前缀，将默认添加 'https://'")
+        # 检查常见错误，如多了斜杠
+        if url.startswith("//"):
+             url = url[2:]
+        return "https://" + url
+    return url
+
+
+_EMPTY_CONFIG: Mapping[str, Any] = MappingProxyType({})
+
+
 class Settings:
     """系统配置类"""
 
@@ -50,8 +72,8 @@ class Settings:
             "deployment_name": os.environ.get("AZURE_OPENAI_DEPLOYMENT_NAME", ""),
         }
 
-        # --- 智能体配置 (可以保持不变) ---
-        self.agent_config = {
+        # --- 智能体配置 (只读映射，可在线程间直接共享，无需复制) ---
+        agent_config = {
             "receptionist": {
                 "name": os.environ.get("RECEPTIONIST_NAME", "李接待"),
             },
@@ -66,6 +88,10 @@ class Settings:
                 "name": os.environ.get("SCHEDULER_NAME", "调度器"),
             }
         }
+        self.agent_config: Mapping[str, Mapping[str, Any]] = MappingProxyType(
+            {agent_type: MappingProxyType(config) for agent_type, config in agent_config.items()}
+        )
+        self._llm_valid = None # validate_llm_config 的缓存结果（llm_config 初始化后不再修改）
 
         # --- 医疗流程配置 (可以保持不变) ---
         self.medical_workflows = {
@@ -88,37 +114,41 @@ class Settings:
         os.makedirs(self.data_dir, exist_ok=True)
         os.makedirs(self.log_dir, exist_ok=True)
 
-    def get_agent_config(self, agent_type: str) -> Dict[str, Any]:
-        """获取特定智能体的配置"""
-        return self.agent_config.get(agent_type, {})
+    def get_agent_config(self, agent_type: str) -> Mapping[str, Any]:
+        """获取特定智能体的配置（只读）"""
+        return self.agent_config.get(agent_type, _EMPTY_CONFIG)
 
     def validate_llm_config(self) -> bool:
-        """验证LLM配置是否有效"""
+        """验证LLM配置是否有效（首次调用后缓存结果）"""
+        if self._llm_valid is not None:
+            return self._llm_valid
         # api_version 不是严格必须的，因为库可能有默认值，但推荐配置
         required_fields = ["api_key", "endpoint", "deployment_name"]
         missing = [field for field in required_fields if not self.llm_config.get(field)]
         if missing:
              warnings.warn(f"LLM 配置缺失以下字段: {', '.join(missing)}")
-             return False
-        return True
+        self._llm_valid = not missing
+        return self._llm_valid
 
     def _ensure_url_protocol(self, url: str) -> str:
         """确保URL包含http/https协议前缀"""
-        if not url:
-            return ""
-        url = url.strip()
-        if not url.startswith(("http://", "https://")):
-            warnings.warn(f"URL '{url}' 缺少协议前缀，将默认添加 'https://'")
-            # 检查常见错误，如多了斜杠
-            if url.startswith("//"):
-                 url = url[2:]
-            return "https://" + url
-        return url
+        return _normalize_url(url)
 
     # 添加一个 get 方法以便像字典一样安全地获取配置
     def get(self, key: str, default: Any = None) -> Any:
         """安全地获取配置项"""
         return getattr(self, key, default)
 
-# 创建一个全局的配置实例供其他模块使用
-SETTINGS = Settings()
\ No newline at end of file
+# 全局配置实例供其他模块使用：首次访问 SETTINGS 时才创建（PEP 562 模块级 __getattr__），
+# 仅导入 Settings 类的模块（如 utils.llm_service）不会触发目录创建、环境变量读取与告警
+_settings_lock = threading.Lock()
+
+
+def __getattr__(name: str) -> Any:
+    if name == "SETTINGS":
+        global SETTINGS
+        with _settings_lock:
+            if "SETTINGS" not in globals():
+                SETTINGS = Settings()
+        return SETTINGS
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
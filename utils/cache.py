@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+进程内缓存工具：带过期时间（TTL）的线程安全 LRU 缓存、按文本相似度命中的近似匹配缓存，以及 LLM 提示词缓存键生成
+"""
+
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, FrozenSet, Hashable, Optional
+
+_TEXT_NOISE_RE = re.compile(r'[\W_]+')  # 空白与标点（含全角标点）
+
+
+class TTLCache:
+    """线程安全的 TTL + LRU 内存缓存，超过容量时淘汰最久未使用的条目"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600.0):
+        """
+        初始化缓存
+
+        Args:
+            maxsize: 最大条目数
+            ttl: 默认过期时间（秒）
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict() # key -> (过期时间, 值)
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """获取缓存值，不存在或已过期时返回 default"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires_at, value = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """写入缓存值，ttl 为空时使用默认过期时间"""
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """移除并返回缓存值（不检查是否过期）"""
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self) -> None:
+        """清空缓存"""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+def normalize_text(text: str) -> str:
+    """规范化文本用于匹配：NFKC 归一化，去除空白与标点，转小写"""
+    return _TEXT_NOISE_RE.sub("", unicodedata.normalize("NFKC", text)).lower()
+
+
+def _char_bigrams(text: str) -> FrozenSet[str]:
+    return frozenset(text[i:i + 2] for i in range(len(text) - 1)) or frozenset((text,))
+
+
+class SimilarityCache:
+    """
+    线程安全的近似匹配 LRU 缓存：规范化后的文本完全相同，或字符二元组 Jaccard 相似度不低于阈值时命中
+
+    适用于按用户提问复用回答的场景（无需向量模型）；阈值应足够高，使仅差一个否定词的问题不会命中。
+    """
+
+    def __init__(self, maxsize: int = 64, threshold: float = 0.93):
+        """
+        初始化缓存
+
+        Args:
+            maxsize: 最大条目数
+            threshold: 近似命中所需的最低 Jaccard 相似度
+        """
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self._data: "OrderedDict[str, tuple]" = OrderedDict() # 规范化文本 -> (字符二元组, 值)
+        self._lock = threading.Lock()
+
+    def get(self, text: str, default: Any = None) -> Any:
+        """查找完全相同或足够相似的文本对应的值，未命中时返回 default"""
+        key = normalize_text(text)
+        with self._lock:
+            if key not in self._data:
+                grams = _char_bigrams(key)
+                best_key, best_score = None, 0.0
+                for cached_key, (cached_grams, _) in self._data.items():
+                    score = len(grams & cached_grams) / len(grams | cached_grams)
+                    if score > best_score:
+                        best_key, best_score = cached_key, score
+                if best_key is None or best_score < self.threshold:
+                    return default
+                key = best_key
+            self._data.move_to_end(key)
+            return self._data[key][1]
+
+    def set(self, text: str, value: Any) -> None:
+        """写入文本对应的值"""
+        key = normalize_text(text)
+        with self._lock:
+            self._data[key] = (_char_bigrams(key), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+def make_prompt_key(prompt: str, system_message: str, temperature: float, max_tokens: int) -> str:
+    """
+    根据 LLM 调用参数生成缓存键
+
+    Args:
+        prompt: 用户提示
+        system_message: 系统消息
+        temperature: 温度参数
+        max_tokens: 最大令牌数
+
+    Returns:
+        形如 "llm:<32位十六进制摘要>" 的缓存键
+    """
+    digest = hashlib.blake2b(f"{system_message}|{temperature}|{max_tokens}|{prompt}".encode("utf-8"), digest_size=16).hexdigest()
+    return "llm:" + digest
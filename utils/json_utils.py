@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+JSON 序列化工具，优先使用 orjson（C 扩展），不可用时回退到标准库 json
+"""
+
+import json
+import logging
+from typing import Any
+
+try:
+    import orjson
+except ImportError:
+    orjson = None # type: ignore
+
+try:
+    import json_repair
+except ImportError:
+    json_repair = None # type: ignore
+
+logger = logging.getLogger("Hospital-MultiAgent-System")
+
+HAS_ORJSON = orjson is not None
+
+# 修复截断 JSON 时，最多向前回退丢弃的不完整元素个数
+_MAX_REPAIR_TRIMS = 8
+_CLOSERS = {"{": "}", "[": "]"}
+
+if HAS_ORJSON:
+    _ORJSON_DUMPS_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+
+def dumps_bytes(obj: Any, sort_keys: bool = False) -> bytes:
+    """
+    将对象序列化为 UTF-8 编码的 JSON 字节串（非 ASCII 字符原样保留，无法序列化的对象使用 str() 转换）
+
+    Args:
+        obj: 待序列化的对象
+        sort_keys: 是否按键排序（用于生成内容摘要等需要规范化输出的场景）
+
+    Returns:
+        UTF-8 编码的 JSON 字节串
+    """
+    if HAS_ORJSON:
+        try:
+            option = _ORJSON_DUMPS_OPTIONS | orjson.OPT_SORT_KEYS if sort_keys else _ORJSON_DUMPS_OPTIONS
+            return orjson.dumps(obj, default=str, option=option)
+        except TypeError as e:
+            # orjson 对部分输入（如超过 64 位的整数）更严格，回退到标准库
+            logger.debug(f"orjson 序列化失败，回退到标准库 json: {e}")
+    return json.dumps(obj, ensure_ascii=False, default=str, sort_keys=sort_keys).encode("utf-8")
+
+
+def dumps(obj: Any) -> str:
+    """
+    将对象序列化为 JSON 字符串，行为等同于 json.dumps(obj, ensure_ascii=False, default=str)
+
+    Args:
+        obj: 待序列化的对象
+
+    Returns:
+        JSON 字符串
+    """
+    if HAS_ORJSON:
+        return dumps_bytes(obj).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, default=str)
+
+
+def loads(data: Any) -> Any:
+    """
+    解析 JSON 字符串/字节串。orjson 解析失败时回退到标准库 json 重新解析，
+    这样既能接受标准库兼容的扩展写法（如 NaN），抛出的 json.JSONDecodeError 也保留标准库的错误信息
+
+    Args:
+        data: JSON 字符串或字节串
+
+    Returns:
+        解析后的对象
+
+    Raises:
+        json.JSONDecodeError: 内容不是合法的 JSON
+    """
+    if HAS_ORJSON:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+
+def _close_truncated_json(text: str) -> str:
+    """补全被截断的 JSON 文本：闭合未结束的字符串，去掉末尾悬空的逗号/冒号，并按嵌套顺序补齐括号"""
+    stack = []
+    in_string = escaped = False
+    for ch in text:
+        if in_string:
+            if escaped: escaped = False
+            elif ch == "\\": escaped = True
+            elif ch == '"': in_string = False
+        elif ch == '"': in_string = True
+        elif ch in _CLOSERS: stack.append(ch)
+        elif ch in "}]" and stack: stack.pop()
+    if in_string:
+        text = (text[:-1] if escaped else text) + '"'
+    text = text.rstrip()
+    while text and text[-1] in ",:":
+        text = text[:-1].rstrip()
+    return text + "".join(_CLOSERS[ch] for ch in reversed(stack))
+
+
+def loads_tolerant(text: str) -> Any:
+    """
+    解析可能不完整（如因 max_tokens 被截断）的 JSON 文本。先严格解析；失败时优先使用 json_repair（若已安装），
+    否则补全未闭合的字符串和括号后重试，仍失败则逐个丢弃末尾不完整的元素再重试
+
+    Args:
+        text: JSON 文本
+
+    Returns:
+        解析后的对象
+
+    Raises:
+        json.JSONDecodeError: 无法修复为合法的 JSON
+    """
+    try:
+        return loads(text)
+    except json.JSONDecodeError as e:
+        original_error = e
+    logger.warning(f"JSON 不完整或格式错误，尝试修复: {original_error}")
+    if json_repair is not None:
+        repaired = json_repair.loads(text)
+        if repaired not in ("", None): # json_repair 无法修复时返回空字符串
+            return repaired
+        raise original_error
+    candidate = text
+    for _ in range(_MAX_REPAIR_TRIMS):
+        try:
+            return loads(_close_truncated_json(candidate))
+        except json.JSONDecodeError:
+            cut = candidate.rfind(",")
+            if cut <= 0:
+                break
+            candidate = candidate[:cut]
+    raise original_error
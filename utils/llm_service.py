@@ -8,13 +8,19 @@ LLM服务类，用于与Azure OpenAI服务交互
 import os
 import json
 import logging
-from typing import Dict, List, Any, Optional, Union
+from typing import Dict, Iterator, List, Any, Optional, Union
 import asyncio
 from openai import AzureOpenAI
 from config.settings import Settings
 
 logger = logging.getLogger("Hospital-MultiAgent-System")
 
+# generate_response 调用失败时返回文本的前缀（调用方可据此识别失败响应，例如避免缓存）
+LLM_ERROR_PREFIX = "很抱歉，我无法处理您的请求"
+
+# response_format 简写 -> Chat Completions API 的 response_format 参数
+_RESPONSE_FORMATS = {"json": {"type": "json_object"}}
+
 class LLMService:
     """LLM服务类，处理与Azure OpenAI的交互"""
     
@@ -76,12 +82,50 @@ class LLMService:
                 logger.error(f"错误详情: {traceback.format_exc()}")
             raise
 
+    def _check_network(self):
+        """
+        检查到 Azure 端点的 DNS 解析和 TCP 连通性并记录日志。
+        只在调用出现网络错误时执行，正常调用复用客户端的 HTTP 连接池，不额外建立连接。
+        """
+        import socket
+        try:
+            # 尝试解析Azure端点的主机名
+            endpoint = self.llm_config.get("endpoint", "")
+            if endpoint:
+                from urllib.parse import urlparse
+                parsed_url = urlparse(endpoint)
+                hostname = parsed_url.netloc
+                ip = socket.gethostbyname(hostname)
+                logger.info(f"成功解析主机名 {hostname} 到 IP：{ip}")
+                
+                # 检查是否可以连接到端口
+                port = 443  # HTTPS默认端口
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.settimeout(5)
+                result = sock.connect_ex((hostname, port))
+                if result == 0:
+                    logger.info(f"成功连接到 {hostname}:{port}")
+                else:
+                    logger.warning(f"无法连接到 {hostname}:{port}，错误码：{result}")
+                sock.close()
+        except Exception as network_error:
+            logger.warning(f"网络检查失败: {str(network_error)}")
+
+    def _response_format_kwargs(self, response_format: Optional[str]) -> Dict[str, Any]:
+        """将 response_format 简写转换为 API 调用参数（未指定时不传该参数）"""
+        if not response_format:
+            return {}
+        if response_format not in _RESPONSE_FORMATS:
+            raise ValueError(f"不支持的 response_format: {response_format}")
+        return {"response_format": _RESPONSE_FORMATS[response_format]}
+
     def generate_response(
         self, 
         prompt: str, 
         system_message: str = "你是一个医疗助手，提供准确、专业的医疗建议。",
         max_tokens: int = 800,
-        temperature: float = 0.7
+        temperature: float = 0.7,
+        response_format: Optional[str] = None
     ) -> str:
         """
         生成LLM响应
@@ -91,6 +135,7 @@ class LLMService:
             system_message: 系统消息
             max_tokens: 最大令牌数
             temperature: 温度参数(创造性)
+            response_format: 为 "json" 时启用 JSON 模式，模型只返回合法的 JSON 对象（不含代码块标记）
         
         Returns:
             LLM生成的响应文本
@@ -102,31 +147,6 @@ class LLMService:
             logger.info(f"系统消息：{system_message[:50]}{'...' if len(system_message) > 50 else ''}")
             logger.info(f"提示词（前50个字符）：{prompt[:50]}{'...' if len(prompt) > 50 else ''}")
             
-            # 记录网络状态检查
-            import socket
-            try:
-                # 尝试解析Azure端点的主机名
-                endpoint = self.llm_config.get("endpoint", "")
-                if endpoint:
-                    from urllib.parse import urlparse
-                    parsed_url = urlparse(endpoint)
-                    hostname = parsed_url.netloc
-                    ip = socket.gethostbyname(hostname)
-                    logger.info(f"成功解析主机名 {hostname} 到 IP：{ip}")
-                    
-                    # 检查是否可以连接到端口
-                    port = 443  # HTTPS默认端口
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock.settimeout(5)
-                    result = sock.connect_ex((hostname, port))
-                    if result == 0:
-                        logger.info(f"成功连接到 {hostname}:{port}")
-                    else:
-                        logger.warning(f"无法连接到 {hostname}:{port}，错误码：{result}")
-                    sock.close()
-            except Exception as network_error:
-                logger.warning(f"网络检查失败: {str(network_error)}")
-            
             # 开始计时
             import time
             start_time = time.time()
@@ -139,7 +159,8 @@ class LLMService:
                     {"role": "user", "content": prompt}
                 ],
                 max_tokens=max_tokens,
-                temperature=temperature
+                temperature=temperature,
+                **self._response_format_kwargs(response_format)
             )
             
             # 记录响应时间和基本信息
@@ -169,17 +190,66 @@ class LLMService:
             # 网络错误特别处理
             if "Connection" in str(e) or "Timeout" in str(e) or "timeout" in str(e).lower():
                 logger.error("检测到网络连接问题，请检查您的网络连接和防火墙设置")
+                self._check_network()
                 if "proxy" in str(e).lower():
                     logger.error("可能与代理设置有关，请检查您的代理配置")
             
-            return f"很抱歉，我无法处理您的请求: {str(e)}"
+            return f"{LLM_ERROR_PREFIX}: {str(e)}"
+    
+    def generate_response_stream(
+        self,
+        prompt: str,
+        system_message: str = "你是一个医疗助手，提供准确、专业的医疗建议。",
+        max_tokens: int = 800,
+        temperature: float = 0.7,
+        response_format: Optional[str] = None
+    ) -> Iterator[str]:
+        """
+        流式生成LLM响应，逐段返回增量文本。调用方提前结束迭代（或关闭生成器）时会关闭底层连接
+        
+        Args:
+            prompt: 用户提示
+            system_message: 系统消息
+            max_tokens: 最大令牌数
+            temperature: 温度参数(创造性)
+            response_format: 为 "json" 时启用 JSON 模式
+        
+        Yields:
+            增量文本片段
+        
+        Raises:
+            Exception: API 调用失败时直接抛出（与 generate_response 不同，不返回错误提示文本）
+        """
+        deployment_name = self.llm_config.get("deployment_name")
+        logger.info(f"正在流式调用LLM API，模型：{deployment_name}，最大令牌：{max_tokens}，温度：{temperature}")
+        stream = self.client.chat.completions.create(
+            model=deployment_name,
+            messages=[
+                {"role": "system", "content": system_message},
+                {"role": "user", "content": prompt}
+            ],
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=True,
+            **self._response_format_kwargs(response_format)
+        )
+        try:
+            for chunk in stream:
+                if not chunk.choices: # Azure 会先发送不含 choices 的内容过滤结果
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+        finally:
+            stream.close()
     
     async def generate_response_async(
         self, 
         prompt: str, 
         system_message: str = "你是一个医疗助手，提供准确、专业的医疗建议。",
         max_tokens: int = 800,
-        temperature: float = 0.7
+        temperature: float = 0.7,
+        response_format: Optional[str] = None
     ) -> str:
         """
         异步生成LLM响应
@@ -189,6 +259,7 @@ class LLMService:
             system_message: 系统消息
             max_tokens: 最大令牌数
             temperature: 温度参数(创造性)
+            response_format: 为 "json" 时启用 JSON 模式，模型只返回合法的 JSON 对象（不含代码块标记）
         
         Returns:
             LLM生成的响应文本
@@ -200,7 +271,8 @@ class LLMService:
                 prompt=prompt,
                 system_message=system_message,
                 max_tokens=max_tokens,
-                temperature=temperature
+                temperature=temperature,
+                response_format=response_format
             )
         )
     
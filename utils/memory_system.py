@@ -8,10 +8,15 @@
 """
 
 import os
+import atexit
 import json
 import logging
 import uuid
 import re # <--- Added missing import
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from typing import Dict, List, Any, Optional, Tuple
 from datetime import datetime, timedelta, timezone
 
@@ -25,6 +30,13 @@ logger = logging.getLogger("Hospital-MultiAgent-System")
 DEFAULT_MEMORY_PATH = "data/hospital_memory_web.json" # Using separate file for web
 SHORT_TERM_HOURS = 24
 
+
+def _json_default(obj: Any) -> Any:
+    """持久化时的序列化回退：集合和双端队列转为列表（如问诊上下文中的症状集合、最近对话片段），其他对象转为字符串"""
+    if isinstance(obj, (set, frozenset, deque)):
+        return list(obj)
+    return str(obj)
+
 class MemorySystem:
     """记忆系统，管理患者信息、问诊记录、对话历史等"""
 
@@ -37,6 +49,14 @@ class MemorySystem:
         self._memory.setdefault("patients", {})
         self._memory.setdefault("global_events", [])
         self._memory.setdefault("active_consultations", {})
+        # 每个线程各自的 pipeline() 嵌套深度与脏标记：深度大于 0 时该线程的写操作只标记为脏，
+        # 退出该线程最外层 pipeline 时统一落盘；其他线程的普通写操作不受影响，照常立即落盘
+        self._pipeline_state = threading.local()
+        # 所有落盘操作都经由单线程写入器按提交顺序执行，后台写入不会被更早的快照覆盖
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory-writer")
+        self._pending_writes: set = set()
+        # 进程退出前等待排队中的后台写入落盘，避免丢失最后几次保存
+        atexit.register(self.flush_pending_writes)
         logger.info(f"记忆系统初始化完成。持久化路径: {persistence_path or '无'}")
         if not llm_service:
              logger.warning("LLM 服务未提供给 MemorySystem，记忆归纳功能将不可用。")
@@ -70,17 +90,67 @@ class MemorySystem:
                 logger.error(f"加载记忆文件 '{self.persistence_path}' 失败: {e}，将使用空记忆。")
         return {"patients": {}, "global_events": [], "active_consultations": {}}
 
-    def _save_memory(self):
+    @contextmanager
+    def pipeline(self, background: bool = False):
+        """
+        批量写入：块内的多次写操作（保存上下文、添加记忆、添加对话等）只在退出最外层块时落盘一次
+
+        Args:
+            background: 为 True 时落盘在后台线程完成，调用方无需等待文件写入（内存中的数据已即时更新）
+
+        用法:
+            with memory_system.pipeline():
+                memory_system.save_consultation_context(...)
+                memory_system.add_patient_memory(...)
+        """
+        state = self._pipeline_state
+        state.depth = getattr(state, "depth", 0) + 1
+        try:
+            yield self
+        finally:
+            state.depth -= 1
+            if state.depth == 0 and getattr(state, "dirty", False):
+                state.dirty = False
+                self._save_memory(background=background)
+
+    def _save_memory(self, background: bool = False):
+        state = self._pipeline_state
+        if getattr(state, "depth", 0):
+            state.dirty = True
+            return
         if self.persistence_path:
             try:
-                os.makedirs(os.path.dirname(self.persistence_path), exist_ok=True)
-                with open(self.persistence_path, 'w', encoding='utf-8') as f:
-                    json.dump(self._memory, f, indent=2, ensure_ascii=False, default=str)
-                logger.debug(f"记忆已保存到 {self.persistence_path}")
-            except IOError as e:
-                logger.error(f"保存记忆文件 '{self.persistence_path}' 失败: {e}")
+                # 在调用线程上序列化，得到当前时刻的一致快照；文件写入交给写入线程
+                # 每次落盘都重写整个文件，使用紧凑格式减小写入量（不缩进、分隔符后不加空格）
+                data = json.dumps(self._memory, ensure_ascii=False, separators=(",", ":"), default=_json_default)
             except TypeError as e:
                  logger.error(f"序列化记忆时失败: {e}", exc_info=True)
+                 return
+            future = self._writer.submit(self._write_memory_file, data)
+            if background:
+                self._pending_writes.add(future)
+                future.add_done_callback(self._on_write_done)
+            else:
+                future.result()
+
+    def _write_memory_file(self, data: str):
+        try:
+            os.makedirs(os.path.dirname(self.persistence_path), exist_ok=True)
+            with open(self.persistence_path, 'w', encoding='utf-8') as f:
+                f.write(data)
+            logger.debug(f"记忆已保存到 {self.persistence_path}")
+        except IOError as e:
+            logger.error(f"保存记忆文件 '{self.persistence_path}' 失败: {e}")
+
+    def _on_write_done(self, future: Future):
+        self._pending_writes.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"后台保存记忆文件失败: {future.exception()}")
+
+    def flush_pending_writes(self, timeout: Optional[float] = None):
+        """等待所有后台写入完成（如关闭服务前调用）"""
+        for future in list(self._pending_writes):
+            future.result(timeout=timeout)
 
     def _get_patient_data(self, patient_id: str, create_if_not_exists: bool = True) -> Optional[Dict[str, Any]]:
         patients = self._memory.setdefault("patients", {})
@@ -184,17 +254,40 @@ class MemorySystem:
              self._save_memory()
              logger.info(f"已将患者 {patient_id} 的 {count} 条记忆标记为已归纳。")
 
-    def add_conversation_entry(self, patient_id: str, role: str, content: Any, metadata: Optional[Dict[str, Any]] = None):
+    def _append_conversation_entry(self, patient_id: str, role: str, content: Any, metadata: Dict[str, Any], now_iso: str) -> bool:
         patient_data = self._get_patient_data(patient_id, create_if_not_exists=True)
-        if not patient_data: return
-        now_iso = self._now_utc().isoformat()
-        if not metadata: metadata = {}
-        metadata["timestamp_utc"] = now_iso
+        if not patient_data: return False
         entry = {"entry_id": str(uuid.uuid4()),"role": role,"content": content,"metadata": metadata}
         patient_data.setdefault("conversation_history", []).append(entry)
         patient_data["last_updated"] = now_iso
         logger.debug(f"为患者 {patient_id} 添加对话 (角色: {role}): ID {entry['entry_id']}")
-        self._save_memory()
+        return True
+
+    def add_conversation_entry(self, patient_id: str, role: str, content: Any, metadata: Optional[Dict[str, Any]] = None):
+        now_iso = self._now_utc().isoformat()
+        if not metadata: metadata = {}
+        metadata["timestamp_utc"] = now_iso
+        if self._append_conversation_entry(patient_id, role, content, metadata, now_iso):
+            self._save_memory()
+
+    def add_conversation_entries(self, entries: List[Dict[str, Any]]):
+        """
+        批量添加对话记录，全部写入后只持久化一次。
+
+        Args:
+            entries: 记录列表，每项包含 "patient_id", "role", "content" 和可选的 "metadata"。
+                     metadata 中已有的 "timestamp_utc" 会被保留（用于保持记录发生时的顺序）。
+        """
+        if not entries: return
+        now_iso = self._now_utc().isoformat()
+        added = 0
+        for item in entries:
+            patient_id = item.get("patient_id")
+            if not patient_id: logger.warning("批量添加对话时跳过缺少 patient_id 的条目"); continue
+            metadata = item.get("metadata") or {}
+            metadata.setdefault("timestamp_utc", now_iso)
+            if self._append_conversation_entry(patient_id, item.get("role", "unknown"), item.get("content"), metadata, now_iso): added += 1
+        if added > 0: self._save_memory()
 
     def get_conversation_history(self, patient_id: str, limit: Optional[int] = None, roles: Optional[List[str]] = None) -> List[Dict[str, Any]]:
         patient_data = self._get_patient_data(patient_id, create_if_not_exists=False)
@@ -237,6 +330,27 @@ class MemorySystem:
             self._save_memory()
         else: pass # Okay if context doesn't exist
 
+    def commit_turn(self, context_id: str, context: Dict[str, Any], entries: List[Dict[str, Any]],
+                    patient_updates: Optional[Dict[str, Dict[str, Any]]] = None, background: bool = True):
+        """
+        一轮对话结束时一次性提交本轮的全部写入：患者信息更新、问诊上下文和对话记录，只落盘一次
+
+        Args:
+            context_id: 问诊上下文 ID
+            context: 本轮维护的上下文字段，合并到已有上下文中（保留其他组件写入的字段），不存在时新建
+            entries: 对话记录列表，格式同 add_conversation_entries
+            patient_updates: 患者 ID -> 需合并的基本信息
+            background: 是否在后台线程落盘
+        """
+        with self.pipeline(background=background):
+            for patient_id, info in (patient_updates or {}).items():
+                self.add_or_update_patient_info(patient_id, info)
+            if context_id in self._memory.get("active_consultations", {}):
+                self.update_consultation_context(context_id, context)
+            else:
+                self.save_consultation_context(context_id, context)
+            self.add_conversation_entries(entries)
+
     def consolidate_short_term_memory(self, patient_id: str) -> bool:
         logger.info(f"开始为患者 {patient_id} 尝试归纳短期记忆...")
         if not self.llm_service: logger.error(f"无法归纳记忆 (Patient: {patient_id})：LLM服务未初始化"); return False